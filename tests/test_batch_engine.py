@@ -0,0 +1,128 @@
+"""
+CPU test of the continuous batching engine against single-request `generate`, with a tiny
+randomly initialised `Videollama2Qwen2ForCausalLM`.
+
+Usage:
+    python -m pytest tests/test_batch_engine.py
+"""
+import torch
+
+from videollama2.model.language_model.videollama2_qwen2 import Videollama2Qwen2Config, Videollama2Qwen2ForCausalLM
+from videollama2.serve.batch_engine import ContinuousBatchingEngine
+
+
+class TinyTokenizer(object):
+    """Decodes token `i` as " t{i}", enough for the engine to stream text."""
+
+    eos_token_id = 1
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(f" t{i}" for i in token_ids if not (skip_special_tokens and i == self.eos_token_id))
+
+
+def build_tiny_model():
+    torch.manual_seed(0)
+    config = Videollama2Qwen2Config(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+    )
+    model = Videollama2Qwen2ForCausalLM(config).eval()
+    # NOTE: a zero logit for eos, so that the random model stops at `max_new_tokens` and the requests
+    # leave the batch at the steps the tests expect.
+    model.lm_head.weight.data[TinyTokenizer.eos_token_id] = 0
+    model.generation_config.eos_token_id = TinyTokenizer.eos_token_id
+    model.generation_config.pad_token_id = 0
+    return model
+
+
+def generate(model, prompts, max_new_tokens):
+    outputs = []
+    for input_ids, num_tokens in zip(prompts, max_new_tokens):
+        output_ids = model.generate(input_ids, do_sample=False, max_new_tokens=num_tokens, use_cache=True)
+        outputs.append(output_ids[0].tolist())
+    return outputs
+
+
+def check_outputs(requests, expected, max_new_tokens, tokenizer):
+    for request, expected_ids, num_tokens in zip(requests, expected, max_new_tokens):
+        text = "".join(request)
+        assert request.output_ids == expected_ids
+        assert text == tokenizer.decode(expected_ids)
+        assert len(request.output_ids) <= num_tokens
+
+
+def test_stepped_requests_join_and_leave_the_batch():
+    model, tokenizer = build_tiny_model(), TinyTokenizer()
+    prompts = [torch.randint(2, 128, (1, length)) for length in [5, 9, 3, 12]]
+    max_new_tokens = [16, 3, 12, 6]
+    expected = generate(model, prompts, max_new_tokens)
+
+    # NOTE: no scheduling thread, the test admits the requests and steps the batch itself.
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=3, start=False)
+    requests = [engine.submit(input_ids, temperature=0.0, max_new_tokens=num_tokens, timeout=60)
+                for input_ids, num_tokens in zip(prompts, max_new_tokens)]
+
+    # the first request decodes alone
+    engine.admit(engine.waiting.get_nowait())
+    engine.step()
+    engine.step()
+    assert engine.running == requests[:1]
+
+    # a longer and a shorter prompt join the running batch, left padded to the longest sequence
+    engine.admit(engine.waiting.get_nowait())
+    engine.admit(engine.waiting.get_nowait())
+    assert engine.running == requests[:3]
+    assert engine.attention_mask.shape == (3, 9)
+    assert engine.attention_mask.sum(dim=1).tolist() == [5 + 2, 9, 3]
+
+    # the second request finishes mid-batch, the others continue in the trimmed batch
+    while not requests[1].finished:
+        engine.step()
+    assert engine.running == [requests[0], requests[2]]
+    assert engine.attention_mask.shape[0] == 2
+    assert all(x.shape[0] == 2 for layer_past in engine.past_key_values for x in layer_past)
+
+    # the last request joins the trimmed batch
+    engine.admit(engine.waiting.get_nowait())
+    assert engine.running == [requests[0], requests[2], requests[3]]
+    while len(engine.running) > 0:
+        engine.step()
+
+    check_outputs(requests, expected, max_new_tokens, tokenizer)
+
+
+def test_overlapping_requests_match_generate():
+    model, tokenizer = build_tiny_model(), TinyTokenizer()
+    prompts = [torch.randint(2, 128, (1, length)) for length in [5, 9, 3, 12]]
+    max_new_tokens = [16, 8, 12, 4]
+    expected = generate(model, prompts, max_new_tokens)
+
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=3, start=False)
+    batch_sizes = []
+    merge = engine.merge
+
+    def recording_merge(*args):
+        merge(*args)
+        batch_sizes.append(len(engine.running))
+
+    engine.merge = recording_merge
+    # NOTE: all requests wait before the loop starts, so that it admits three of them into one batch
+    # and the last one when a slot is released.
+    requests = [engine.submit(input_ids, temperature=0.0, max_new_tokens=num_tokens, timeout=60)
+                for input_ids, num_tokens in zip(prompts, max_new_tokens)]
+    engine.start()
+
+    check_outputs(requests, expected, max_new_tokens, tokenizer)
+    assert batch_sizes[:3] == [1, 2, 3]
+    assert len(batch_sizes) == 4
+
+
+if __name__ == "__main__":
+    test_stepped_requests_join_and_leave_the_batch()
+    test_overlapping_requests_match_generate()
+    print("Passed.")
@@ -0,0 +1,87 @@
+"""
+Test of the video_affinity dispatch of the controller through its /get_worker_address endpoint,
+with fake workers registered directly (no worker process is started).
+
+Usage:
+    python -m pytest tests/test_controller.py
+"""
+import hashlib
+
+from fastapi.testclient import TestClient
+
+from videollama2.serve import controller as controller_module
+from videollama2.serve.controller import Controller
+
+
+WORKER_STATUS = {"model_names": ["videollama2"], "speed": 1, "queue_length": 0}
+
+
+def build_client(dispatch_method, num_workers):
+    controller = Controller(dispatch_method)
+    for idx in range(num_workers):
+        controller.add_worker(f"http://worker{idx}:21002", False, dict(WORKER_STATUS))
+    # NOTE: the endpoints use the module level controller of the server.
+    controller_module.controller = controller
+    return controller, TestClient(controller_module.app)
+
+
+def get_worker_address(client, media_digest, report=False):
+    ret = client.post("/get_worker_address", json={"model": "videollama2", "media_digest": media_digest, "report": report})
+    return ret.json()
+
+
+def test_repeated_media_stick_to_one_worker():
+    controller, client = build_client("video_affinity", 4)
+    digests = [hashlib.sha1(str(idx).encode()).hexdigest() for idx in range(200)]
+
+    assignment = {digest: get_worker_address(client, digest)["address"] for digest in digests}
+    assert len(set(assignment.values())) == 4
+    for _ in range(3):
+        for digest in digests:
+            # reported requests do not pile up, so every request goes to the owner of the media
+            ret = get_worker_address(client, digest, report=True)
+            assert ret["address"] == assignment[digest]
+            client.post("/report_request", json={"request_id": ret["request_id"], "first_token_latency": 0.1,
+                                                 "num_tokens": 8, "decode_time": 0.1, "success": True})
+
+    # a joining worker only takes media from the other workers
+    controller.add_worker("http://worker4:21002", False, dict(WORKER_STATUS))
+    joined = {digest: get_worker_address(client, digest)["address"] for digest in digests}
+    moved = [digest for digest in digests if joined[digest] != assignment[digest]]
+    assert 0 < len(moved) < len(digests) / 2
+    assert all(joined[digest] == "http://worker4:21002" for digest in moved)
+
+    # a leaving worker only gives its media to the other workers
+    controller.remove_worker("http://worker0:21002")
+    left = {digest: get_worker_address(client, digest)["address"] for digest in digests}
+    for digest in digests:
+        if joined[digest] != "http://worker0:21002":
+            assert left[digest] == joined[digest]
+        else:
+            assert left[digest] != "http://worker0:21002"
+
+
+def test_hot_media_spills_over_bounded_load():
+    controller, client = build_client("video_affinity", 4)
+    digest = hashlib.sha1(b"hot").hexdigest()
+    owner = get_worker_address(client, digest)["address"]
+
+    # unreported requests stay in flight, the owner takes its share and the rest spills over
+    addresses = [get_worker_address(client, digest, report=True)["address"] for _ in range(40)]
+    assert addresses[0] == owner
+    assert len(set(addresses)) > 1
+    assert addresses.count(owner) <= 40 * controller.affinity_load_factor / 4 + 1
+
+
+def test_power_of_two_uses_queue_length_without_stats():
+    controller, client = build_client("power_of_two", 2)
+    controller.receive_heart_beat("http://worker0:21002", 10)
+    for _ in range(20):
+        assert get_worker_address(client, None)["address"] == "http://worker1:21002"
+
+
+if __name__ == "__main__":
+    test_repeated_media_stick_to_one_worker()
+    test_hot_media_spills_over_bounded_load()
+    test_power_of_two_uses_queue_length_without_stats()
+    print("Passed.")
@@ -0,0 +1,88 @@
+"""
+Equivalence test of `encode_images_or_videos`, which encodes an image once and broadcasts its
+features along time, against the former computation which expanded every image into
+`num_frames` copies before the vision tower. The vision tower then runs with a different batch
+size, and batched kernels are not guaranteed to be bit-exact across batch sizes, so the outputs
+are compared with a tolerance.
+
+Usage:
+    python -m pytest tests/test_encode.py
+"""
+import einops
+import torch
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModel
+
+from videollama2.model.language_model.videollama2_qwen2 import Videollama2Qwen2Config, Videollama2Qwen2ForCausalLM
+
+NUM_FRAMES = 4
+
+
+def build_tiny_model(tmp_path):
+    torch.manual_seed(0)
+    # NOTE: the name of the vision tower must contain "clip", see `build_vision_tower`.
+    vision_tower_path = str(tmp_path / "tiny-clip")
+    clip_config = CLIPVisionConfig(hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                   num_attention_heads=4, image_size=32, patch_size=8)
+    CLIPVisionModel(clip_config).save_pretrained(vision_tower_path)
+    CLIPImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32}).save_pretrained(vision_tower_path)
+
+    config = Videollama2Qwen2Config(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        mm_vision_tower=vision_tower_path,
+        mm_vision_select_layer=-2,
+        mm_vision_select_feature="patch",
+        mm_hidden_size=32,
+        mm_projector_type="linear",
+        num_frames=NUM_FRAMES,
+    )
+    model = Videollama2Qwen2ForCausalLM(config).eval()
+    model.get_vision_tower().load_model()
+    return model
+
+
+def encode_expanded(model, images_or_videos, modalities):
+    """The former `encode_images_or_videos`: images are expanded to `num_frames` frames before the vision tower."""
+    num_frames = model.config.num_frames
+    videos = [x.unsqueeze(0).expand(num_frames, -1, -1, -1) if modal == 'image' else x for x, modal in zip(images_or_videos, modalities)]
+    videos = torch.stack(videos, dim=0)
+    batch_size = videos.size(0)
+
+    frames = einops.rearrange(videos, 'b t c h w -> (b t) c h w')
+    frames_features = model.get_vision_tower()(frames)
+    frames_features = einops.rearrange(frames_features, '(b t) n h -> b t n h', b=batch_size)
+    return model.temporal_aggregator(frames_features)
+
+
+@torch.no_grad()
+def test_images_encoded_once_match_expanded_images(tmp_path):
+    model = build_tiny_model(tmp_path)
+    images_or_videos = [
+        torch.randn(3, 32, 32),
+        torch.randn(NUM_FRAMES, 3, 32, 32),
+        torch.randn(3, 32, 32),
+    ]
+    modalities = ['image', 'video', 'image']
+
+    expected = encode_expanded(model, images_or_videos, modalities)
+    output = model.encode_images_or_videos(images_or_videos, modalities)
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+    # images alone (the vision tower batch shrinks from 2 * NUM_FRAMES to 2 frames)
+    expected = encode_expanded(model, images_or_videos[::2], modalities[::2])
+    output = model.encode_images_or_videos(images_or_videos[::2], modalities[::2])
+    assert torch.allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_images_encoded_once_match_expanded_images(pathlib.Path(tmp_dir))
+    print("Passed.")
@@ -0,0 +1,72 @@
+"""
+Tolerance test of the batched torch preprocessing (`preprocess_frames`) against the PIL path
+(`expand2square` + `CLIPImageProcessor.preprocess`), for padded and non-padded aspect ratios,
+odd sizes, downscaled and upscaled frames, grayscale and RGBA inputs.
+
+Usage:
+    python -m pytest tests/test_preprocess.py
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from videollama2.mm_utils import expand2square, preprocess_frames, processor_preprocess
+
+# NOTE: PIL resamples in fixed-point arithmetic, torch in float, the resized levels differ by rounding.
+MAX_LEVEL_ERROR = 3
+MEAN_LEVEL_ERROR = 0.5
+
+
+def random_frames(num_frames, height, width, channels, seed=0):
+    """Smooth random uint8 frames with shape (T, H, W, C), or (T, H, W) for one channel."""
+    generator = torch.Generator().manual_seed(seed)
+    frames = torch.rand(num_frames, channels, 7, 7, generator=generator) * 255
+    frames = F.interpolate(frames, size=(height, width), mode='bilinear', align_corners=False)
+    frames = frames.round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+    return frames[..., 0] if channels == 1 else frames
+
+
+def reference_preprocess(frames, processor, aspect_ratio, normalize):
+    images = [Image.fromarray(frame).convert('RGB') for frame in frames]
+    if aspect_ratio == 'pad':
+        images = [expand2square(image, tuple(int(x*255) for x in processor.image_mean)) for image in images]
+    return processor_preprocess(images, processor, normalize)
+
+
+def check_close(frames, aspect_ratio):
+    processor = CLIPImageProcessor()
+    expected = reference_preprocess(frames, processor, aspect_ratio, normalize=False)
+    output = preprocess_frames(frames, processor, aspect_ratio, normalize=False)
+    assert output.shape == expected.shape and output.dtype == torch.uint8
+
+    level_error = (output.float() - expected.float()).abs()
+    assert level_error.max() <= MAX_LEVEL_ERROR
+    assert level_error.mean() <= MEAN_LEVEL_ERROR
+
+    # the normalized outputs differ by the level errors scaled by the std of the channels
+    expected = reference_preprocess(frames, processor, aspect_ratio, normalize=True)
+    output = preprocess_frames(frames, processor, aspect_ratio, normalize=True)
+    atol = MAX_LEVEL_ERROR / 255 / min(processor.image_std) + 1e-5
+    assert torch.allclose(output, expected, atol=atol, rtol=0)
+
+
+def test_rgb_frames():
+    for height, width in [(224, 224), (37, 53), (53, 37), (300, 451), (481, 270)]:
+        frames = random_frames(3, height, width, 3)
+        for aspect_ratio in ['pad', None]:
+            check_close(frames, aspect_ratio)
+
+
+def test_grayscale_and_rgba_frames():
+    for channels in [1, 4]:
+        frames = random_frames(2, 97, 161, channels, seed=channels)
+        for aspect_ratio in ['pad', None]:
+            check_close(frames, aspect_ratio)
+
+
+if __name__ == "__main__":
+    test_rgb_frames()
+    test_grayscale_and_rgba_frames()
+    print("Passed.")
@@ -6,17 +6,21 @@ import torch
 from .model import Videollama2LlamaForCausalLM, Videollama2MistralForCausalLM, Videollama2MixtralForCausalLM, Videollama2Qwen2ForCausalLM
 from .model.builder import load_pretrained_model
 from .conversation import conv_templates, SeparatorStyle
-from .mm_utils import process_video, tokenizer_MMODAL_token, get_model_name_from_path, KeywordsStoppingCriteria
+from .mm_utils import process_video, tokenizer_MMODAL_token, tokenizer_MMODAL_token_batch, precompute_template_tokens, get_model_name_from_path, KeywordsStoppingCriteria
+from .mm_cache import PreprocessCache, copy_media_key
 from .constants import NUM_FRAMES, DEFAULT_MMODAL_TOKEN, DEFAULT_MMODAL_START_TOKEN, DEFAULT_MMODAL_END_TOKEN, MMODAL_TOKEN_INDEX
 
 
-def model_init(model_path=None):
+def model_init(model_path=None, cache_dir=None, preprocess_backend='pil', **kwargs):
     model_path = "DAMO-NLP-SG/VideoLLaMA2-7B" if model_path is None else model_path
     model_name = get_model_name_from_path(model_path)
-    tokenizer, model, processor, context_len = load_pretrained_model(model_path, None, model_name)
+    # NOTE: `kwargs` are passed to `load_pretrained_model`, e.g., `fast_load=True` for a fast startup.
+    tokenizer, model, processor, context_len = load_pretrained_model(model_path, None, model_name, **kwargs)
 
     if tokenizer.unk_token is not None: 
         tokenizer.pad_token = tokenizer.unk_token
+    # NOTE: tokenize the system prompts and separators of all conversation templates once.
+    precompute_template_tokens(tokenizer)
 
     num_frames = model.config.num_frames if hasattr(model.config, "num_frames") else NUM_FRAMES
 
@@ -30,7 +34,11 @@ def model_init(model_path=None):
         # mistral/mixtral/llama2
         version = 'llama2'
 
-    return model, partial(process_video, aspect_ratio=None, processor=processor, num_frames=num_frames), tokenizer, version
+    # NOTE: preprocessed videos are cached on disk when `cache_dir` is given (e.g., repeated eval runs).
+    cache = PreprocessCache(cache_dir) if cache_dir is not None else None
+
+    # NOTE: `preprocess_backend='torch'` preprocesses the frames of a video as one batch instead of one PIL round-trip per frame.
+    return model, partial(process_video, aspect_ratio=None, processor=processor, num_frames=num_frames, cache=cache, backend=preprocess_backend), tokenizer, version
 
 
 def infer(model, video, instruct, tokenizer, do_sample=False, version='llama2'):
@@ -38,7 +46,7 @@ def infer(model, video, instruct, tokenizer, do_sample=False, version='llama2'):
 
     Args:
         model: VideoLLaMA2 model.
-        video (torch.Tensor): video tensor (T, C, H, W).
+        video (torch.Tensor): video tensor (T, C, H, W), or its precomputed features (N, D) read from a `FeatureStore`.
         instruct (str): text instruction for understanding video.
         tokenizer: tokenizer.
         do_sample (bool): whether to sample.
@@ -48,7 +56,8 @@ def infer(model, video, instruct, tokenizer, do_sample=False, version='llama2'):
     """
 
     # 1. vision preprocess (load & transform image or video).
-    tensor = [video.half().cuda()]
+    # NOTE: uint8 frames are kept as they are and normalized by the model.
+    tensor = [copy_media_key(video.cuda() if video.dtype == torch.uint8 else video.half().cuda(), video)]
     modals = ["video"]
 
     # 2. text preprocess (tag process & generate prompt).
@@ -89,6 +98,108 @@ def infer(model, video, instruct, tokenizer, do_sample=False, version='llama2'):
     return outputs
 
 
+def strip_stop_str(output, stop_str):
+    """Drop the trailing stop string of an output (kept by `KeywordsStoppingCriteria.truncate` and the engine)."""
+    output = output.strip()
+    if stop_str and output.endswith(stop_str):
+        output = output[:-len(stop_str)]
+    return output.strip()
+
+
+def batch_infer(model, videos, instructs, tokenizer, do_sample=False, version='llama2', engine=None):
+    """batched inference api of VideoLLaMA2 for video understanding.
+
+    Args:
+        model: VideoLLaMA2 model.
+        videos (List[torch.Tensor]): video tensors (T, C, H, W), one per instruction.
+        instructs (List[str]): text instructions for understanding videos.
+        tokenizer: tokenizer.
+        do_sample (bool): whether to sample.
+        version (str): conversation template version.
+        engine (ContinuousBatchingEngine): if given, the samples are decoded by the engine, i.e.,
+            a finished sample leaves the batch at once and a waiting sample takes its place.
+    Returns:
+        List[str]: responses of the model.
+    """
+    if engine is None and getattr(model, 'prefix_cache', None) is not None:
+        # NOTE: the prefix cache only serves unpadded single prompts, decode the samples one by one
+        # so that the questions on the same video only prefill their own text.
+        conv = conv_templates[version]
+        stop_str = conv.sep if conv.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.QWEN] else conv.sep2
+        return [
+            strip_stop_str(infer(model=model, video=video, instruct=instruct, tokenizer=tokenizer, do_sample=do_sample, version=version), stop_str)
+            for video, instruct in zip(videos, instructs)
+        ]
+    assert len(videos) == len(instructs)
+
+    # 1. vision preprocess (load & transform image or video).
+    # NOTE: uint8 frames are kept as they are and normalized by the model.
+    tensor = [copy_media_key(video.cuda() if video.dtype == torch.uint8 else video.half().cuda(), video) for video in videos]
+    modals = ["video"] * len(videos)
+
+    # 2. text preprocess (tag process & generate prompt).
+    modal_token = DEFAULT_MMODAL_TOKEN['VIDEO']
+    modal_index = MMODAL_TOKEN_INDEX["VIDEO"]
+
+    prompts = []
+    for instruct in instructs:
+        conv = conv_templates[version].copy()
+        conv.append_message(conv.roles[0], modal_token + '\n' + instruct)
+        conv.append_message(conv.roles[1], None)
+        prompts.append(conv.get_prompt())
+    input_ids = tokenizer_MMODAL_token_batch(prompts, tokenizer, modal_index, return_tensors='pt')
+    stop_str = conv.sep if conv.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.QWEN] else conv.sep2
+
+    if engine is not None:
+        requests = [
+            engine.submit(
+                cur_input_ids.unsqueeze(0),
+                images_or_videos=[cur_tensor],
+                modal_list=[modal],
+                temperature=0.2 if do_sample else 0.0,
+                max_new_tokens=1024,
+                stop_str=stop_str,
+            )
+            for cur_input_ids, cur_tensor, modal in zip(input_ids, tensor, modals)
+        ]
+        # NOTE: the engine cuts every output right after its stop string, which is dropped.
+        return [strip_stop_str(''.join(request), stop_str) for request in requests]
+
+    # NOTE: left padding, so that the new tokens of all samples are appended right after their prompts.
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    max_len = max(len(x) for x in input_ids)
+    padded_input_ids = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_masks = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+    for i, cur_input_ids in enumerate(input_ids):
+        padded_input_ids[i, max_len - len(cur_input_ids):] = cur_input_ids
+        attention_masks[i, max_len - len(cur_input_ids):] = 1
+    input_ids, attention_masks = padded_input_ids.cuda(), attention_masks.cuda()
+
+    # 3. generate response according to visual signals and prompts. 
+    keywords = [stop_str]
+    # NOTE: finished samples are padded instead of decoded further, the generation ends when all samples are finished.
+    stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
+
+    with torch.inference_mode():
+        output_ids = model.generate(
+            input_ids,
+            attention_mask=attention_masks,
+            images_or_videos=tensor,
+            modal_list=modals,
+            do_sample=do_sample,
+            temperature=0.2 if do_sample else 0.0,
+            max_new_tokens=1024,
+            use_cache=True,
+            stopping_criteria=[stopping_criteria],
+            pad_token_id=tokenizer.eos_token_id,
+        )
+
+    # NOTE: cut each sample where it would have stopped alone, and drop its stop string (as the engine path).
+    outputs = [strip_stop_str(x, stop_str) for x in stopping_criteria.truncate(output_ids)]
+
+    return outputs
+
+
 def x_infer(video, question, model, tokenizer, mode='vanilla', do_sample=False, version='llama2'):
     if mode == 'mcqa':
         instruction = f'{question}\nAnswer with the option\'s letter from the given choices directly and only give the best option.'
@@ -99,3 +210,13 @@ def x_infer(video, question, model, tokenizer, mode='vanilla', do_sample=False,
     elif mode == 'vanilla':
         instruction = question
         return infer(model=model, tokenizer=tokenizer, video=video, instruct=instruction, do_sample=do_sample, version=version)
+
+
+def x_batch_infer(videos, questions, model, tokenizer, mode='vanilla', do_sample=False, version='llama2', engine=None):
+    if mode == 'mcqa':
+        instructions = [f'{question}\nAnswer with the option\'s letter from the given choices directly and only give the best option.' for question in questions]
+    elif mode == 'openend':
+        instructions = [f'{question}\nAnswer the question using a single word or a short phrase with multiple words.' for question in questions]
+    elif mode == 'vanilla':
+        instructions = questions
+    return batch_infer(model=model, tokenizer=tokenizer, videos=videos, instructs=instructions, do_sample=do_sample, version=version, engine=engine)
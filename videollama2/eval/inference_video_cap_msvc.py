@@ -5,9 +5,12 @@ import json
 import warnings
 from tqdm import tqdm
 
+import torch
+
 import sys
 sys.path.append('./')
 from videollama2 import model_init, x_infer
+from videollama2.pipeline import PrefetchPipeline
 
 # NOTE: Ignore TypedStorage warning, which refers to this link~(https://github.com/pytorch/pytorch/issues/97207#issuecomment-1494781560)
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
@@ -25,7 +28,7 @@ def get_chunk(lst, n, k):
 
 
 def run_inference(args):
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
 
     gt_questions = json.load(open(args.question_file, "r"))
     gt_questions = get_chunk(gt_questions, args.num_chunks, args.chunk_idx)
@@ -36,15 +39,18 @@ def run_inference(args):
 
     video_formats = ['.mp4', '.avi', '.mov', '.mkv']
 
+    def load_sample(sample):
+        return sample, processor(os.path.join(args.video_folder, sample['video_path']))
+
+    # NOTE: decode & transfer the next videos while generating for the current one.
+    samples = PrefetchPipeline(gt_questions, device=model.device, dtype=torch.float16, transform=load_sample)
+
     # Iterate over each sample in the ground truth file
-    for idx, sample in enumerate(tqdm(gt_questions)):
+    for idx, (sample, video_tensor) in enumerate(tqdm(samples)):
         video_name = sample['video_path']
         question = sample['question']
         answer = sample['captions']
 
-        video_path = os.path.join(args.video_folder, video_name)
-        video_tensor = processor(video_path)
-
         output = x_infer(
             video_tensor,
             question, 
@@ -58,6 +64,7 @@ def run_inference(args):
         sample_set = {'video_name': video_name, 'question': question, 'answer': answer, 'pred': output}
         ans_file.write(json.dumps(sample_set) + "\n")
 
+    print(f'Pipeline timings: {samples.summary()}')
     ans_file.close()
 
 
@@ -71,6 +78,7 @@ if __name__ == "__main__":
     parser.add_argument("--num-chunks", type=int, default=1)
     parser.add_argument("--chunk-idx", type=int, default=0)
     parser.add_argument("--device", type=str, required=False, default='cuda:0')
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
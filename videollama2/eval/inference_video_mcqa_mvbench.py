@@ -5,6 +5,7 @@ import json
 import argparse
 import warnings
 import traceback
+from functools import partial
 
 import torch
 import numpy as np
@@ -15,7 +16,9 @@ from torch.utils.data import Dataset, DataLoader
 
 import sys
 sys.path.append('./')
-from videollama2 import model_init, x_infer
+from videollama2 import model_init, x_batch_infer
+from videollama2.pipeline import PrefetchPipeline, SharedFrameBuffer, SharedFramesDataset
+from videollama2.serve.batch_engine import ContinuousBatchingEngine
 from videollama2.constants import NUM_FRAMES
 
 # NOTE: Ignore TypedStorage warning, which refers to this link~(https://github.com/pytorch/pytorch/issues/97207#issuecomment-1494781560)
@@ -201,7 +204,7 @@ tasks = {
 }
 
 
-def build_mvbench_eval(args, processor, num_frames):
+def build_mvbench_eval(args, processor, num_frames, frame_buffer=None):
     data_list = []
     for task_name, task in tasks.items():
         json_file = os.path.join(args.question_file, task[0])
@@ -217,7 +220,11 @@ def build_mvbench_eval(args, processor, num_frames):
                 'data': data
             })
     data_list = get_chunk(data_list, args.num_chunks, args.chunk_idx)
-    dataset = MVBenchDataset(data_list, processor, num_segments=num_frames)
+    if frame_buffer is not None:
+        # NOTE: the workers send uint8 frames through the shared-memory ring, the model normalizes them.
+        dataset = SharedFramesDataset(MVBenchDataset(data_list, partial(processor, normalize=False), num_segments=num_frames), frame_buffer)
+    else:
+        dataset = MVBenchDataset(data_list, processor, num_segments=num_frames)
     dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
     
     return dataloader
@@ -245,7 +252,13 @@ def mvbench_dump(ans_file, line, outputs):
 
 
 def run_inference(args):
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
+    if args.feature_cache_size > 0:
+        model.get_vision_tower().enable_feature_cache(args.feature_cache_size << 30)
+    if args.prefix_cache_size > 0:
+        model.enable_prefix_cache(args.prefix_cache_size << 30)
+    # NOTE: with early exit, finished answers leave the decode batch at once and waiting questions take their place.
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=args.batch_size) if args.early_exit else None
 
     num_frames = model.config.num_frames if hasattr(model.config, "num_frames") else NUM_FRAMES
 
@@ -253,25 +266,36 @@ def run_inference(args):
     os.makedirs(os.path.dirname(answer_file), exist_ok=True)
     ans_file = open(answer_file, "w")
 
-    val_loader = build_mvbench_eval(args, processor, num_frames)
+    frame_buffer = None
+    if args.shared_frames:
+        frame_buffer = SharedFrameBuffer.for_loader(model.get_vision_tower().image_processor, num_frames, args.batch_size, args.num_workers)
+    val_loader = build_mvbench_eval(args, processor, num_frames, frame_buffer)
+
+    def load_frames(line):
+        line['video'] = frame_buffer.get_batch(line['video'], pin_memory=torch.cuda.is_available())
+        return line
+
+    # NOTE: decode & transfer the next batches while generating for the current one.
+    val_loader = PrefetchPipeline(val_loader, device=model.device, dtype=torch.float16, transform=load_frames if frame_buffer is not None else None)
 
-    # NOTE: only support batch size 1 for now
     for i, line in enumerate(tqdm(val_loader)):
-        video_tensor = line['video'][0]
-        instruct = line['instruct'][0]
+        video_tensors = list(line['video'])
+        instructs = line['instruct']
 
-        pred = x_infer(
-            video_tensor,
-            instruct,
+        preds = x_batch_infer(
+            video_tensors,
+            instructs,
             mode='vanilla',
             model=model,
             tokenizer=tokenizer,
             do_sample=False,
             version=version,
+            engine=engine,
         )
 
-        mvbench_dump(ans_file, line, [pred])
+        mvbench_dump(ans_file, line, preds)
 
+    print(f'Pipeline timings: {val_loader.summary()}')
     ans_file.close()
 
 
@@ -287,6 +311,11 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, required=False, default='cuda:0')
     parser.add_argument("--batch-size", type=int, default=1)
     parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shared-frames", action='store_true', help='Ship uint8 frames from the workers through a shared-memory ring buffer.')
+    parser.add_argument("--early-exit", action='store_true', help='Decode with continuous batching, so that finished samples stop being decoded.')
+    parser.add_argument("--feature-cache-size", type=int, default=0, help='Cache the frame features of the vision tower in a cpu LRU of this size in GB (0 disables it).')
+    parser.add_argument("--prefix-cache-size", type=int, default=0, help='Reuse the key/value states of the system prompt and video across the questions on a video, in a LRU of this size in GB (0 disables it, not used with --early-exit).')
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
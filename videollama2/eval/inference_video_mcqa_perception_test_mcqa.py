@@ -5,6 +5,7 @@ import json
 import argparse
 import warnings
 import traceback
+from functools import partial
 from tqdm import tqdm
 
 import torch
@@ -12,7 +13,10 @@ from torch.utils.data import Dataset, DataLoader
 
 import sys
 sys.path.append('./')
-from videollama2 import model_init, x_infer
+from videollama2 import model_init, x_batch_infer
+from videollama2.pipeline import PrefetchPipeline, SharedFrameBuffer, SharedFramesDataset
+from videollama2.serve.batch_engine import ContinuousBatchingEngine
+from videollama2.constants import NUM_FRAMES
 
 
 def split_list(lst, n):
@@ -83,67 +87,83 @@ def collate_fn(batch):
 
 
 def run_inference(args):
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
+    if args.feature_cache_size > 0:
+        model.get_vision_tower().enable_feature_cache(args.feature_cache_size << 30)
+    if args.prefix_cache_size > 0:
+        model.enable_prefix_cache(args.prefix_cache_size << 30)
+    # NOTE: with early exit, finished answers leave the decode batch at once and waiting questions take their place.
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=args.batch_size) if args.early_exit else None
 
     questions = json.load(open(args.question_file, "r"))
     questions = list(questions.values())
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
 
-    assert args.batch_size == 1, "Batch size must be 1 for inference"
-    dataset = PerceptionTestMCQADataset(questions, processor)
+    num_frames = model.config.num_frames if hasattr(model.config, "num_frames") else NUM_FRAMES
+    frame_buffer = None
+    if args.shared_frames:
+        frame_buffer = SharedFrameBuffer.for_loader(model.get_vision_tower().image_processor, num_frames, args.batch_size, args.num_workers)
+    if frame_buffer is not None:
+        # NOTE: the workers send uint8 frames through the shared-memory ring, the model normalizes them.
+        dataset = SharedFramesDataset(PerceptionTestMCQADataset(questions, partial(processor, normalize=False)), frame_buffer)
+    else:
+        dataset = PerceptionTestMCQADataset(questions, processor)
     dataloader = DataLoader(dataset, shuffle=False, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_fn)
 
+    def load_frames(batch):
+        video_tensors, *others = batch
+        return (frame_buffer.get_batch(video_tensors, pin_memory=torch.cuda.is_available()), *others)
+
+    # NOTE: decode & transfer the next batches while generating for the current one.
+    dataloader = PrefetchPipeline(dataloader, device=model.device, dtype=torch.float16, transform=load_frames if frame_buffer is not None else None)
+
     answer_file = os.path.expanduser(args.answer_file)
     os.makedirs(os.path.dirname(answer_file), exist_ok=True)
     ans_file = open(answer_file, "w")
 
     # Iterate over each sample in the ground truth file
-    for i, (video_tensor, video_id, instructs, question_ids, options) in enumerate(tqdm(dataloader)):
-
-        # reduce batch dimension
-        video_tensor = video_tensor[0]
-        video_id = video_id[0]
-        instructs = instructs[0]
-        question_ids = question_ids[0]
-        options = options[0]
-
-        qas = []
-        for idx, instruct in enumerate(instructs):
-            letters = ['(A)', '(B)', '(C)']
-            question_id = question_ids[idx]
-            _options = options[idx]
-
-            output = x_infer(
-                video_tensor,
-                instruct,
+    for i, (video_tensors, video_ids, batch_instructs, batch_question_ids, batch_options) in enumerate(tqdm(dataloader)):
+        for video_tensor, video_id, instructs, question_ids, options in zip(video_tensors, video_ids, batch_instructs, batch_question_ids, batch_options):
+            # NOTE: all questions of one video are answered in one batch.
+            outputs = x_batch_infer(
+                [video_tensor] * len(instructs),
+                instructs,
                 mode='vanilla',
                 model=model,
                 tokenizer=tokenizer,
                 do_sample=False,
                 version=version,
+                engine=engine,
             )
 
-            pred_answer = re.findall('\(*[A-C]\)*', output)
-            try:
-                assert len(pred_answer) >= 1, 'The video \"{}\" output \"{}\" is not in the expected format'.format(video_id, instruct + '\n' + output)
-                pred_answer = pred_answer[0].strip()
-                # if not pred_answer.startswith('('):
-                pred_answer = pred_answer.strip('()')
-                pred_answer = f'({pred_answer})'
-                pred_idx = letters.index(pred_answer)
-            except:
-                traceback.print_exc()
-                tmp_options = [x.lower() for x in _options]
-                if output.lower() in tmp_options:
+            qas = []
+            for idx, (instruct, output) in enumerate(zip(instructs, outputs)):
+                letters = ['(A)', '(B)', '(C)']
+                question_id = question_ids[idx]
+                _options = options[idx]
+
+                pred_answer = re.findall('\(*[A-C]\)*', output)
+                try:
+                    assert len(pred_answer) >= 1, 'The video \"{}\" output \"{}\" is not in the expected format'.format(video_id, instruct + '\n' + output)
+                    pred_answer = pred_answer[0].strip()
+                    # if not pred_answer.startswith('('):
+                    pred_answer = pred_answer.strip('()')
+                    pred_answer = f'({pred_answer})'
+                    pred_idx = letters.index(pred_answer)
+                except:
+                    traceback.print_exc()
                     tmp_options = [x.lower() for x in _options]
-                    pred_idx = tmp_options.index(output.lower())
-                else:
-                    pred_idx = 2
+                    if output.lower() in tmp_options:
+                        tmp_options = [x.lower() for x in _options]
+                        pred_idx = tmp_options.index(output.lower())
+                    else:
+                        pred_idx = 2
 
-            qas.append({'id': question_id, 'answer_id': pred_idx, 'answer': _options[pred_idx]})
+                qas.append({'id': question_id, 'answer_id': pred_idx, 'answer': _options[pred_idx]})
 
-        ans_file.write('\"{}\": {},\n'.format(video_id, json.dumps(qas)))
+            ans_file.write('\"{}\": {},\n'.format(video_id, json.dumps(qas)))
 
+    print(f'Pipeline timings: {dataloader.summary()}')
     ans_file.close()
 
 
@@ -160,6 +180,11 @@ if __name__ == "__main__":
     parser.add_argument("--model_max_length", type=int, required=False, default=2048)
     parser.add_argument("--batch-size", type=int, required=False, default=1)
     parser.add_argument("--num-workers", type=int, required=False, default=8)
+    parser.add_argument("--shared-frames", action='store_true', help='Ship uint8 frames from the workers through a shared-memory ring buffer.')
+    parser.add_argument("--early-exit", action='store_true', help='Decode with continuous batching, so that finished samples stop being decoded.')
+    parser.add_argument("--feature-cache-size", type=int, default=0, help='Cache the frame features of the vision tower in a cpu LRU of this size in GB (0 disables it).')
+    parser.add_argument("--prefix-cache-size", type=int, default=0, help='Reuse the key/value states of the system prompt and video across the questions on a video, in a LRU of this size in GB (0 disables it, not used with --early-exit).')
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
@@ -6,6 +6,7 @@ import copy
 import argparse
 import warnings
 import traceback
+from functools import partial
 
 import cv2
 import torch
@@ -17,7 +18,10 @@ from torch.utils.data import Dataset, DataLoader
 
 import sys
 sys.path.append('./')
-from videollama2 import model_init, x_infer
+from videollama2 import model_init, x_batch_infer
+from videollama2.pipeline import PrefetchPipeline, SharedFrameBuffer, SharedFramesDataset
+from videollama2.serve.batch_engine import ContinuousBatchingEngine
+from videollama2.constants import NUM_FRAMES
 
 # NOTE: Ignore TypedStorage warning, which refers to this link~(https://github.com/pytorch/pytorch/issues/97207#issuecomment-1494781560)
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
@@ -170,12 +174,16 @@ def load_parquet(parquet_file):
     return jsons
 
 
-def build_videomme_eval(args, processor):
+def build_videomme_eval(args, processor, frame_buffer=None):
     # convert parquet to json
     questions = load_parquet(args.question_file)
     # questions = json.load(open(args.question_file, "r"))
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
-    dataset = VideoMMEDataset(args.video_folder, args.subtitle_folder, questions, processor)
+    if frame_buffer is not None:
+        # NOTE: the workers send uint8 frames through the shared-memory ring, the model normalizes them.
+        dataset = SharedFramesDataset(VideoMMEDataset(args.video_folder, args.subtitle_folder, questions, partial(processor, normalize=False)), frame_buffer)
+    else:
+        dataset = VideoMMEDataset(args.video_folder, args.subtitle_folder, questions, processor)
     dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, collate_fn=collate_fn)
 
     return dataloader
@@ -199,7 +207,13 @@ def videomme_dump(record, instruct, output):
 
 def run_inference(args):
     # Initialize the model
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
+    if args.feature_cache_size > 0:
+        model.get_vision_tower().enable_feature_cache(args.feature_cache_size << 30)
+    if args.prefix_cache_size > 0:
+        model.enable_prefix_cache(args.prefix_cache_size << 30)
+    # NOTE: with early exit, finished answers leave the decode batch at once and waiting questions take their place.
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=args.batch_size) if args.early_exit else None
 
     answer_file = os.path.expanduser(args.answer_file)
     answer_sub_file = answer_file.replace('.json', '_sub.json')
@@ -207,47 +221,73 @@ def run_inference(args):
     ans_file = open(answer_file, "w")
     ans_sub_file = open(answer_sub_file, "w")
 
-    val_loader = build_videomme_eval(args, processor)
+    num_frames = model.config.num_frames if hasattr(model.config, "num_frames") else NUM_FRAMES
+    frame_buffer = None
+    if args.shared_frames:
+        frame_buffer = SharedFrameBuffer.for_loader(model.get_vision_tower().image_processor, num_frames, args.batch_size, args.num_workers)
+    val_loader = build_videomme_eval(args, processor, frame_buffer)
+
+    def load_frames(batch):
+        videos, subtitles, records = batch
+        return frame_buffer.get_batch(videos, pin_memory=torch.cuda.is_available()), subtitles, records
+
+    # NOTE: decode & transfer the next batches while generating for the current one.
+    val_loader = PrefetchPipeline(val_loader, device=model.device, dtype=torch.float16, transform=load_frames if frame_buffer is not None else None)
 
     # Iterate over each sample in the ground truth file
     for i, (videos, subtitles, records) in enumerate(tqdm(val_loader)):
-        video_tensor  = videos[0]
-        subtitle = subtitles[0]
-        record = records[0]
+        new_records, new_records_sub = [], []
+        # NOTE: all questions (w/o and w/ subtitles) of all videos in the batch are answered in one batch.
+        batch_videos, batch_instructs, batch_targets = [], [], []
+        for video_tensor, subtitle, record in zip(videos, subtitles, records):
+            new_record = copy.deepcopy(record)
+            new_record_sub = copy.deepcopy(record)
+            new_records.append(new_record)
+            new_records_sub.append(new_record_sub)
+
+            if video_tensor is None:
+                new_record['missing'] = True
+                new_record_sub['missing'] = True
+                continue
+            else:
+                new_record['missing'] = False
+                new_record_sub['missing'] = False
+
+            questions = record['questions']
+            for idx, question in enumerate(questions):
+                q = question['question']
+                ops = question['choices']
+
+                instruct = "Select the best answer to the following multiple-choice question based on the video. Respond with only the letter (A, B, C, or D) of the correct option.\n"
+                instruct += f"{q}\n"
+                for op_idx, op in enumerate(ops):
+                    instruct += f"{op}\n"
+                instruct += "The best answer is: "
+                batch_videos.append(video_tensor)
+                batch_instructs.append(instruct)
+                batch_targets.append((new_record, idx))
+
+                instruct = f"This video's subtitles are listed below:\n{subtitle}\n" + instruct
+                batch_videos.append(video_tensor)
+                batch_instructs.append(instruct)
+                batch_targets.append((new_record_sub, idx))
+
+        outputs = []
+        if engine is not None:
+            # NOTE: the engine keeps at most `batch_size` questions in flight and refills the batch by itself.
+            outputs = x_batch_infer(batch_videos, batch_instructs, mode='vanilla', model=model, tokenizer=tokenizer, do_sample=False, version=version, engine=engine)
+        else:
+            for start in range(0, len(batch_instructs), args.batch_size):
+                outputs += x_batch_infer(batch_videos[start:start + args.batch_size], batch_instructs[start:start + args.batch_size], mode='vanilla', model=model, tokenizer=tokenizer, do_sample=False, version=version)
 
-        new_record = copy.deepcopy(record)
-        new_record_sub = copy.deepcopy(record)
+        for (target_record, idx), instruct, output in zip(batch_targets, batch_instructs, outputs):
+            target_record['questions'][idx]['response'] = videomme_dump(target_record, instruct, output)
 
-        if video_tensor is None:
-            new_record['missing'] = True
+        for new_record, new_record_sub in zip(new_records, new_records_sub):
             ans_file.write(json.dumps(new_record) + ",\n")
-            new_record_sub['missing'] = True
             ans_sub_file.write(json.dumps(new_record_sub) + ",\n")
-            continue
-        else:
-            new_record['missing'] = False
-            new_record_sub['missing'] = False
-
-        questions = record['questions']
-        for idx, question in enumerate(questions):
-            q = question['question']
-            ops = question['choices']
-
-            instruct = "Select the best answer to the following multiple-choice question based on the video. Respond with only the letter (A, B, C, or D) of the correct option.\n"
-            instruct += f"{q}\n"
-            for op_idx, op in enumerate(ops):
-                instruct += f"{op}\n"
-            instruct += "The best answer is: "
-            output = x_infer(video_tensor, instruct, mode='vanilla', model=model, tokenizer=tokenizer, do_sample=False, version=version)
-            new_record['questions'][idx]['response'] = videomme_dump(record, instruct, output)
-
-            instruct = f"This video's subtitles are listed below:\n{subtitle}\n" + instruct
-            output = x_infer(video_tensor, instruct, mode='vanilla', model=model, tokenizer=tokenizer, do_sample=False, version=version)
-            new_record_sub['questions'][idx]['response'] = videomme_dump(record, instruct, output)
-
-        ans_file.write(json.dumps(new_record) + ",\n")
-        ans_sub_file.write(json.dumps(new_record_sub) + ",\n")
 
+    print(f'Pipeline timings: {val_loader.summary()}')
     ans_file.close()
     ans_sub_file.close()
 
@@ -265,6 +305,11 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, required=False, default='cuda:0')
     parser.add_argument("--batch-size", type=int, default=1)
     parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shared-frames", action='store_true', help='Ship uint8 frames from the workers through a shared-memory ring buffer.')
+    parser.add_argument("--early-exit", action='store_true', help='Decode with continuous batching, so that finished samples stop being decoded.')
+    parser.add_argument("--feature-cache-size", type=int, default=0, help='Cache the frame features of the vision tower in a cpu LRU of this size in GB (0 disables it).')
+    parser.add_argument("--prefix-cache-size", type=int, default=0, help='Reuse the key/value states of the system prompt and video across the questions on a video, in a LRU of this size in GB (0 disables it, not used with --early-exit).')
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
@@ -5,9 +5,12 @@ import argparse
 import warnings
 from tqdm import tqdm
 
+import torch
+
 import sys
 sys.path.append('./')
 from videollama2 import model_init, x_infer
+from videollama2.pipeline import PrefetchPipeline
 
 # NOTE: Ignore TypedStorage warning, which refers to this link~(https://github.com/pytorch/pytorch/issues/97207#issuecomment-1494781560)
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
@@ -26,7 +29,7 @@ def get_chunk(lst, n, k):
 
 def run_inference(args):
     # Initialize the model
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
 
     gt_questions = json.load(open(args.question_file, "r"))
     gt_questions = get_chunk(gt_questions, args.num_chunks, args.chunk_idx)
@@ -39,13 +42,8 @@ def run_inference(args):
 
     video_formats = ['.mp4', '.avi', '.mov', '.mkv']
 
-    # Iterate over each sample in the ground truth file
-    for idx, sample in enumerate(tqdm(gt_questions)):
+    def load_sample(sample):
         video_name = sample['video_name']
-        question = sample['question']
-        qid = sample['question_id']
-        answer = gt_answers[idx]['answer']
-
         # Load the video file
         for fmt in video_formats:
             temp_path = os.path.join(args.video_folder, f"v_{video_name}{fmt}")
@@ -57,10 +55,20 @@ def run_inference(args):
             if os.path.exists(temp_path):
                 video_path = temp_path
                 break
+        return sample, processor(video_path)
+
+    # NOTE: decode & transfer the next videos while generating for the current one.
+    samples = PrefetchPipeline(gt_questions, device=model.device, dtype=torch.float16, transform=load_sample)
+
+    # Iterate over each sample in the ground truth file
+    for idx, (sample, video_tensor) in enumerate(tqdm(samples)):
+        video_name = sample['video_name']
+        question = sample['question']
+        qid = sample['question_id']
+        answer = gt_answers[idx]['answer']
 
         # question = question + '\n' + 'Answer the question using a single word or a short phrase with multiple words.'
 
-        video_tensor = processor(video_path)
         output = x_infer(
             video_tensor,
             question, 
@@ -74,6 +82,7 @@ def run_inference(args):
         sample_set = {'id': qid, 'question': question, 'answer': answer, 'pred': output}
         ans_file.write(json.dumps(sample_set) + "\n")
 
+    print(f'Pipeline timings: {samples.summary()}')
     ans_file.close()
 
 
@@ -88,6 +97,7 @@ if __name__ == "__main__":
     parser.add_argument("--num-chunks", type=int, default=1)
     parser.add_argument("--chunk-idx", type=int, default=0)
     parser.add_argument("--device", type=str, required=False, default='cuda:0')
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
@@ -12,6 +12,7 @@ from torch.utils.data import Dataset, DataLoader
 import sys
 sys.path.append('./')
 from videollama2 import model_init, x_infer
+from videollama2.pipeline import PrefetchPipeline
 
 # NOTE: Ignore TypedStorage warning, which refers to this link~(https://github.com/pytorch/pytorch/issues/97207#issuecomment-1494781560)
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
@@ -72,7 +73,7 @@ def collate_fn(batch):
 
 def run_inference(args):
     # Initialize the model
-    model, processor, tokenizer, version = model_init(args.model_path)
+    model, processor, tokenizer, version = model_init(args.model_path, preprocess_backend=args.preprocess_backend)
 
     questions = json.load(open(args.question_file, "r"))
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
@@ -80,6 +81,8 @@ def run_inference(args):
     assert args.batch_size == 1, "Batch size must be 1 for inference"
     dataset = VCGPTDataset(questions, processor)
     dataloader = DataLoader(dataset, shuffle=False, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_fn)
+    # NOTE: decode & transfer the next batches while generating for the current one.
+    dataloader = PrefetchPipeline(dataloader, device=model.device, dtype=torch.float16)
 
     answer_file = os.path.expanduser(args.answer_file)
     os.makedirs(os.path.dirname(answer_file), exist_ok=True)
@@ -108,6 +111,7 @@ def run_inference(args):
 
         ans_file.write(json.dumps(qa) + "\n")
 
+    print(f'Pipeline timings: {dataloader.summary()}')
     ans_file.close()
 
 
@@ -123,6 +127,7 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, required=False, default='cuda:0')
     parser.add_argument("--batch-size", type=int, required=False, default=1)
     parser.add_argument("--num-workers", type=int, required=False, default=8)
+    parser.add_argument("--preprocess-backend", type=str, default='pil', choices=['pil', 'torch'], help='Preprocess the frames of a video one by one with PIL, or as one batch with torch.')
     args = parser.parse_args()
 
     run_inference(args)
@@ -0,0 +1,245 @@
+"""
+Offline extraction and storage of projected visual features.
+
+`encode_images_or_videos` is deterministic for a given video, sampling config and model, so its
+output (the connector features after `temporal_aggregator`) can be computed once, away from the
+language model, and reused across questions, evals and restarts. The features are appended to
+memory-mapped shards and located through an index; pass them to `generate` (or `infer`) in
+place of the video tensors, e.g.:
+
+    store = FeatureStore('features/videollama2-7b')
+    features = store.get_video('video.mp4', **store.meta['params'])
+    output_ids = model.generate(input_ids, images_or_videos=[features], modal_list=['video'], ...)
+
+Extraction (only the vision tower and the connector are loaded):
+    python -m videollama2.feature_store --model-path DAMO-NLP-SG/VideoLLaMA2-7B --video-folder videos --store-dir features/videollama2-7b
+"""
+import os
+import json
+import uuid
+import hashlib
+import argparse
+import threading
+
+import torch
+import numpy as np
+from transformers import AutoConfig
+
+from .constants import NUM_FRAMES
+from .mm_cache import file_digest
+from .mm_utils import process_video
+from .pipeline import PrefetchPipeline
+from .model.quantization import load_vision_modules, quantize_vision_tower, quantize_connector, encode_videos
+
+
+def make_key(digest, params):
+    """Build the key of a video (by its content digest) and its sampling parameters (num_frames, aspect_ratio, ...)."""
+    meta = {'file': digest, 'params': {k: params[k] for k in sorted(params)}}
+    return hashlib.sha1(json.dumps(meta, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class FeatureStore(object):
+    """Sharded, memory-mapped store of float16 visual features with an index.
+
+    Layout of `root`:
+        features-00000.bin, ...: raw float16 features appended one after the other. A new shard
+            is started once the current one exceeds `shard_size` bytes.
+        index.json: the store `meta` (model, sampling parameters, ...) and, for every key, the
+            (shard, offset, shape) of its features. It is rewritten atomically by `flush`, so
+            readers never see entries whose data is not written yet.
+
+    There is one writer at a time, readers (in any process) see the entries of the last `flush`
+    and can `reload` the index.
+
+    Args:
+        root (str): directory of the store.
+        meta (dict): properties of the features, must match the meta of an existing store.
+        shard_size (int): size of a shard in bytes.
+    """
+
+    index_name = 'index.json'
+
+    def __init__(self, root, meta=None, shard_size=4 << 30):
+        self.root = root
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # shard -> np.memmap of the whole shard
+        self._shards = {}
+        # (path, size, mtime) -> content digest, avoid re-hashing unchanged files in one process
+        self._file_digests = {}
+        self.reload()
+
+        if meta is not None:
+            if len(self.entries) > 0 and self.meta != meta:
+                raise ValueError(f'The features in {root} were extracted with {self.meta}, not {meta}.')
+            self.meta = meta
+
+    def reload(self):
+        index_path = os.path.join(self.root, self.index_name)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            self.meta, self.entries = index['meta'], index['entries']
+        else:
+            self.meta, self.entries = {}, {}
+        self._shards = {}
+
+    def flush(self):
+        index_path = os.path.join(self.root, self.index_name)
+        # NOTE: write to a temporary file and rename, so that concurrent readers never see partial indices.
+        tmp_path = f'{index_path}.{uuid.uuid4().hex}.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                json.dump({'meta': self.meta, 'entries': self.entries}, f)
+        os.replace(tmp_path, index_path)
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f'features-{shard:05d}.bin')
+
+    def make_key(self, file_path, **params):
+        stat = os.stat(file_path)
+        file_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self._file_digests:
+            self._file_digests[file_key] = file_digest(file_path)
+        return make_key(self._file_digests[file_key], params)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def put(self, key, features):
+        """Append the features of `key`, they are visible to `get` at once and to other processes after `flush`."""
+        array = features.detach().to('cpu', dtype=torch.float16).contiguous().numpy()
+        with self._lock:
+            shard = max([entry[0] for entry in self.entries.values()], default=0)
+            offset = os.path.getsize(self.shard_path(shard)) if os.path.exists(self.shard_path(shard)) else 0
+            if offset > 0 and offset + array.nbytes > self.shard_size:
+                shard, offset = shard + 1, 0
+            with open(self.shard_path(shard), 'ab') as f:
+                f.write(array.tobytes())
+            self.entries[key] = [shard, offset // array.itemsize, list(array.shape)]
+            # NOTE: the shard has grown, map it again on the next read.
+            self._shards.pop(shard, None)
+
+    def get(self, key):
+        """Return the features of `key` (memory mapped, copy-on-write), or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        shard, offset, shape = entry
+        with self._lock:
+            if shard not in self._shards:
+                self._shards[shard] = np.memmap(self.shard_path(shard), dtype=np.float16, mode='c')
+            memmap = self._shards[shard]
+        return torch.from_numpy(memmap[offset:offset + int(np.prod(shape))].reshape(shape))
+
+    def get_video(self, file_path, **params):
+        return self.get(self.make_key(file_path, **params))
+
+
+class VideoDataset(torch.utils.data.Dataset):
+    """Decode and preprocess the videos which are not in the store yet (in the `DataLoader` workers)."""
+
+    def __init__(self, video_paths, processor, existing_keys, params):
+        self.video_paths = video_paths
+        self.processor = processor
+        self.existing_keys = existing_keys
+        self.params = params
+
+    def __len__(self):
+        return len(self.video_paths)
+
+    def __getitem__(self, idx):
+        video_path = self.video_paths[idx]
+        key = make_key(file_digest(video_path), self.params)
+        if key in self.existing_keys:
+            return key, None
+        try:
+            video = process_video(video_path, self.processor, **self.params)
+        except Exception as e:
+            print(f'Failed to process {video_path}: {e}')
+            return key, None
+        return key, video
+
+
+def collate_fn(batch):
+    return [x[0] for x in batch], [x[1] for x in batch]
+
+
+def list_videos(video_folder, video_list=None, extensions=('.mp4', '.avi', '.mov', '.mkv', '.webm')):
+    if video_list is not None:
+        with open(video_list, 'r') as f:
+            return [os.path.join(video_folder, line.strip()) for line in f if line.strip()]
+    video_paths = []
+    for root, _, files in os.walk(video_folder):
+        video_paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(extensions))
+    return sorted(video_paths)
+
+
+def extract_features(args):
+    config = AutoConfig.from_pretrained(args.model_path)
+    vision_tower, projector = load_vision_modules(args.model_path)
+    if args.cpu_int8:
+        device, dtype = torch.device('cpu'), torch.float32
+        vision_tower, projector = quantize_vision_tower(vision_tower), quantize_connector(projector)
+    else:
+        device, dtype = torch.device(args.device), torch.float16 if args.device.startswith('cuda') else torch.float32
+        vision_tower, projector = vision_tower.to(device=device, dtype=dtype), projector.to(device=device, dtype=dtype)
+
+    # NOTE: the same sampling as `model_init`, the parameters are part of the keys.
+    params = {'aspect_ratio': None, 'num_frames': getattr(config, 'num_frames', NUM_FRAMES)}
+    meta = {
+        'model': args.model_path,
+        'mm_projector_type': config.mm_projector_type,
+        'hidden_size': config.hidden_size,
+        'cpu_int8': args.cpu_int8,
+        'params': params,
+    }
+    store = FeatureStore(args.store_dir, meta=meta, shard_size=args.shard_size << 30)
+
+    video_paths = list_videos(args.video_folder, args.video_list)
+    dataset = VideoDataset(video_paths, vision_tower.image_processor, set(store.keys()), params)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_fn)
+    # NOTE: decode & transfer the next batches while encoding the current one.
+    dataloader = PrefetchPipeline(dataloader, device=device, dtype=dtype)
+
+    num_extracted = 0
+    with torch.inference_mode():
+        for i, (keys, videos) in enumerate(dataloader):
+            keys = [key for key, video in zip(keys, videos) if video is not None]
+            videos = [video for video in videos if video is not None]
+            if len(videos) > 0:
+                features = encode_videos(vision_tower, projector, videos, config.mm_projector_type)
+                for key, feature in zip(keys, features):
+                    store.put(key, feature)
+                num_extracted += len(videos)
+            if (i + 1) % args.flush_interval == 0:
+                store.flush()
+                print(f'[{(i + 1) * args.batch_size}/{len(video_paths)}] {num_extracted} videos extracted, {dataloader.summary()}')
+    store.flush()
+    print(f'{num_extracted} videos extracted, {len(store)} videos in {args.store_dir}. Pipeline timings: {dataloader.summary()}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract the projected visual features of a video corpus into a feature store.')
+
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--video-folder", type=str, required=True)
+    parser.add_argument("--video-list", type=str, default=None, help="File with one video path (relative to --video-folder) per line, all videos in the folder by default.")
+    parser.add_argument("--store-dir", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--cpu-int8", action="store_true", help="Encode on cpu with the int8 vision tower and connector.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shard-size", type=int, default=4, help="Size of a shard in GB.")
+    parser.add_argument("--flush-interval", type=int, default=16, help="Write the index every n batches.")
+    args = parser.parse_args()
+
+    extract_features(args)
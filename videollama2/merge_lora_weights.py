@@ -0,0 +1,54 @@
+"""
+Merge a LoRA/QLoRA checkpoint into its base model once and export a self-contained checkpoint.
+
+The exported folder holds the merged language model, the mm_projector and the vision tower
+weights in safetensors, so that `load_pretrained_model` loads it like a full checkpoint (on the
+fast path) instead of loading the base model, the non-LoRA trainables and merging the LoRA
+weights at every start.
+
+Usage:
+    python -m videollama2.merge_lora_weights --model-path work_dirs/videollama2_lora --save-path work_dirs/videollama2_lora_merged
+"""
+import os
+import argparse
+import warnings
+
+import torch
+
+from videollama2.model.builder import load_pretrained_model
+from videollama2.mm_utils import get_model_name_from_path
+
+
+def merge_lora(args):
+    model_name = get_model_name_from_path(args.model_path)
+    assert 'lora' in model_name.lower(), f'{args.model_path} is not a LoRA checkpoint (its name does not contain "lora").'
+    save_name = get_model_name_from_path(args.save_path)
+    if not ('videollama' in save_name.lower() or 'vlb' in save_name.lower()):
+        warnings.warn(f'The name of {args.save_path} should contain "videollama", otherwise it is not loaded as a VideoLLaMA 2 model.')
+
+    tokenizer, model, processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, device=args.device)
+
+    # NOTE: the vision tower is saved with the model, it is built from its config instead of being reloaded.
+    vision_tower = model.get_vision_tower()
+    assert vision_tower.is_loaded
+    model.config.merged_lora = True
+    model.config.mm_vision_tower_in_checkpoint = True
+    model.to(torch.float16)
+
+    os.makedirs(args.save_path, exist_ok=True)
+    model.save_pretrained(args.save_path, safe_serialization=True, max_shard_size=args.max_shard_size)
+    tokenizer.save_pretrained(args.save_path)
+    print(f'Merged checkpoint is saved to {args.save_path}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge LoRA weights into a self-contained checkpoint.')
+
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--save-path", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--max-shard-size", type=str, default="100GB", help="The default keeps all weights in one safetensors file.")
+    args = parser.parse_args()
+
+    merge_lora(args)
@@ -0,0 +1,270 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+import numpy as np
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Compute the sha1 digest of the content of a file.
+
+    Args:
+        file_path (str): path of the file.
+        chunk_size (int): number of bytes read at a time.
+    Returns:
+        str: hex digest of the file content.
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def tensor_digest(tensor):
+    """Compute the digest of the content (dtype, shape and values) of a tensor."""
+    tensor = tensor.detach().to('cpu').contiguous()
+    blake2b = hashlib.blake2b(digest_size=16)
+    blake2b.update(f'{tensor.dtype}{tuple(tensor.shape)}'.encode('utf-8'))
+    blake2b.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return blake2b.hexdigest()
+
+
+def set_media_key(tensor, media_key):
+    """Attach the key of the media (e.g., its `PreprocessCache` key or media store digest) to its pixel tensor.
+
+    The key is an attribute of the tensor object, copy it with `copy_media_key` when the tensor is
+    moved or cast (which creates a new tensor).
+    """
+    if media_key is not None:
+        tensor.media_key = media_key
+    return tensor
+
+
+def copy_media_key(tensor, source):
+    return set_media_key(tensor, getattr(source, 'media_key', None))
+
+
+def media_digest(tensor):
+    """The media key attached to `tensor`, otherwise the digest of its content (which copies it to the cpu)."""
+    media_key = getattr(tensor, 'media_key', None)
+    return media_key if media_key is not None else tensor_digest(tensor)
+
+
+def nbytes(value):
+    """Count the bytes of the tensors in a (nested) tuple/list/dict."""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    elif isinstance(value, (tuple, list)):
+        return sum(nbytes(x) for x in value)
+    elif isinstance(value, dict):
+        return sum(nbytes(x) for x in value.values())
+    return 0
+
+
+def processor_digest(processor):
+    """Compute the digest of an image processor config (size, crop, mean, std, ...)."""
+    if hasattr(processor, 'to_json_string'):
+        config = processor.to_json_string()
+    else:
+        config = json.dumps(vars(processor), sort_keys=True, default=str)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()
+
+
+class PreprocessCache(object):
+    """Persistent on-disk cache of preprocessed image/video tensors.
+
+    Every entry is the final `pixel_values` tensor saved as a `.npy` file, float16 for the
+    normalized tensors and uint8 for the raw frames. Hits are memory-mapped (copy-on-write),
+    so loading an entry does not copy the data and many processes can share the page cache.
+    `get` and `put` return the tensor in the stored dtype, so that hits and misses match.
+
+    The sizes of the entries are indexed in memory (in least-recently-used order) when the
+    cache is opened, so that entries are evicted once the running total exceeds `max_size`
+    without scanning the cache directory. Entries written by other processes sharing the
+    directory are indexed when they are read.
+
+    Args:
+        cache_dir (str): directory of the cache files.
+        max_size (int): size budget of the cache in bytes.
+    """
+
+    suffix = '.npy'
+
+    def __init__(self, cache_dir, max_size=64 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # (path, size, mtime) -> content digest, avoid re-hashing unchanged files in one process
+        self._file_digests = {}
+        # path -> size of the entries, from the least to the most recently used
+        self._index = OrderedDict((path, size) for _, size, path in sorted(self.entries()))
+        self._total_size = sum(self._index.values())
+
+    def _file_digest(self, file_path):
+        stat = os.stat(file_path)
+        file_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self._file_digests:
+            self._file_digests[file_key] = file_digest(file_path)
+        return self._file_digests[file_key]
+
+    def make_key(self, file_path, processor, **params):
+        """Build the cache key of a media file and its preprocessing parameters.
+
+        Args:
+            file_path (str): path of the image or video.
+            processor: image processor used for `preprocess`.
+            **params: sampling/preprocessing parameters (num_frames, sample_scheme, aspect_ratio, image_grid, ...).
+        Returns:
+            str: hex digest used as the cache key.
+        """
+        meta = {
+            'file': self._file_digest(file_path),
+            'processor': processor_digest(processor),
+            'params': {k: params[k] for k in sorted(params)},
+        }
+        return hashlib.sha1(json.dumps(meta, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            array = np.load(entry_path, mmap_mode='c')
+            os.utime(entry_path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        with self._lock:
+            if entry_path in self._index:
+                self._index.move_to_end(entry_path)
+            else:
+                self._add(entry_path, os.path.getsize(entry_path))
+        return torch.from_numpy(array)
+
+    def put(self, key, tensor):
+        """Save `tensor` (float16 unless uint8) and return it in the stored dtype."""
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        dtype = torch.uint8 if tensor.dtype == torch.uint8 else torch.float16
+        array = tensor.detach().to('cpu', dtype=dtype).numpy()
+        # NOTE: write to a temporary file and rename, so that concurrent readers never see partial entries.
+        tmp_path = f'{entry_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._add(entry_path, size)
+            self._evict()
+        return torch.from_numpy(array)
+
+    def _add(self, path, size):
+        self._total_size += size - self._index.pop(path, 0)
+        self._index[path] = size
+
+    def _evict(self):
+        while self._total_size > self.max_size and len(self._index) > 1:
+            path, size = self._index.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """List (mtime, size, path) of all cache entries by scanning the cache directory."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        return self._total_size
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self.entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._index.clear()
+            self._total_size = 0
+
+
+class LRUCache(object):
+    """In-memory least-recently-used cache bounded by the bytes of the stored tensors.
+
+    Args:
+        max_size (int): size budget of the cache in bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._data:
+                self.pop(key)
+            if size > self.max_size:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.popitem()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, size = self._data.pop(key)
+            self.size -= size
+            return value
+
+    def popitem(self):
+        """Remove and return the least recently used (key, value) pair."""
+        with self._lock:
+            key, (value, size) = self._data.popitem(last=False)
+            self.size -= size
+            return key, value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
@@ -1,12 +1,16 @@
 import ast
 import math
 import base64
+import weakref
+import threading
 from io import BytesIO
+from collections import OrderedDict
 
 import torch
 import decord
 import imageio
 import numpy as np
+import torch.nn.functional as F
 from PIL import Image
 from decord import VideoReader, cpu
 from moviepy.editor import VideoFileClip
@@ -16,6 +20,7 @@ from scenedetect import open_video, SceneManager
 from scenedetect.detectors import ContentDetector
 from scenedetect.stats_manager import StatsManager
 
+from .mm_cache import set_media_key
 from .constants import NUM_FRAMES, MAX_FRAMES, NUM_FRAMES_PER_SECOND, MMODAL_INDEX_TOKEN, IMAGE_TOKEN_INDEX
 
 
@@ -284,8 +289,11 @@ def process_images(images, image_processor, model_cfg):
     return new_images
 
 
-def process_videos(frames, image_processor, model_cfg):
+def process_videos(frames, image_processor, model_cfg, backend='pil'):
     # this function only used during inference
+    if backend == 'torch' and isinstance(frames, np.ndarray):
+        # NOTE: decoded frames share the same size, they are preprocessed as one batch (do not pad for video frames).
+        return preprocess_frames(frames, image_processor, aspect_ratio=None)
     # image_aspect_ratio = getattr(model_cfg, "image_aspect_ratio", None)
     # new_frames = []
     # print("Current image_aspect_ratio:", image_aspect_ratio)
@@ -353,7 +361,119 @@ def create_photo_grid(arr, rows=None, cols=None):
     return grid
 
 
-def process_image(image_path, processor, aspect_ratio='pad', num_frames=NUM_FRAMES, image_grid=False):
+def normalize_frames(frames, processor):
+    """Rescale and normalize uint8 frames following the config of `processor` (CLIPImageProcessor).
+
+    This is the consumer-side half of preprocessing with `normalize=False`: the frames are shipped
+    as uint8 (4x smaller than float32) and normalized on the device where they are consumed. The
+    256 possible levels of every channel are computed with the same arithmetic as `processor` and
+    looked up, so the outputs are identical to `processor.preprocess`.
+
+    Args:
+        frames (torch.Tensor): uint8 frames with shape (..., C, H, W).
+        processor (CLIPImageProcessor): image processor whose config is replicated.
+    Returns:
+        torch.Tensor: float32 pixel values with the same shape as `frames`.
+    """
+    c = frames.shape[-3]
+    levels = torch.arange(256, dtype=torch.float64)
+    if processor.do_rescale:
+        levels = levels * processor.rescale_factor
+    levels = levels.float().expand(c, 256)
+    if processor.do_normalize:
+        mean = torch.tensor(processor.image_mean, dtype=torch.float32).view(c, 1)
+        std = torch.tensor(processor.image_std, dtype=torch.float32).view(c, 1)
+        levels = (levels - mean) / std
+    levels = levels.to(frames.device)
+
+    channels = torch.arange(c, device=frames.device).view(c, 1, 1)
+    return levels[channels, frames.long()]
+
+
+def preprocess_frames(frames, processor, aspect_ratio='pad', normalize=True):
+    """Vectorized counterpart of `expand2square` + `processor.preprocess` for frames of the same size.
+
+    The frames are padded, resized, center-cropped, rescaled and normalized as one batch following
+    the config of `processor` (CLIPImageProcessor), instead of one PIL round-trip per frame. The
+    resized frames are rounded to uint8 levels like PIL, so the outputs match `processor.preprocess`
+    up to the interpolation error, which `tests/test_preprocess.py` bounds.
+
+    Args:
+        frames (np.ndarray, torch.Tensor): uint8 frames with shape (T, H, W, C) or (T, H, W).
+        processor (CLIPImageProcessor): image processor whose config is replicated.
+        aspect_ratio (str): 'pad' to pad the frames into squares with the mean color.
+        normalize (bool): whether to rescale and normalize, otherwise uint8 frames are returned.
+    Returns:
+        torch.Tensor: pixel values with shape (T, C, crop_height, crop_width).
+    """
+    if isinstance(frames, np.ndarray):
+        frames = torch.from_numpy(frames)
+    if frames.ndim == 3:
+        frames = frames.unsqueeze(-1).expand(-1, -1, -1, 3)
+    # NOTE: drop the alpha channel as `convert('RGB')` does.
+    frames = frames[..., :3].permute(0, 3, 1, 2)
+    t, c, h, w = frames.shape
+
+    if aspect_ratio == 'pad' and h != w:
+        size = max(h, w)
+        background = torch.tensor([int(x*255) for x in processor.image_mean], dtype=frames.dtype).view(1, c, 1, 1)
+        square_frames = background.expand(t, c, size, size).clone()
+        top, left = (size - h) // 2, (size - w) // 2
+        square_frames[:, :, top:top + h, left:left + w] = frames
+        frames, h, w = square_frames, size, size
+
+    frames = frames.float()
+
+    if processor.do_resize:
+        if 'shortest_edge' in processor.size:
+            short, long = (h, w) if h <= w else (w, h)
+            new_short = processor.size['shortest_edge']
+            new_long = int(new_short * long / short)
+            new_h, new_w = (new_short, new_long) if h <= w else (new_long, new_short)
+        else:
+            new_h, new_w = processor.size['height'], processor.size['width']
+        mode = {0: 'nearest', 2: 'bilinear', 3: 'bicubic'}[int(processor.resample)]
+        if mode == 'nearest':
+            frames = F.interpolate(frames, size=(new_h, new_w), mode=mode)
+        else:
+            frames = F.interpolate(frames, size=(new_h, new_w), mode=mode, align_corners=False, antialias=True)
+        # NOTE: PIL resizes in uint8
+        frames = frames.round().clamp(0, 255)
+        h, w = new_h, new_w
+
+    if processor.do_center_crop:
+        crop_h, crop_w = processor.crop_size['height'], processor.crop_size['width']
+        if h < crop_h or w < crop_w:
+            pad_h, pad_w = max(crop_h - h, 0), max(crop_w - w, 0)
+            frames = F.pad(frames, (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2))
+            h, w = frames.shape[-2:]
+        top, left = (h - crop_h) // 2, (w - crop_w) // 2
+        frames = frames[:, :, top:top + crop_h, left:left + crop_w]
+
+    frames = frames.to(torch.uint8)
+    if normalize:
+        frames = normalize_frames(frames, processor)
+
+    return frames.contiguous()
+
+
+def processor_preprocess(images, processor, normalize=True):
+    """`processor.preprocess` of PIL images, which stops before rescaling (uint8 outputs) if not `normalize`."""
+    if normalize:
+        return processor.preprocess(images, return_tensors='pt')['pixel_values']
+    # NOTE: the consumer applies `normalize_frames`, which gives the same values as a full `preprocess`.
+    pixel_values = processor.preprocess(images, do_rescale=False, do_normalize=False, return_tensors='pt')['pixel_values']
+    return torch.as_tensor(pixel_values).round().to(torch.uint8)
+
+
+def process_image(image_path, processor, aspect_ratio='pad', num_frames=NUM_FRAMES, image_grid=False, cache=None, normalize=True):
+    if cache is not None:
+        cache_key = cache.make_key(image_path, processor, modal='image', aspect_ratio=aspect_ratio, num_frames=num_frames,
+                                   image_grid=image_grid, normalize=normalize)
+        images = cache.get(cache_key)
+        if images is not None:
+            return set_media_key(images if normalize else images.to(torch.uint8), cache_key)
+
     image = Image.open(image_path).convert('RGB')
 
     if image_grid:
@@ -370,11 +490,129 @@ def process_image(image_path, processor, aspect_ratio='pad', num_frames=NUM_FRAM
     else:
         images = [Image.fromarray(f) for f in images]
 
-    images = processor.preprocess(images, return_tensors='pt')['pixel_values']
+    images = processor_preprocess(images, processor, normalize)
+
+    if cache is not None:
+        images = set_media_key(cache.put(cache_key, images), cache_key)
+
     return images
 
 
-def process_video(video_path, processor, aspect_ratio='pad', num_frames=NUM_FRAMES, image_grid=False, sample_scheme='uniform'):
+class SparseVideoReader(object):
+    """Base class of the sparse video readers used by `process_video`.
+
+    Subclasses expose the number of frames (`__len__`), the frame rate (`fps`) and
+    `get_frame(index)`. `get_batch` visits the requested indices in ascending order so
+    that every container is decoded with (keyframe-aware) seeks plus short forward
+    decoding, and only the sampled frames are ever held in memory.
+    """
+
+    fps = None
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get_frame(self, index):
+        raise NotImplementedError
+
+    def get_batch(self, frame_ids):
+        """Decode frames at `frame_ids` and return them as a (T, H, W, C) uint8 array."""
+        frame_ids = [int(x) for x in frame_ids]
+        decoded = {index: self.get_frame(index) for index in sorted(set(frame_ids))}
+        return np.stack([decoded[index] for index in frame_ids])
+
+    def close(self):
+        pass
+
+
+class DecordVideoReader(SparseVideoReader):
+
+    def __init__(self, video_path):
+        # NOTE: num_threads=1 is required to avoid deadlock in multiprocessing
+        self.reader = VideoReader(uri=video_path, ctx=cpu(0), num_threads=1)
+        self.fps = float(self.reader.get_avg_fps())
+
+    def __len__(self):
+        return len(self.reader)
+
+    def get_frame(self, index):
+        return self.reader[index].asnumpy()
+
+    def get_batch(self, frame_ids):
+        # decord already seeks to the nearest keyframe and decodes forward inside `get_batch`.
+        try:
+            return self.reader.get_batch(frame_ids).numpy()
+        except:
+            return self.reader.get_batch(frame_ids).asnumpy()
+
+
+class GifVideoReader(SparseVideoReader):
+
+    def __init__(self, video_path, fps=10):
+        self.reader = imageio.get_reader(video_path)
+        self.fps = fps
+
+    def __len__(self):
+        return len(self.reader)
+
+    def get_frame(self, index):
+        return np.asarray(self.reader.get_data(index))
+
+    def close(self):
+        self.reader.close()
+
+
+class MoviepyVideoReader(SparseVideoReader):
+    """Reader for containers that decord can not handle well (e.g., the .webm files of sthsthv2).
+
+    `VideoFileClip.get_frame` reuses the ffmpeg pipe for short forward jumps and restarts
+    ffmpeg with an input seek (`-ss`, keyframe based) for long jumps or backward jumps.
+    """
+
+    def __init__(self, video_path):
+        self.reader = VideoFileClip(video_path, audio=False)
+        self.fps = self.reader.fps
+        # NOTE: the same timestamps as `VideoFileClip.iter_frames()`
+        self.timestamps = np.arange(0, self.reader.duration, 1.0 / self.fps)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def get_frame(self, index):
+        return self.reader.get_frame(self.timestamps[index])
+
+    def close(self):
+        self.reader.close()
+
+
+def open_video_reader(video_path):
+    """Open a sparse frame reader according to the video container.
+
+    Args:
+        video_path (str): path of the video file.
+    Returns:
+        SparseVideoReader: reader which decodes only the requested frames.
+    """
+    if video_path.endswith('.gif'):
+        return GifVideoReader(video_path)
+    # added by lixin4ever, include the support of .webm files from sthsthv2
+    elif video_path.endswith('.webm'):
+        return MoviepyVideoReader(video_path)
+    else:
+        return DecordVideoReader(video_path)
+
+
+def process_video(video_path, processor, aspect_ratio='pad', num_frames=NUM_FRAMES, image_grid=False, sample_scheme='uniform', cache=None, backend='pil', normalize=True):
+    # NOTE: only videos given by path are cached, decoded frames (np.ndarray/list) are processed directly.
+    use_cache = cache is not None and isinstance(video_path, str)
+    if use_cache:
+        cache_key = cache.make_key(video_path, processor, modal='video', aspect_ratio=aspect_ratio, num_frames=num_frames,
+                                   image_grid=image_grid, sample_scheme=sample_scheme, max_frames=MAX_FRAMES, backend=backend,
+                                   normalize=normalize)
+        video = cache.get(cache_key)
+        if video is not None:
+            return set_media_key(video if normalize else video.to(torch.uint8), cache_key)
+
     def frame_sample(duration, mode='uniform', local_fps=None):
         if mode == 'uniform':
             # Calculate the size of each segment from which a frame will be extracted
@@ -399,47 +637,23 @@ def process_video(video_path, processor, aspect_ratio='pad', num_frames=NUM_FRAM
             raise ImportError(f'Unsupported frame sampling mode: {mode}')
 
     if isinstance(video_path, str):
-        if video_path.endswith('.gif'):
-            video_gif = imageio.get_reader(video_path)
-            duration, local_fps = len(video_gif), 10
-
-            frame_id_list = frame_sample(duration, mode=sample_scheme, local_fps=local_fps)
-            # limit the max input frames
-            if len(frame_id_list) > MAX_FRAMES:
-                frame_id_list = np.linspace(0, duration-1, MAX_FRAMES, dtype=int)
-            video_data = [frame for index, frame in enumerate(video_gif) if index in frame_id_list]
-        # added by lixin4ever, include the support of .webm files from sthsthv2
-        elif video_path.endswith('.webm'):
-            video_webm = VideoFileClip(video_path)
-            video_frames = np.array(list(video_webm.iter_frames()))
-
-            duration, local_fps = len(video_frames), video_webm.fps
-
-            frame_id_list = frame_sample(duration, mode=sample_scheme, local_fps=local_fps)
-            # limit the max input frames
-            if len(frame_id_list) > MAX_FRAMES:
-                frame_id_list = np.linspace(0, duration-1, MAX_FRAMES, dtype=int)
-            video_data = video_frames[frame_id_list]
-        else:
-            # NOTE: num_threads=1 is required to avoid deadlock in multiprocessing
-            decord_vr = VideoReader(uri=video_path, ctx=cpu(0), num_threads=1) 
-            duration, local_fps = len(decord_vr), float(decord_vr.get_avg_fps())
-        
-            frame_id_list = frame_sample(duration, mode=sample_scheme, local_fps=local_fps)
-            # limit the max input frames
-            if len(frame_id_list) > MAX_FRAMES:
-                frame_id_list = np.linspace(0, duration-1, MAX_FRAMES, dtype=int)
-            try:
-                video_data = decord_vr.get_batch(frame_id_list).numpy()
-            except:
-                video_data = decord_vr.get_batch(frame_id_list).asnumpy()
-
-            # if self.data_args.use_temp_aug:
-            #     frame_id_list = np.linspace(0, duration-1, num_frames * 2 * 2, dtype=int)
-            #     video_data = decord_vr.get_batch(frame_id_list)
-            #     video_frames = [Image.fromarray(f) for f in video_data.numpy()]
-            #     chunked_video_frames = chunk_list(video_frames, 2*2)
-            #     video_data = [frame_expansion(frame_list, 2) for frame_list in chunked_video_frames]
+        # NOTE: only the sampled frames are decoded, the full clip is never materialized.
+        video_reader = open_video_reader(video_path)
+        duration, local_fps = len(video_reader), video_reader.fps
+
+        frame_id_list = frame_sample(duration, mode=sample_scheme, local_fps=local_fps)
+        # limit the max input frames
+        if len(frame_id_list) > MAX_FRAMES:
+            frame_id_list = np.linspace(0, duration-1, MAX_FRAMES, dtype=int)
+        video_data = video_reader.get_batch(frame_id_list)
+        video_reader.close()
+
+        # if self.data_args.use_temp_aug:
+        #     frame_id_list = np.linspace(0, duration-1, num_frames * 2 * 2, dtype=int)
+        #     video_data = decord_vr.get_batch(frame_id_list)
+        #     video_frames = [Image.fromarray(f) for f in video_data.numpy()]
+        #     chunked_video_frames = chunk_list(video_frames, 2*2)
+        #     video_data = [frame_expansion(frame_list, 2) for frame_list in chunked_video_frames]
     elif isinstance(video_path, np.ndarray):
         assert len(video_path) == num_frames
         video_data = video_path
@@ -450,15 +664,28 @@ def process_video(video_path, processor, aspect_ratio='pad', num_frames=NUM_FRAM
     if image_grid:
         grid_h = grid_w = math.ceil(math.sqrt(num_frames))
         pg = create_photo_grid(video_data, grid_h, grid_w)
-        video_data = [pg, *video_data]
 
-    if aspect_ratio == 'pad':
-        images = [Image.fromarray(f.numpy() if isinstance(f, torch.Tensor) else f) for f in video_data]
-        images = [expand2square(image, tuple(int(x*255) for x in processor.image_mean)) for image in images]
-        video = processor.preprocess(images, return_tensors='pt')['pixel_values']
+    if backend == 'torch':
+        # NOTE: all frames of a video share the same size, so they are preprocessed as one batch.
+        video = preprocess_frames(video_data, processor, aspect_ratio, normalize)
+        if image_grid:
+            video = torch.cat([preprocess_frames(pg[None], processor, aspect_ratio, normalize), video], dim=0)
+    elif backend == 'pil':
+        if image_grid:
+            video_data = [pg, *video_data]
+
+        if aspect_ratio == 'pad':
+            images = [Image.fromarray(f.numpy() if isinstance(f, torch.Tensor) else f) for f in video_data]
+            images = [expand2square(image, tuple(int(x*255) for x in processor.image_mean)) for image in images]
+            video = processor_preprocess(images, processor, normalize)
+        else:
+            images = [Image.fromarray(f.numpy() if isinstance(f, torch.Tensor) else f) for f in video_data]
+            video = processor_preprocess(images, processor, normalize)
     else:
-        images = [Image.fromarray(f.numpy() if isinstance(f, torch.Tensor) else f) for f in video_data]
-        video = processor.preprocess(images, return_tensors='pt')['pixel_values']
+        raise ValueError(f'Unsupported preprocessing backend: {backend}')
+
+    if use_cache:
+        video = set_media_key(cache.put(cache_key, video), cache_key)
 
     return video
 
@@ -485,10 +712,60 @@ def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX
     return input_ids
 
 
-def tokenizer_MMODAL_token(prompt, tokenizer, MMODAL_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
-    prompt_chunks = [tokenizer(chunk).input_ids for chunk in prompt.split(f'<{MMODAL_INDEX_TOKEN[MMODAL_token_index].lower()}>')]
-    num_prompt_chunks = len(prompt.split(f'<{MMODAL_INDEX_TOKEN[MMODAL_token_index].lower()}>'))
+# NOTE: tokenized template chunks (system prompt & role header before the first modal token, separators) per tokenizer
+_TOKENIZED_CHUNKS = weakref.WeakKeyDictionary()
+_TOKENIZED_CHUNKS_LOCK = threading.Lock()
+_MAX_TOKENIZED_CHUNKS = 1024
+
+
+def tokenize_cached(tokenizer, text):
+    """Tokenize a recurring text (e.g., the system prompt of a conversation template) with memoization.
 
+    The ids are cached per tokenizer (and its vocabulary size, which changes with `add_tokens`) in a
+    bounded LRU, so do not modify the returned tuple. It is safe to call from several threads.
+    """
+    key = (text, len(tokenizer))
+    with _TOKENIZED_CHUNKS_LOCK:
+        cache = _TOKENIZED_CHUNKS.setdefault(tokenizer, OrderedDict())
+        input_ids = cache.get(key)
+        if input_ids is not None:
+            cache.move_to_end(key)
+            return input_ids
+    # NOTE: tokenize outside of the lock, a concurrent miss of the same text only tokenizes it twice.
+    input_ids = tuple(tokenizer(text).input_ids)
+    with _TOKENIZED_CHUNKS_LOCK:
+        cache[key] = input_ids
+        while len(cache) > _MAX_TOKENIZED_CHUNKS:
+            cache.popitem(last=False)
+    return input_ids
+
+
+def precompute_template_tokens(tokenizer, templates=None):
+    """Tokenize the system prompt & first role header and the separators of every conversation template ahead of the requests.
+
+    Args:
+        tokenizer: tokenizer.
+        templates (dict): name -> `Conversation`, all `conv_templates` by default.
+    """
+    from .conversation import conv_templates, SeparatorStyle
+    templates = conv_templates if templates is None else templates
+    for conv in templates.values():
+        for MMODAL_token_index in MMODAL_INDEX_TOKEN:
+            modal_token = f'<{MMODAL_INDEX_TOKEN[MMODAL_token_index].lower()}>'
+            cur_conv = conv.copy()
+            cur_conv.append_message(cur_conv.roles[0], modal_token + '\n')
+            cur_conv.append_message(cur_conv.roles[1], None)
+            try:
+                prompt = cur_conv.get_prompt()
+            except Exception:
+                continue
+            tokenize_cached(tokenizer, prompt.split(modal_token)[0])
+        for sep in [conv.sep, conv.sep2]:
+            if sep:
+                tokenize_cached(tokenizer, sep)
+
+
+def _merge_MMODAL_chunks(prompt_chunks, tokenizer, MMODAL_token_index, return_tensors=None):
     def insert_separator(X, sep):
         return [ele for sublist in zip(X, [sep]*len(X)) for ele in sublist][:-1]
 
@@ -508,6 +785,85 @@ def tokenizer_MMODAL_token(prompt, tokenizer, MMODAL_token_index=IMAGE_TOKEN_IND
     return input_ids
 
 
+def tokenizer_MMODAL_token(prompt, tokenizer, MMODAL_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
+    chunks = prompt.split(f'<{MMODAL_INDEX_TOKEN[MMODAL_token_index].lower()}>')
+    if len(chunks) > 1:
+        # NOTE: the chunk before the first modal token is the system prompt & role header of the template, shared by all requests.
+        prompt_chunks = [tokenize_cached(tokenizer, chunks[0])] + [tokenizer(chunk).input_ids for chunk in chunks[1:]]
+    else:
+        prompt_chunks = [tokenizer(chunks[0]).input_ids]
+
+    return _merge_MMODAL_chunks(prompt_chunks, tokenizer, MMODAL_token_index, return_tensors)
+
+
+def tokenizer_MMODAL_token_batch(prompts, tokenizer, MMODAL_token_index=IMAGE_TOKEN_INDEX, return_tensors=None):
+    """Batched `tokenizer_MMODAL_token`, the chunks of all prompts are tokenized in one tokenizer call.
+
+    Args:
+        prompts (List[str]): prompts with modal tokens.
+        tokenizer: tokenizer.
+        MMODAL_token_index (int): index of the modal token.
+        return_tensors (str): 'pt' to return tensors, otherwise lists of ids.
+    Returns:
+        list: ids of every prompt (not padded).
+    """
+    modal_token = f'<{MMODAL_INDEX_TOKEN[MMODAL_token_index].lower()}>'
+    split_prompts = [prompt.split(modal_token) for prompt in prompts]
+    texts = [chunk for chunks in split_prompts for chunk in (chunks[1:] if len(chunks) > 1 else chunks)]
+    chunk_ids = iter(tokenizer(texts).input_ids if len(texts) > 0 else [])
+
+    outputs = []
+    for chunks in split_prompts:
+        if len(chunks) > 1:
+            prompt_chunks = [tokenize_cached(tokenizer, chunks[0])] + [next(chunk_ids) for _ in chunks[1:]]
+        else:
+            prompt_chunks = [next(chunk_ids)]
+        outputs.append(_merge_MMODAL_chunks(prompt_chunks, tokenizer, MMODAL_token_index, return_tensors))
+    return outputs
+
+
+def check_tokenizer_consistency(tokenizer, other_tokenizer, texts=None):
+    """Check that two tokenizers (e.g., the slow and the fast one of a model) produce identical ids.
+
+    Args:
+        tokenizer: reference tokenizer.
+        other_tokenizer: tokenizer to validate.
+        texts (List[str]): probe texts, by default the prompts of all conversation templates and some edge cases.
+    Returns:
+        bool: whether all ids and special tokens match.
+    """
+    from .conversation import conv_templates
+    if texts is None:
+        texts = [
+            '', ' ', '\n', '\n\n', 'Hello world!', '  leading and trailing spaces  ', 'What is happening in the video?',
+            '(A) 12 apples\n(B) 3.5 kg\n(C) 1,000 dollars', 'A: yes; B: no.', '视频里发生了什么？', 'café naïve 😀',
+            tokenizer.eos_token or '', tokenizer.bos_token or '',
+        ]
+        for conv in conv_templates.values():
+            cur_conv = conv.copy()
+            cur_conv.append_message(cur_conv.roles[0], 'What is happening in the video?')
+            cur_conv.append_message(cur_conv.roles[1], 'A man is ironing clothes on the back of a taxi.')
+            cur_conv.append_message(cur_conv.roles[0], 'Answer with the option\'s letter.\n(A) yes\n(B) no')
+            cur_conv.append_message(cur_conv.roles[1], None)
+            try:
+                prompt = cur_conv.get_prompt()
+            except Exception:
+                continue
+            texts.append(prompt)
+
+    for attr in ['bos_token_id', 'eos_token_id', 'unk_token_id', 'pad_token_id']:
+        if getattr(tokenizer, attr) != getattr(other_tokenizer, attr):
+            return False
+    if len(tokenizer) != len(other_tokenizer):
+        return False
+    for text in texts:
+        if tokenizer(text).input_ids != other_tokenizer(text).input_ids:
+            return False
+        if tokenizer(text, add_special_tokens=False).input_ids != other_tokenizer(text, add_special_tokens=False).input_ids:
+            return False
+    return True
+
+
 def get_model_name_from_path(model_path):
     model_path = model_path.strip("/")
     model_paths = model_path.split("/")
@@ -518,34 +874,91 @@ def get_model_name_from_path(model_path):
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """Stop every sequence of the batch once it ends with one of `keywords`.
+
+    Keywords are matched by their token ids for the whole batch at once. Every sequence keeps a
+    finished flag, so finished rows are never checked again. Only keywords which are not a single
+    special token (whose text may be generated with other token boundaries) fall back to decoding
+    the tail of the unfinished rows.
+
+    The flags are returned per sequence, so `generate` stops decoding a finished row (its next
+    tokens are padding) and returns as soon as all rows are finished.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
         self.keyword_ids = []
         self.max_keyword_len = 0
+        # NOTE: keywords that may appear in the text without their exact ids, e.g., '###' split as '#' + '##'
+        self.text_keywords = []
+        special_tokens = set(tokenizer.all_special_tokens) | set(tokenizer.get_added_vocab().keys())
         for keyword in keywords:
-            cur_keyword_ids = tokenizer(keyword).input_ids
+            cur_keyword_ids = tokenize_cached(tokenizer, keyword)
             if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
                 cur_keyword_ids = cur_keyword_ids[1:]
             if len(cur_keyword_ids) > self.max_keyword_len:
                 self.max_keyword_len = len(cur_keyword_ids)
             self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+            if not (len(cur_keyword_ids) == 1 and keyword in special_tokens):
+                self.text_keywords.append(keyword)
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
-    
-    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
-        for keyword_id in self.keyword_ids:
-            if (output_ids[0, -keyword_id.shape[0]:] == keyword_id).all():
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
-    
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+
+        self.finished = None
+        self._device_keyword_ids = None
+
+    def update(self, output_ids: torch.LongTensor) -> torch.BoolTensor:
+        """Update and return the per-sequence finished flags with shape (b,)."""
+        batch_size, length = output_ids.shape
+        # NOTE: a new generation (another batch or shorter outputs) resets the flags
+        if self.finished is None or self.finished.shape[0] != batch_size or self.finished.device != output_ids.device or length < self._length:
+            self.finished = torch.zeros(batch_size, dtype=torch.bool, device=output_ids.device)
+        self._length = length
+        if self._device_keyword_ids is None or self._device_keyword_ids[0].device != output_ids.device:
+            self._device_keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+
+        finished = self.finished
+        for keyword_id in self._device_keyword_ids:
+            if keyword_id.shape[0] <= length:
+                finished = finished | (output_ids[:, -keyword_id.shape[0]:] == keyword_id).all(dim=1)
+
+        if len(self.text_keywords) > 0 and not finished.all():
+            # NOTE: when generating from `inputs_embeds`, the outputs do not include the prompt
+            offset = min(length if length <= self.start_len else length - self.start_len, self.max_keyword_len)
+            rows = torch.nonzero(~finished).squeeze(1)
+            if offset > 0:
+                outputs = self.tokenizer.batch_decode(output_ids[rows, -offset:], skip_special_tokens=True)
+                matched = [any(keyword in output for keyword in self.text_keywords) for output in outputs]
+                if any(matched):
+                    finished = finished.clone()
+                    finished[rows[torch.tensor(matched, device=rows.device)]] = True
+
+        self.finished = finished
+        return finished
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return self.update(output_ids)
+
+    def truncate(self, output_ids: torch.LongTensor):
+        """Decode every sample of a batch and cut it where generation would have stopped for this sample alone.
+
+        The early finished samples of a batch are padded until all samples hit a keyword, so their
+        tail is dropped here: at the first keyword ids, the first eos token or the first keyword text.
+        """
+        keyword_ids = [keyword_id.tolist() for keyword_id in self.keyword_ids]
         outputs = []
-        for i in range(output_ids.shape[0]):
-            outputs.append(self.call_for_batch(output_ids[i].unsqueeze(0), scores))
-        return all(outputs)
+        for cur_output_ids in output_ids.tolist():
+            end = len(cur_output_ids)
+            if self.tokenizer.eos_token_id in cur_output_ids:
+                end = cur_output_ids.index(self.tokenizer.eos_token_id) + 1
+            for keyword_id in keyword_ids:
+                for start in range(0, end - len(keyword_id) + 1):
+                    if cur_output_ids[start:start + len(keyword_id)] == keyword_id:
+                        end = start + len(keyword_id)
+                        break
+            output = self.tokenizer.decode(cur_output_ids[:end], skip_special_tokens=True)
+            for keyword in self.keywords:
+                if keyword in output:
+                    output = output[:output.index(keyword) + len(keyword)]
+            outputs.append(output)
+        return outputs
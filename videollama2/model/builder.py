@@ -15,23 +15,296 @@
 
 
 import os
+import json
+import time
+import hashlib
 import warnings
 import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
-from transformers import PretrainedConfig, AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig
+from transformers import PretrainedConfig, AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig, GenerationConfig
+from transformers.utils import SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_NAME, WEIGHTS_INDEX_NAME
 
 from . import *
-from .multimodal_projector import load_mm_projector
+from .multimodal_projector import load_mm_projector, load_weights, find_weights
 from ..constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from ..mm_utils import check_tokenizer_consistency
+from ..mm_cache import file_digest
 
 
-def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, **kwargs):
+# NOTE: the files which define the tokenization, their content is the key of the consistency verdicts.
+TOKENIZER_FILES = ['tokenizer.json', 'tokenizer.model', 'tokenizer_config.json', 'special_tokens_map.json',
+                   'added_tokens.json', 'vocab.json', 'merges.txt']
+_VERDICTS_LOCK = threading.Lock()
+
+
+def get_verdicts_file():
+    from huggingface_hub.constants import HF_HOME
+    return os.path.join(HF_HOME, 'videollama2', 'tokenizer_verdicts.json')
+
+
+def tokenizer_files_digest(model_path, revision=None):
+    """Digest of the local (or cached hub) tokenizer files of `model_path` and the tokenizers version, None if none is available."""
+    import tokenizers
+    import transformers
+    from huggingface_hub import try_to_load_from_cache
+
+    sha1 = hashlib.sha1(f'{transformers.__version__}-{tokenizers.__version__}'.encode('utf-8'))
+    num_files = 0
+    for filename in TOKENIZER_FILES:
+        if os.path.isdir(model_path):
+            path = os.path.join(model_path, filename)
+        else:
+            path = try_to_load_from_cache(model_path, filename, revision=revision)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            continue
+        sha1.update(filename.encode('utf-8'))
+        sha1.update(file_digest(path).encode('utf-8'))
+        num_files += 1
+    return sha1.hexdigest() if num_files > 0 else None
+
+
+def load_verdict(digest):
+    try:
+        with open(get_verdicts_file(), 'r') as f:
+            return json.load(f).get(digest, None)
+    except (OSError, ValueError):
+        return None
+
+
+def save_verdict(digest, consistent):
+    verdicts_file = get_verdicts_file()
+    with _VERDICTS_LOCK:
+        try:
+            with open(verdicts_file, 'r') as f:
+                verdicts = json.load(f)
+        except (OSError, ValueError):
+            verdicts = {}
+        verdicts[digest] = consistent
+        os.makedirs(os.path.dirname(verdicts_file), exist_ok=True)
+        tmp_file = f'{verdicts_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(verdicts, f, indent=2)
+        os.replace(tmp_file, verdicts_file)
+
+
+def validate_fast_tokenizer(model_path, **kwargs):
+    """Check that the fast tokenizer of `model_path` produces the same ids as the slow one, and cache the verdict.
+
+    Returns:
+        bool: whether the fast tokenizer is consistent.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, **kwargs)
+    try:
+        fast_tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, **kwargs)
+        consistent = fast_tokenizer.is_fast and check_tokenizer_consistency(tokenizer, fast_tokenizer)
+    except Exception as e:
+        warnings.warn(f'Failed to load the fast tokenizer of {model_path} ({e}).')
+        consistent = False
+    if not consistent:
+        warnings.warn(f'The fast tokenizer of {model_path} is inconsistent with the slow tokenizer, keep the slow tokenizer.')
+
+    # NOTE: the files of hub models are in the cache now, they were downloaded by `from_pretrained`.
+    digest = tokenizer_files_digest(model_path, revision=kwargs.get('revision', None))
+    if digest is not None:
+        save_verdict(digest, consistent)
+    return consistent
+
+
+def load_tokenizer(model_path, use_fast=True, **kwargs):
+    """Load the tokenizer of `model_path`.
+
+    The fast tokenizer is loaded (alone) only if a cached verdict says that it produces the same
+    ids as the slow one for the current tokenizer files. Otherwise the slow tokenizer is returned,
+    and if no verdict exists yet the fast tokenizer is validated in a background thread, so that
+    the next loads can use it without paying the validation at startup.
+    """
+    if not use_fast:
+        return AutoTokenizer.from_pretrained(model_path, use_fast=False, **kwargs)
+
+    digest = tokenizer_files_digest(model_path, revision=kwargs.get('revision', None))
+    verdict = load_verdict(digest) if digest is not None else None
+    if verdict:
+        return AutoTokenizer.from_pretrained(model_path, use_fast=True, **kwargs)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, **kwargs)
+    if verdict is None:
+        threading.Thread(target=validate_fast_tokenizer, args=(model_path,), kwargs=kwargs, daemon=True).start()
+    return tokenizer
+
+
+class StartupTimer(object):
+    """Accumulate the wall time of the startup stages, each stage ends at its `lap`."""
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def summary(self):
+        timings = ', '.join(f'{stage}: {seconds:.2f}s' for stage, seconds in self.timings.items())
+        return f'{timings}, total: {time.perf_counter() - self.start:.2f}s'
+
+
+def get_checkpoint_shards(model_path, token=None):
+    """Return the local weight shards of `model_path`, safetensors shards are preferred over pytorch ones."""
+    for index_name, weights_name in [(SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME), (WEIGHTS_INDEX_NAME, WEIGHTS_NAME)]:
+        if os.path.isdir(model_path):
+            folder = model_path
+        else:
+            from huggingface_hub import snapshot_download
+            # NOTE: only the shards of one format are downloaded, e.g., `model-00001-of-00003.safetensors`.
+            folder = snapshot_download(model_path, token=token, allow_patterns=[index_name, weights_name, weights_name.replace('.', '-*.', 1)])
+
+        index_file = os.path.join(folder, index_name)
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                shards = sorted(set(json.load(f)['weight_map'].values()))
+            return [os.path.join(folder, shard) for shard in shards]
+        if os.path.exists(os.path.join(folder, weights_name)):
+            return [os.path.join(folder, weights_name)]
+    raise FileNotFoundError(f'No safetensors or pytorch weights found in {model_path}.')
+
+
+def load_checkpoint_shard(model, shard, device, dtype, expected_keys):
+    """Materialize the weights of one shard in `model` on `device`, return the unexpected keys."""
+    from accelerate.utils import set_module_tensor_to_device
+
+    unexpected_keys = []
+
+    def load(name, get_tensor):
+        if name not in expected_keys:
+            unexpected_keys.append(name)
+        else:
+            set_module_tensor_to_device(model, name, device, value=get_tensor(name), dtype=dtype)
+
+    if shard.endswith('.safetensors'):
+        from safetensors import safe_open
+        # NOTE: safetensors are memory mapped, each tensor is read and copied to `device` on its own.
+        with safe_open(shard, framework='pt', device=str(device)) as f:
+            for name in f.keys():
+                load(name, f.get_tensor)
+    else:
+        state_dict = torch.load(shard, map_location='cpu', mmap=True, weights_only=True)
+        for name in list(state_dict.keys()):
+            load(name, state_dict.pop)
+    return unexpected_keys
+
+
+def load_model_fast(model_cls, model_path, device, torch_dtype=torch.float16, token=None, num_workers=8, timer=None, **kwargs):
+    """Build `model_cls` on the meta device and materialize the weights of `model_path` directly on `device`.
+
+    Compared with `from_pretrained`, the weights are never initialized and never copied through
+    cpu tensors of the model: the shards (memory mapped safetensors if available) are read by
+    `num_workers` threads in parallel and their tensors are placed on `device` with `torch_dtype`.
+
+    Args:
+        model_cls: `Videollama2*ForCausalLM` class.
+        model_path (str): local folder or hub repo of a full (non-LoRA) checkpoint.
+        device (str or torch.device): the device of all weights.
+        torch_dtype (torch.dtype): the dtype of the floating weights.
+        token (str): hub token.
+        num_workers (int): number of threads reading the shards.
+        timer (StartupTimer): records the config, construct and weights stages.
+        **kwargs: extra arguments of the model construction, e.g., `attn_implementation`.
+    Returns:
+        the model in eval mode.
+    """
+    from accelerate import init_empty_weights
+
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+
+    config = model_cls.config_class.from_pretrained(model_path, token=token)
+    shards = get_checkpoint_shards(model_path, token=token)
+    if timer is not None:
+        timer.lap('config')
+
+    with init_empty_weights():
+        model = model_cls._from_config(config, torch_dtype=torch_dtype, **kwargs)
+    if timer is not None:
+        timer.lap('construct')
+
+    expected_keys = set(model.state_dict().keys())
+    with ThreadPoolExecutor(max_workers=max(min(num_workers, len(shards)), 1)) as executor:
+        unexpected_keys = sum(executor.map(lambda shard: load_checkpoint_shard(model, shard, device, torch_dtype, expected_keys), shards), [])
+    if len(unexpected_keys) > 0:
+        warnings.warn(f'Unused weights of {model_path}: {unexpected_keys}')
+
+    model.tie_weights()
+    missing_keys = [name for name, param in model.named_parameters() if param.device.type == 'meta']
+    if len(missing_keys) > 0:
+        raise ValueError(f'Missing weights in {model_path}: {missing_keys}')
+    # NOTE: buffers (e.g., rotary embeddings) are created on cpu by `init_empty_weights`.
+    model.to(device)
+    model.eval()
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path, token=token)
+    except OSError:
+        pass
+    if timer is not None:
+        timer.lap('weights')
+
+    return model
+
+
+def get_single_device(device_map, device):
+    """Return the device of all weights for `device_map`, or None if the weights may be dispatched on several devices."""
+    if isinstance(device_map, dict):
+        devices = set(device_map.values())
+        return devices.pop() if len(devices) == 1 else None
+    if device_map in ['auto', 'balanced', 'balanced_low_0', 'sequential']:
+        # NOTE: `from_pretrained` shards the model over all visible gpus.
+        if torch.cuda.device_count() > 1:
+            return None
+        return device
+    return device_map
+
+
+def is_merged_lora_checkpoint(model_path, token=None):
+    """Whether `model_path` is a LoRA checkpoint merged and exported by `videollama2.merge_lora_weights`."""
+    try:
+        config = PretrainedConfig.from_pretrained(model_path, token=token)
+    except (OSError, ValueError):
+        return False
+    return getattr(config, 'merged_lora', False)
+
+
+def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, use_fast=True, fast_load=False, cpu_int8=False, **kwargs):
+    """Load the tokenizer, model, image processor and context length of a checkpoint.
+
+    With `fast_load`, full (non-LoRA) VideoLLaMA 2 checkpoints are built on the meta device and their
+    weights are materialized on `device` directly (see `load_model_fast`), and the vision tower is
+    only loaded on the first multimodal request. LoRA checkpoints exported by `merge_lora_weights`
+    always take this path. Models dispatched on several devices by `device_map` (e.g., "auto" with
+    several gpus) fall back to `from_pretrained`. The startup timings are printed in both modes.
+
+    With `cpu_int8` and `device='cpu'`, the vision tower and the connector are quantized to int8
+    for CPU inference (see `videollama2.model.quantization`).
+    """
+    timer = StartupTimer()
     if 'token' in kwargs:
         token = kwargs['token']
     else:
         token = None
-    
+
+    if cpu_int8 and device != 'cpu':
+        warnings.warn(f'int8 vision modules are only supported on cpu, not on {device}.')
+        cpu_int8 = False
+
+    if fast_load and (load_8bit or load_4bit):
+        warnings.warn('Fast loading does not support quantized models, fall back to `from_pretrained`.')
+        fast_load = False
+
     kwargs = {"device_map": device_map, **kwargs}
 
     if device != "cuda":
@@ -55,8 +328,15 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
         kwargs['attn_implementation'] = 'flash_attention_2'
 
     if "videollama" in model_name.lower() or 'vlb' in model_name.lower():
+        # NOTE: merged lora/qlora checkpoints are self-contained, they are loaded like SFT models.
+        merged_lora = is_merged_lora_checkpoint(model_path, token=token)
+        if merged_lora and not (load_8bit or load_4bit):
+            fast_load = True
+        if merged_lora and model_base is not None:
+            warnings.warn(f'{model_path} is a merged LoRA checkpoint, ignore the model base {model_base}.')
+
         # NOTE: lora/qlora model loading
-        if 'lora' in model_name.lower() or 'qlora' in model_name.lower():
+        if not merged_lora and ('lora' in model_name.lower() or 'qlora' in model_name.lower()):
             if model_base is None:
                 cfg_pretrained = PretrainedConfig.from_pretrained(model_path, token=token)
                 # NOTE: AutoConfig will modify `_name_or_path` property to `model_path` if `model_path` is not None.
@@ -67,7 +347,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             # NOTE: remove qlora training quantization config 
             if hasattr(lora_cfg_pretrained, 'quantization_config'):
                 del lora_cfg_pretrained.quantization_config
-            tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False, token=token)
+            tokenizer = load_tokenizer(model_base, use_fast=use_fast, token=token)
             print('Loading VideoLLaMA from base model...')
 
             if 'vicuna' in model_base.lower():
@@ -83,18 +363,22 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
                 model.model.embed_tokens.weight = torch.nn.Parameter(torch.empty(token_num, tokem_dim, device=model.device, dtype=model.dtype))
 
             print('Loading additional VideoLLaMA weights...')
-            if os.path.exists(os.path.join(model_path, 'non_lora_trainables.bin')):
-                non_lora_trainables = torch.load(os.path.join(model_path, 'non_lora_trainables.bin'), map_location='cpu')
+            if find_weights(model_path, 'non_lora_trainables') is not None:
+                non_lora_trainables = load_weights(find_weights(model_path, 'non_lora_trainables'))
             else:
                 # this is probably from HF Hub
                 from huggingface_hub import hf_hub_download
+                from huggingface_hub.utils import EntryNotFoundError
                 def load_from_hf(repo_id, filename, subfolder=None):
                     cache_file = hf_hub_download(
                         repo_id=repo_id,
                         filename=filename,
                         subfolder=subfolder)
-                    return torch.load(cache_file, map_location='cpu')
-                non_lora_trainables = load_from_hf(model_path, 'non_lora_trainables.bin')
+                    return load_weights(cache_file)
+                try:
+                    non_lora_trainables = load_from_hf(model_path, 'non_lora_trainables.safetensors')
+                except EntryNotFoundError:
+                    non_lora_trainables = load_from_hf(model_path, 'non_lora_trainables.bin')
             non_lora_trainables = {(k[11:] if k.startswith('base_model.') else k): v for k, v in non_lora_trainables.items()}
             if any(k.startswith('model.model.') for k in non_lora_trainables):
                 non_lora_trainables = {(k[6:] if k.startswith('model.') else k): v for k, v in non_lora_trainables.items()}
@@ -106,7 +390,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             print('Merging LoRA weights...')
             model = model.merge_and_unload()
             print('Model is loaded...')
-        elif model_base is not None or '-base' in model_name.lower():
+        elif not merged_lora and (model_base is not None or '-base' in model_name.lower()):
             # NOTE: Base/Pretrain model loading
             print('Loading VideoLLaMA 2 from base model...')
             cfg_pretrained = PretrainedConfig.from_pretrained(model_path, token=token)
@@ -114,7 +398,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             # cfg_pretrained = AutoConfig.from_pretrained(model_path, token=token)
             model_base = model_base if model_base is not None else cfg_pretrained._name_or_path
 
-            tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False, token=token)
+            tokenizer = load_tokenizer(model_base, use_fast=use_fast, token=token)
 
             if 'vicuna' in model_base.lower():
                 model = Videollama2LlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
@@ -132,7 +416,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             # mm_projector_weights = torch.load(os.path.join(model_path, 'mm_projector.bin'), map_location='cpu')
             # mm_projector_weights = {k: v.to(torch.float16) for k, v in mm_projector_weights.items()}
             # model.load_state_dict(mm_projector_weights, strict=False)
-            # * new codes which supports loading mm_projector.bin both offline and online 
+            # * new codes which supports loading mm_projector.safetensors/bin both offline and online 
             mm_projector_weights = load_mm_projector(model_path, token=token)
             model.load_state_dict(mm_projector_weights, strict=False)
         else:
@@ -140,28 +424,40 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             cfg_pretrained = PretrainedConfig.from_pretrained(model_path, token=token)
             model_base = cfg_pretrained._name_or_path
 
-            if 'vicuna' in model_base.lower():
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, token=token)
-                model = Videollama2LlamaForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+            if merged_lora:
+                # NOTE: the class the lora weights were merged into.
+                model_cls = {
+                    cls.__name__: cls for cls in [Videollama2LlamaForCausalLM, Videollama2MistralForCausalLM, Videollama2MixtralForCausalLM, Videollama2Qwen2ForCausalLM]
+                }[cfg_pretrained.architectures[0]]
+            elif 'vicuna' in model_base.lower():
+                model_cls = Videollama2LlamaForCausalLM
             elif 'mistral' in model_base.lower():
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, token=token)
-                model = Videollama2MistralForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+                model_cls = Videollama2MistralForCausalLM
             elif 'mixtral' in model_base.lower():
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, token=token)
-                model = Videollama2MixtralForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+                model_cls = Videollama2MixtralForCausalLM
             elif 'qwen2' in model_base.lower():
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, token=token)
-                model = Videollama2Qwen2ForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+                model_cls = Videollama2Qwen2ForCausalLM
             else:
                 # NOTE: mistral-based model is our default model.
-                tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False, token=token)
-                model = Videollama2MistralForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+                model_cls = Videollama2MistralForCausalLM
+
+            tokenizer = load_tokenizer(model_path, use_fast=use_fast, token=token)
+            timer.lap('tokenizer')
+            fast_device = get_single_device(kwargs['device_map'], device) if fast_load else None
+            if fast_load and fast_device is None:
+                warnings.warn(f'Fast loading puts all weights on one device, fall back to `from_pretrained` to dispatch them with device_map={kwargs["device_map"]}.')
+                fast_load = False
+            if fast_load:
+                fast_kwargs = {'attn_implementation': kwargs['attn_implementation']} if 'attn_implementation' in kwargs else {}
+                model = load_model_fast(model_cls, model_path, fast_device, torch_dtype=kwargs['torch_dtype'], token=token, timer=timer, **fast_kwargs)
+            else:
+                model = model_cls.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
     else:
         # Load language model
         if model_base is not None:
             # PEFT model
             from peft import PeftModel
-            tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
+            tokenizer = load_tokenizer(model_base, use_fast=use_fast)
             model = AutoModelForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, **kwargs)
             print(f"Loading LoRA weights from {model_path}")
             model = PeftModel.from_pretrained(model, model_path)
@@ -170,10 +466,10 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             print('Convert to FP16...')
             model.to(torch.float16)
         else:
-            use_fast = False
-            tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+            tokenizer = load_tokenizer(model_path, use_fast=use_fast)
             model = AutoModelForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
 
+    timer.lap('model')
     processor = None
 
     if "videollama" in model_name.lower() or 'vlb' in model_name.lower():
@@ -183,18 +479,32 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             tokenizer.add_tokens([DEFAULT_IMAGE_PATCH_TOKEN], special_tokens=True)
         if mm_use_im_start_end:
             tokenizer.add_tokens([DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN], special_tokens=True)
-        model.resize_token_embeddings(len(tokenizer))
+        if model.get_input_embeddings().weight.shape[0] != len(tokenizer):
+            model.resize_token_embeddings(len(tokenizer))
+        timer.lap('embeddings')
 
         vision_tower = model.get_vision_tower()
         if not vision_tower.is_loaded:
-            vision_tower.load_model()
-        vision_tower.to(device=device, dtype=torch.float16)
+            if fast_load and not cpu_int8:
+                # NOTE: the weights are loaded on the first multimodal request.
+                vision_tower.defer_load(device=device, dtype=torch.float16)
+            else:
+                vision_tower.load_model()
+        if vision_tower.is_loaded and not cpu_int8:
+            vision_tower.to(device=device, dtype=torch.float16)
+        if cpu_int8:
+            # NOTE: the vision tower is quantized from the float32 weights it was loaded with, never rounded through float16.
+            from .quantization import quantize_vision_modules
+            quantize_vision_modules(model)
         # NOTE: videollama2 adopts the same processor for processing image and video.
         processor = vision_tower.image_processor
+        timer.lap('vision_tower')
 
     if hasattr(model.config, "max_sequence_length"):
         context_len = model.config.max_sequence_length
     else:
         context_len = 2048
 
+    print(f'Startup timings: {timer.summary()}')
+
     return tokenizer, model, processor, context_len
@@ -89,6 +89,7 @@ class Videollama2MixtralForCausalLM(MixtralForCausalLM, Videollama2MetaForCausal
         return super().forward(
             input_ids=input_ids,
             attention_mask=attention_mask,
+            position_ids=position_ids,
             past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
             labels=labels,
@@ -112,6 +113,20 @@ class Videollama2MixtralForCausalLM(MixtralForCausalLM, Videollama2MetaForCausal
         if "inputs_embeds" in kwargs:
             raise NotImplementedError("`inputs_embeds` is not supported")
 
+        if images_or_videos is not None:
+            prefix_inputs = self.prepare_inputs_with_prefix_cache(inputs, attention_mask, images_or_videos, modal_list)
+            if prefix_inputs is not None:
+                inputs, attention_mask, kwargs["past_key_values"] = prefix_inputs
+
+        if kwargs.get("past_key_values") is not None:
+            # NOTE: continue from cached key/value states, the ids covered by the cache are never embedded.
+            outputs = super().generate(inputs, attention_mask=attention_mask, **kwargs)
+            # NOTE: only return the new tokens, the same as generating from `inputs_embeds`.
+            if isinstance(outputs, torch.Tensor):
+                return outputs[:, inputs.shape[1]:]
+            outputs.sequences = outputs.sequences[:, inputs.shape[1]:]
+            return outputs
+
         if images_or_videos is not None:
             X_modalities = [images_or_videos, modal_list] if timestamps is None else [images_or_videos, modal_list, timestamps]
             (
@@ -1,8 +1,15 @@
+import threading
+
 import torch
 import torch.nn as nn
 
 from transformers import CLIPVisionModel, CLIPImageProcessor, CLIPVisionConfig
 
+from ...mm_cache import LRUCache, tensor_digest
+
+# NOTE: serializes the deferred loading of the vision towers between the serving threads.
+_LOAD_LOCK = threading.Lock()
+
 
 class CLIPVisionTower(nn.Module):
 
@@ -14,20 +21,52 @@ class CLIPVisionTower(nn.Module):
         self.vision_tower_name = vision_tower
         self.select_layer = args.mm_vision_select_layer
         self.select_feature = getattr(args, 'mm_vision_select_feature', 'patch')
+        self.feature_cache = None
+        # (device, dtype) of the weights loaded on the first forward, see `defer_load`.
+        self.deferred_load = None
 
         if not delay_load:
             self.load_model()
+        elif getattr(args, 'mm_vision_tower_in_checkpoint', False):
+            # NOTE: the weights are part of the model checkpoint (e.g., exported by `merge_lora_weights`).
+            self.build_model()
         else:
             self.cfg_only = CLIPVisionConfig.from_pretrained(self.vision_tower_name)
 
-    def load_model(self):
+    def load_model(self, device=None, dtype=None):
+        self.image_processor = CLIPImageProcessor.from_pretrained(self.vision_tower_name)
+
+        vision_tower = CLIPVisionModel.from_pretrained(self.vision_tower_name, torch_dtype=dtype)
+        if device is not None:
+            vision_tower.to(device=device)
+        vision_tower.requires_grad_(False)
+        self.vision_tower = vision_tower
+
+        self.is_loaded = True
+
+    def build_model(self):
+        """Build the vision tower without its pretrained weights, which are loaded with the model weights."""
         self.image_processor = CLIPImageProcessor.from_pretrained(self.vision_tower_name)
 
-        self.vision_tower = CLIPVisionModel.from_pretrained(self.vision_tower_name)
-        self.vision_tower.requires_grad_(False)
+        vision_tower = CLIPVisionModel(CLIPVisionConfig.from_pretrained(self.vision_tower_name))
+        vision_tower.requires_grad_(False)
+        self.vision_tower = vision_tower
 
         self.is_loaded = True
 
+    def defer_load(self, device, dtype):
+        """Only load the image processor now, the weights are loaded onto `device` with `dtype` on the first forward."""
+        self.image_processor = CLIPImageProcessor.from_pretrained(self.vision_tower_name)
+        self.deferred_load = (device, dtype)
+
+    def ensure_loaded(self):
+        if self.is_loaded or self.deferred_load is None:
+            return
+        with _LOAD_LOCK:
+            if not self.is_loaded:
+                device, dtype = self.deferred_load
+                self.load_model(device=device, dtype=dtype)
+
     def feature_select(self, image_forward_outs):
         image_features = image_forward_outs.hidden_states[self.select_layer]
         if self.select_feature == 'patch':
@@ -38,14 +77,70 @@ class CLIPVisionTower(nn.Module):
             raise ValueError(f'Unexpected select feature: {self.select_feature}')
         return image_features
 
+    def enable_feature_cache(self, max_size=2 << 30):
+        """Cache the selected features of frames in a cpu LRU of `max_size` bytes.
+
+        The frames are keyed by the key of their video (e.g., the digest of the media file and its
+        preprocessing, see `mm_cache.media_digest`) and their index in the video, so that the pixels
+        are not hashed frame by frame on every forward.
+        """
+        self.feature_cache = LRUCache(max_size)
+
+    def disable_feature_cache(self):
+        self.feature_cache = None
+
+    def cached_forward(self, images, keys=None):
+        """Encode `images` (N, C, H, W) through the feature cache.
+
+        Args:
+            images (torch.Tensor): frames.
+            keys (list): hashable key of every frame, by default the digest of the whole batch and the frame index.
+        """
+        if keys is None:
+            digest = tensor_digest(images)
+            keys = [(digest, idx) for idx in range(images.size(0))]
+        cache_keys = [(key, self.select_layer, self.select_feature) for key in keys]
+
+        features = {}
+        missing_indices = {}
+        for idx, cache_key in enumerate(cache_keys):
+            if cache_key in features or cache_key in missing_indices:
+                continue
+            feature = self.feature_cache.get(cache_key)
+            if feature is not None:
+                features[cache_key] = feature.to(device=self.device, non_blocking=True)
+            else:
+                missing_indices[cache_key] = idx
+
+        if len(missing_indices) > 0:
+            missing_images = images[list(missing_indices.values())]
+            image_forward_outs = self.vision_tower(missing_images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
+            missing_features = self.feature_select(image_forward_outs)
+            for cache_key, feature in zip(missing_indices, missing_features):
+                # NOTE: `feature` is a view of the whole batch output, cache a copy of its own on the cpu,
+                # so that the cache holds (and charges) only the bytes of the frame. The copy goes to pinned
+                # memory asynchronously, later copies back to the device are ordered after it on the stream.
+                cpu_feature = torch.empty(feature.shape, dtype=feature.dtype, pin_memory=feature.is_cuda)
+                self.feature_cache.put(cache_key, cpu_feature.copy_(feature, non_blocking=True))
+                features[cache_key] = feature
+
+        return torch.stack([features[cache_key] for cache_key in cache_keys], dim=0)
+
     @torch.no_grad()
-    def forward(self, images):
+    def forward(self, images, keys=None):
+        """Encode images or frames, `keys` are the cache keys of the frames (used if the feature cache is enabled)."""
+        self.ensure_loaded()
         if type(images) is list:
             image_features = []
-            for image in images:
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                image_feature = self.feature_select(image_forward_out).to(image.dtype)
+            for idx, image in enumerate(images):
+                if self.feature_cache is not None:
+                    image_feature = self.cached_forward(image.unsqueeze(0), None if keys is None else keys[idx:idx + 1]).to(image.dtype)
+                else:
+                    image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
+                    image_feature = self.feature_select(image_forward_out).to(image.dtype)
                 image_features.append(image_feature)
+        elif self.feature_cache is not None:
+            image_features = self.cached_forward(images, keys).to(images.dtype)
         else:
             image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
             image_features = self.feature_select(image_forward_outs).to(images.dtype)
@@ -58,10 +153,14 @@ class CLIPVisionTower(nn.Module):
 
     @property
     def dtype(self):
+        if not self.is_loaded and self.deferred_load is not None:
+            return self.deferred_load[1]
         return self.vision_tower.dtype
 
     @property
     def device(self):
+        if not self.is_loaded and self.deferred_load is not None:
+            return torch.device(self.deferred_load[0])
         return self.vision_tower.device
 
     @property
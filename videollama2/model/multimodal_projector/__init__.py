@@ -1 +1 @@
-from .builder import load_mm_projector
\ No newline at end of file
+from .builder import load_mm_projector, load_weights, save_weights, find_weights
\ No newline at end of file
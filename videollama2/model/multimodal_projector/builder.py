@@ -14,6 +14,7 @@
 
 import os
 import re
+from collections.abc import Mapping
 
 import einops
 import torch
@@ -46,21 +47,78 @@ def parse_snapshot_folder(repo_id, cache_dir=None, repo_type="model"):
     return folder
 
 
+class LazyWeights(Mapping):
+    """Read-only mapping over the tensors of a safetensors file.
+
+    The file is memory mapped, so workers loading the same weights share the page cache. A tensor
+    is only read (and cast to `dtype` if it is floating) when it is accessed.
+    """
+
+    def __init__(self, path, dtype=None):
+        from safetensors import safe_open
+        self.path = path
+        self.dtype = dtype
+        self.file = safe_open(path, framework='pt', device='cpu')
+        self.names = list(self.file.keys())
+        self.name_set = set(self.names)
+
+    def __getitem__(self, key):
+        if key not in self.name_set:
+            raise KeyError(key)
+        tensor = self.file.get_tensor(key)
+        if self.dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(self.dtype)
+        return tensor
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def find_weights(folder, name):
+    """Return the path of the `name` weights in `folder`, safetensors are preferred over pickled ones."""
+    for ext in ['.safetensors', '.bin']:
+        path = os.path.join(folder, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_weights(path, dtype=None):
+    """Load the weights saved by `save_weights` (or pickled by `torch.save`), floating tensors are cast to `dtype`."""
+    if path.endswith('.safetensors'):
+        return LazyWeights(path, dtype=dtype)
+    weights = torch.load(path, map_location='cpu')
+    if dtype is not None:
+        weights = {k: v.to(dtype) if v.is_floating_point() else v for k, v in weights.items()}
+    return weights
+
+
+def save_weights(weights, path):
+    """Save a state dict in safetensors (if `path` ends with .safetensors) or with `torch.save`."""
+    if path.endswith('.safetensors'):
+        from safetensors.torch import save_file
+        save_file({k: v.contiguous() for k, v in weights.items()}, path, metadata={'format': 'pt'})
+    else:
+        torch.save(weights, path)
+
+
 def load_mm_projector(model_path, cache_dir=None, token=None):
-    if os.path.exists(os.path.join(model_path, 'mm_projector.bin')):
+    if find_weights(model_path, 'mm_projector') is not None:
         is_local = True
         folder = model_path
     else:
         is_local = False
         folder = parse_snapshot_folder(model_path, cache_dir=cache_dir, repo_type="model")
-        if not os.path.exists(os.path.join(folder, 'mm_projector.bin')):
+        if find_weights(folder, 'mm_projector') is None:
             # downloading from remote repo
             from huggingface_hub import snapshot_download
             snapshot_download(repo_id=model_path, cache_dir=cache_dir, token=token)
 
-    mm_projector_weights = torch.load(os.path.join(folder, 'mm_projector.bin'), map_location='cpu')
-    mm_projector_weights = {k: v.to(torch.float16) for k, v in mm_projector_weights.items()}
-    return mm_projector_weights
+    # NOTE: mm_projector.safetensors is memory mapped and cast to fp16 lazily, mm_projector.bin is unpickled.
+    return load_weights(find_weights(folder, 'mm_projector'), dtype=torch.float16)
 
 
 class IdentityMap(nn.Module):
@@ -0,0 +1,182 @@
+"""
+CPU int8 inference for the vision tower and the vision-language connector.
+
+The linear layers of the CLIP ViT and of the connector readout (`build_mlp`) are quantized with
+dynamic int8 quantization (weights in int8, activations quantized on the fly), while the
+convolutions of the STC/STP connectors (`RegStage`, `Conv3d`) stay in float32 with channels-last
+weights, which selects the faster oneDNN kernels on CPU.
+
+Usage (accuracy check against float32 and throughput benchmark):
+    python -m videollama2.model.quantization --model-path DAMO-NLP-SG/VideoLLaMA2-7B --video path/to/video.mp4
+"""
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from timm.models.regnet import RegStage
+from transformers import AutoConfig
+
+from .multimodal_encoder.builder import build_vision_tower
+from .multimodal_projector.builder import build_vision_projector, load_weights
+
+
+class CPUQuantizedModule(nn.Module):
+    """Run a dynamically quantized module in float32 and cast its outputs to `output_dtype`.
+
+    Quantized linear layers only accept float32 inputs, while the language model may run in
+    another dtype (e.g., float16), so the inputs and outputs are cast around the module.
+    """
+
+    def __init__(self, module, output_dtype=None):
+        super().__init__()
+        self.module = module
+        self.output_dtype = output_dtype
+
+    def forward(self, x, *args, **kwargs):
+        output_dtype = self.output_dtype if self.output_dtype is not None else x.dtype
+        return self.module(x.float(), *args, **kwargs).to(output_dtype)
+
+
+def quantize_vision_tower(vision_tower):
+    """Quantize the linear layers of a `CLIPVisionTower` to int8 in place."""
+    vision_tower.ensure_loaded()
+    vision_tower.vision_tower = torch.ao.quantization.quantize_dynamic(
+        vision_tower.vision_tower.to(device='cpu', dtype=torch.float32), {nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return vision_tower
+
+
+def quantize_connector(projector):
+    """Quantize the readout of a connector to int8 and convert its convolutions to channels-last."""
+    projector = projector.to(device='cpu', dtype=torch.float32)
+    for module in projector.modules():
+        if isinstance(module, RegStage):
+            module.to(memory_format=torch.channels_last)
+        elif isinstance(module, nn.Conv3d):
+            module.to(memory_format=torch.channels_last_3d)
+
+    # NOTE: STC/STP connectors keep their convolutions in float32, mlp/linear projectors are quantized entirely.
+    if isinstance(projector, nn.Linear):
+        # a root module is not swapped by `quantize_dynamic`
+        projector = nn.Sequential(projector)
+    if hasattr(projector, 'readout'):
+        projector.readout = torch.ao.quantization.quantize_dynamic(projector.readout, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    else:
+        projector = torch.ao.quantization.quantize_dynamic(projector, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return projector
+
+
+def quantize_vision_modules(model):
+    """Quantize the vision tower and the connector of a `Videollama2*ForCausalLM` for CPU inference (in place).
+
+    The visual features are cast back to the dtype of the language model.
+    """
+    quantize_vision_tower(model.get_vision_tower())
+    model.get_model().mm_projector = CPUQuantizedModule(quantize_connector(model.get_model().mm_projector), output_dtype=model.dtype)
+    return model
+
+
+def load_vision_modules(model_path, token=None):
+    """Load the float32 vision tower and connector of `model_path` without loading the language model."""
+    from .builder import get_checkpoint_shards
+
+    config = AutoConfig.from_pretrained(model_path, token=token)
+    vision_tower = build_vision_tower(config)
+    projector = build_vision_projector(config)
+
+    # NOTE: only the connector tensors are read from the (lazily loaded) shards.
+    projector_weights = {}
+    for shard in get_checkpoint_shards(model_path, token=token):
+        weights = load_weights(shard)
+        projector_weights.update({k.split('mm_projector.')[1]: weights[k] for k in weights if 'mm_projector.' in k})
+    projector.load_state_dict(projector_weights)
+
+    return vision_tower.float().eval(), projector.float().eval()
+
+
+def encode_videos(vision_tower, projector, videos, projector_type):
+    """Encode videos (t, c, h, w) with the same number of frames, the same as `encode_images_or_videos`.
+
+    Returns:
+        torch.Tensor: projected features with shape (b, n, h).
+    """
+    features = vision_tower(torch.cat(videos, dim=0))
+    features = features.view(len(videos), -1, *features.shape[1:])
+    if projector_type in ['mlp2x_gelu', 'linear']:
+        features = features.mean(1)
+    # NOTE: the vision tower and the connector are kept in the same dtype (float32 on cpu).
+    return projector(features.to(vision_tower.dtype))
+
+
+@torch.no_grad()
+def check_accuracy(reference, quantized, frames):
+    """Compare the outputs of the float32 `reference` and the int8 `quantized` encoders on `frames`.
+
+    Returns:
+        dict: mean/min token cosine similarity, maximum absolute and relative L2 error.
+    """
+    reference_output = reference(frames).float()
+    quantized_output = quantized(frames).float()
+
+    cosine = torch.nn.functional.cosine_similarity(reference_output, quantized_output, dim=-1)
+    return {
+        'cosine_mean': cosine.mean().item(),
+        'cosine_min': cosine.min().item(),
+        'max_abs_diff': (reference_output - quantized_output).abs().max().item(),
+        'rel_l2_err': ((reference_output - quantized_output).norm() / reference_output.norm()).item(),
+    }
+
+
+@torch.no_grad()
+def benchmark(encoder, frames, warmup=2, iters=10):
+    """Return the throughput of `encoder` in frames per second."""
+    for _ in range(warmup):
+        encoder(frames)
+    start = time.perf_counter()
+    for _ in range(iters):
+        encoder(frames)
+    return iters * frames.shape[0] / (time.perf_counter() - start)
+
+
+def main(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    config = AutoConfig.from_pretrained(args.model_path)
+    vision_tower, projector = load_vision_modules(args.model_path)
+    if args.video is not None:
+        from ..mm_utils import process_video
+        frames = process_video(args.video, vision_tower.image_processor, aspect_ratio=None, num_frames=args.num_frames).float()
+    else:
+        frames = torch.randn(args.num_frames, 3, vision_tower.config.image_size, vision_tower.config.image_size)
+
+    def reference(x):
+        return encode_videos(vision_tower, projector, [x], config.mm_projector_type)
+
+    quantized_vision_tower = quantize_vision_tower(copy.deepcopy(vision_tower))
+    quantized_projector = quantize_connector(copy.deepcopy(projector))
+
+    def quantized(x):
+        return encode_videos(quantized_vision_tower, quantized_projector, [x], config.mm_projector_type)
+
+    print('Accuracy of int8 against fp32: ' + ', '.join(f'{k}: {v:.4f}' for k, v in check_accuracy(reference, quantized, frames).items()))
+
+    fp32_throughput = benchmark(reference, frames, warmup=args.warmup, iters=args.iters)
+    int8_throughput = benchmark(quantized, frames, warmup=args.warmup, iters=args.iters)
+    print(f'Throughput fp32: {fp32_throughput:.2f} frames/s, int8: {int8_throughput:.2f} frames/s ({int8_throughput / fp32_throughput:.2f}x)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Accuracy check and CPU benchmark of the int8 vision tower and connector.')
+
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--video", type=str, default=None, help="Video to encode, random frames are used if not given.")
+    parser.add_argument("--num-frames", type=int, default=8)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
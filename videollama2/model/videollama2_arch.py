@@ -20,10 +20,11 @@ import einops
 import torch
 import torch.nn as nn
 
-from .multimodal_projector import load_mm_projector
+from .multimodal_projector import load_mm_projector, load_weights
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_vision_projector
-from ..mm_utils import get_anyres_image_grid_shape
+from ..mm_utils import get_anyres_image_grid_shape, normalize_frames
+from ..mm_cache import LRUCache, media_digest
 from ..constants import NUM_FRAMES, IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN,DEFAULT_MMODAL_PATCH_TOKEN, DEFAULT_MMODAL_START_TOKEN, DEFAULT_MMODAL_END_TOKEN, MMODAL_TOKEN_INDEX
 
 
@@ -49,6 +50,8 @@ class Videollama2MetaModel:
         pretrain_mm_mlp_adapter = model_args.pretrain_mm_mlp_adapter
 
         self.config.mm_vision_tower = vision_tower
+        # NOTE: the vision tower is reloaded from `vision_tower`, not from the (merged) checkpoint.
+        self.config.mm_vision_tower_in_checkpoint = False
 
         if self.get_vision_tower() is None:
             vision_tower = build_vision_tower(model_args)
@@ -83,16 +86,17 @@ class Videollama2MetaModel:
                 if os.path.isdir(pretrain_mm_mlp_adapter):
                     mm_projector_weights = load_mm_projector(pretrain_mm_mlp_adapter)
                 else:
-                    mm_projector_weights = torch.load(pretrain_mm_mlp_adapter, map_location='cpu')
+                    mm_projector_weights = load_weights(pretrain_mm_mlp_adapter)
             else:
                 # Support loading projector weights from remote HuggingFace model hub
                 is_local = False
-                pretrain_mm_mlp_adapter = pretrain_mm_mlp_adapter.replace('mm_projector.bin', '')
+                pretrain_mm_mlp_adapter = pretrain_mm_mlp_adapter.replace('mm_projector.bin', '').replace('mm_projector.safetensors', '')
                 pretrain_mm_mlp_adapter = pretrain_mm_mlp_adapter.strip('/').strip('\\').strip()
                 mm_projector_weights = load_mm_projector(pretrain_mm_mlp_adapter)
 
             def get_w(weights, keyword):
-                return {k.split(keyword + '.')[1]: v for k, v in weights.items() if keyword in k}
+                # NOTE: only the matched weights are read from lazily loaded safetensors.
+                return {k.split(keyword + '.')[1]: weights[k] for k in weights if keyword in k}
 
             # self.mm_projector.load_state_dict(get_w(mm_projector_weights, 'mm_projector'))
             # set strict=False to avoid missing key error regarding bert.embeddings.position_ids
@@ -115,17 +119,41 @@ class Videollama2MetaForCausalLM(ABC):
         return self.get_model().get_vision_tower()
 
     def encode_images_or_videos(self, images_or_videos, modalities):
-        num_frames = self.config.num_frames if hasattr(self.config, 'num_frames') else NUM_FRAMES
-
-        videos = [x.unsqueeze(0).expand(num_frames, -1, -1, -1) if modal == 'image' else x for x, modal in zip(images_or_videos, modalities)]
-        videos = torch.stack(videos, dim=0)
+        # NOTE: precomputed features with shape (n, h), e.g., read from a `FeatureStore`, are used as they are.
+        is_feature = [len(x.size()) == 2 for x in images_or_videos]
+        if any(is_feature):
+            raw = [(x, modal) for x, modal, feature in zip(images_or_videos, modalities, is_feature) if not feature]
+            raw_features = iter(self.encode_images_or_videos(*map(list, zip(*raw))) if len(raw) > 0 else [])
+            return torch.stack([
+                x.to(device=self.device, dtype=self.dtype) if feature else next(raw_features)
+                for x, feature in zip(images_or_videos, is_feature)
+            ], dim=0)
 
-        assert len(videos.size()) == 5
-        batch_size = videos.size(0)
+        num_frames = self.config.num_frames if hasattr(self.config, 'num_frames') else NUM_FRAMES
 
-        frames = einops.rearrange(videos, 'b t c h w -> (b t) c h w')
-        frames_features = self.get_model().get_vision_tower()(frames)
-        frames_features = einops.rearrange(frames_features, '(b t) n h -> b t n h', b = batch_size)
+        # NOTE: an image is encoded only once and its features are broadcast to a `num_frames`-long
+        # pseudo-video afterwards, which is equivalent to encoding `num_frames` copies of the image up
+        # to the rounding of the batched kernels at another batch size (see tests/test_encode.py).
+        frames = [x.unsqueeze(0) if modal == 'image' else x for x, modal in zip(images_or_videos, modalities)]
+        assert all(len(x.size()) == 4 for x in frames)
+        vision_tower = self.get_model().get_vision_tower()
+        # NOTE: with the feature cache, frames are keyed by the key (or one digest) of their media and their index.
+        frame_keys = None
+        if getattr(vision_tower, 'feature_cache', None) is not None:
+            frame_keys = [(media_digest(x), idx) for x, y in zip(images_or_videos, frames) for idx in range(y.size(0))]
+        # NOTE: uint8 frames (preprocessed with `normalize=False`) are normalized here, on the device
+        # of the model, and cast to its dtype (`normalize_frames` returns float32).
+        if any(x.dtype == torch.uint8 for x in frames):
+            image_processor = vision_tower.image_processor
+            frames = [normalize_frames(x, image_processor).to(device=self.device, dtype=self.dtype) if x.dtype == torch.uint8 else x for x in frames]
+        frame_counts = [x.size(0) for x in frames]
+
+        frames = torch.cat(frames, dim=0)
+        frames_features = vision_tower(frames, keys=frame_keys)
+        frames_features = torch.split(frames_features, frame_counts, dim=0)
+
+        frames_features = [x.expand(num_frames, -1, -1) if modal == 'image' else x for x, modal in zip(frames_features, modalities)]
+        frames_features = torch.stack(frames_features, dim=0)
 
         return self.temporal_aggregator(frames_features)
 
@@ -166,98 +194,97 @@ class Videollama2MetaForCausalLM(ABC):
 
         Xs, keys = X_modalities
         X_features = self.encode_images_or_videos(Xs, keys)
+        num_X_tokens = X_features.shape[1]
+
+        # 1. locate the image/video/audio tokens of the whole batch in one pass
+        X_token_ids = torch.tensor([MMODAL_TOKEN_INDEX[key.upper()] for key in set(keys)], device=input_ids.device)
+        is_X_token = torch.isin(input_ids, X_token_ids)
+        # NOTE: features are consumed in order, a sample without any modal token consumes one feature as well.
+        num_X_consumed = is_X_token.sum(dim=1).clamp(min=1)
+        X_start_ids = torch.cumsum(num_X_consumed, dim=0) - num_X_consumed
+        X_ids = X_start_ids[:, None] + torch.cumsum(is_X_token.long(), dim=1) - 1
+
+        # 2. position of every token in the spliced sequences (each modal token expands to `num_X_tokens` positions)
+        token_lens = is_X_token.long() * (num_X_tokens - 1) + 1
+        new_positions = torch.cumsum(token_lens, dim=1) - token_lens
+        max_len = int(token_lens.sum(dim=1).max())
+
+        # 3. embed all text tokens with a single call and scatter them into a preallocated buffer
+        text_embeds = self.get_model().embed_tokens(input_ids.masked_fill(is_X_token, 0))
+        batch_size, _, hidden_size = text_embeds.shape
+        new_input_embeds = torch.zeros((batch_size, max_len, hidden_size), dtype=text_embeds.dtype, device=text_embeds.device)
+        text_b, text_t = torch.where(~is_X_token)
+        text_positions = new_positions[text_b, text_t]
+        new_input_embeds[text_b, text_positions] = text_embeds[text_b, text_t]
+
+        # 4. replace image/video/audio tokens with pre-computed embeddings
+        X_b, X_t = torch.where(is_X_token)
+        X_positions = new_positions[X_b, X_t][:, None] + torch.arange(num_X_tokens, device=input_ids.device)[None]
+        new_input_embeds[X_b[:, None], X_positions] = X_features[X_ids[X_b, X_t]].to(new_input_embeds)
+
+        new_labels = None
+        if labels is not None:
+            assert labels.shape == input_ids.shape
+            new_labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+            new_labels[text_b, text_positions] = labels[text_b, text_t]
+
+        # NOTE: modal features are always attended, padding (right side) is not.
+        if attention_mask is not None:
+            new_attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
+            new_attention_mask[text_b, text_positions] = attention_mask[text_b, text_t]
+            new_attention_mask[X_b[:, None], X_positions] = True
+            attention_mask = new_attention_mask
 
-        new_input_embeds = []
-        new_labels = [] if labels is not None else None
-        cur_X_idx = 0
-        # replace image/video/audio tokens with pre-computed embeddings
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            # cur_X_features = X_features[batch_idx]
-            if (torch.any(torch.stack([cur_input_ids == MMODAL_TOKEN_INDEX[key.upper()] for key in keys]), dim=0)).sum() == 0:
-                half_len = cur_input_ids.shape[0] // 2
-                cur_X_features = X_features[cur_X_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids[:half_len])
-                cur_input_embeds_2 = self.get_model().embed_tokens(cur_input_ids[half_len:])
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_X_features[0:0], cur_input_embeds_2], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                if labels is not None:
-                    new_labels.append(labels[batch_idx])
-                cur_X_idx += 1 
-                continue
-
-            X_token_indices = torch.where(torch.any(torch.stack([cur_input_ids == MMODAL_TOKEN_INDEX[key.upper()] for key in keys]), dim=0))[0] 
-            cur_new_input_embeds = []
-            if labels is not None:
-                cur_labels = labels[batch_idx]
-                cur_new_labels = []
-                assert cur_labels.shape == cur_input_ids.shape
-            
-            # X_index_inonesample = 0
-            while X_token_indices.numel() > 0:
-                cur_X_features = X_features[cur_X_idx]
-                X_token_start = X_token_indices[0]
-
-                cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:X_token_start])) 
-                cur_new_input_embeds.append(cur_X_features)
-                if labels is not None:
-                    cur_new_labels.append(cur_labels[:X_token_start])
-                    cur_new_labels.append(torch.full((cur_X_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
-                    cur_labels = cur_labels[X_token_start+1:]
-
-                cur_X_idx += 1
-                cur_input_ids = cur_input_ids[X_token_start+1:] 
-                X_token_indices = torch.where(torch.any(torch.stack([cur_input_ids == MMODAL_TOKEN_INDEX[key.upper()] for key in keys]), dim=0))[0]
-
-            if cur_input_ids.numel() > 0:
-                cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids))
-                if labels is not None:
-                    cur_new_labels.append(cur_labels)
-            cur_new_input_embeds = [x.to(device=self.device) for x in cur_new_input_embeds]
-            # NOTE: one cur_new_input_embeds per each  
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds, dim=0)
-            new_input_embeds.append(cur_new_input_embeds)
-            if labels is not None:
-                cur_new_labels = torch.cat(cur_new_labels, dim=0)
-                new_labels.append(cur_new_labels)
-
-        # padding
-        if any(x.shape != new_input_embeds[0].shape for x in new_input_embeds):
-            max_len = max(x.shape[0] for x in new_input_embeds)
-
-            new_input_embeds_align = []
-            for cur_new_embed in new_input_embeds:
-                cur_new_embed = torch.cat((cur_new_embed, torch.zeros((max_len - cur_new_embed.shape[0], cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)), dim=0)
-                new_input_embeds_align.append(cur_new_embed)
-            new_input_embeds = torch.stack(new_input_embeds_align, dim=0)
-
-            if labels is not None:
-                new_labels_align = []
-                _new_labels = new_labels
-                for cur_new_label in new_labels:
-                    cur_new_label = torch.cat((cur_new_label, torch.full((max_len - cur_new_label.shape[0],), IGNORE_INDEX, dtype=cur_new_label.dtype, device=cur_new_label.device)), dim=0)
-                    new_labels_align.append(cur_new_label)
-                new_labels = torch.stack(new_labels_align, dim=0)
-
-            if attention_mask is not None:
-                new_attention_mask = []
-                for cur_attention_mask, cur_new_labels, cur_new_labels_align in zip(attention_mask, _new_labels, new_labels):
-                    new_attn_mask_pad_left = torch.full((cur_new_labels.shape[0] - labels.shape[1],), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                    new_attn_mask_pad_right = torch.full((cur_new_labels_align.shape[0] - cur_new_labels.shape[0],), False, dtype=attention_mask.dtype, device=attention_mask.device)
-                    cur_new_attention_mask = torch.cat((new_attn_mask_pad_left, cur_attention_mask, new_attn_mask_pad_right), dim=0)
-                    new_attention_mask.append(cur_new_attention_mask)
-                attention_mask = torch.stack(new_attention_mask, dim=0)
-                assert attention_mask.shape == new_labels.shape
-        else:
-            new_input_embeds = torch.stack(new_input_embeds, dim=0)
-            if labels is not None:
-                new_labels  = torch.stack(new_labels, dim=0)
+        return None, attention_mask, past_key_values, new_input_embeds, new_labels
 
-            if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
-                assert attention_mask.shape == new_input_embeds.shape[:2]
+    def enable_prefix_cache(self, max_size=2 << 30):
+        """Cache the key/value states of the shared prompt prefix (system prompt + visual tokens) in a LRU of `max_size` bytes.
 
-        return None, attention_mask, past_key_values, new_input_embeds, new_labels
+        Entries are keyed by the digests of the images/videos and the prefix token ids (i.e., the
+        conversation template), so follow-up questions on the same video only prefill their own text.
+        """
+        self.prefix_cache = LRUCache(max_size)
+
+    def disable_prefix_cache(self):
+        self.prefix_cache = None
+
+    def prepare_inputs_with_prefix_cache(self, input_ids, attention_mask, images_or_videos, modal_list):
+        """Split a prompt after its last modal token and look up (or compute) the key/value states of the prefix.
+
+        Returns:
+            tuple: (input_ids, attention_mask, past_key_values) for `generate`, or None if the prompt
+                can not use the prefix cache (cache disabled, batched or padded inputs, no modal token).
+        """
+        if getattr(self, 'prefix_cache', None) is None or input_ids.shape[0] != 1:
+            return None
+        if attention_mask is not None and not attention_mask.all():
+            return None
+
+        X_token_ids = torch.tensor([MMODAL_TOKEN_INDEX[key.upper()] for key in set(modal_list)], device=input_ids.device)
+        X_token_indices = torch.where(torch.isin(input_ids[0], X_token_ids))[0]
+        if X_token_indices.numel() == 0 or X_token_indices[-1] == input_ids.shape[1] - 1:
+            return None
+        prefix_len = int(X_token_indices[-1]) + 1
+        prefix_ids, suffix_ids = input_ids[:, :prefix_len], input_ids[:, prefix_len:]
+
+        cache_key = (tuple(media_digest(x) for x in images_or_videos), tuple(modal_list), tuple(prefix_ids[0].tolist()))
+        past_key_values = self.prefix_cache.get(cache_key)
+        if past_key_values is None:
+            _, prefix_attention_mask, _, prefix_embeds, _ = self.prepare_inputs_labels_for_multimodal(
+                prefix_ids, torch.ones_like(prefix_ids), None, None, [images_or_videos, modal_list]
+            )
+            past_key_values = self(inputs_embeds=prefix_embeds, attention_mask=prefix_attention_mask, use_cache=True, return_dict=True).past_key_values
+            # NOTE: keep the immutable legacy format, `generate` would extend a `Cache` object in place.
+            if hasattr(past_key_values, 'to_legacy_cache'):
+                past_key_values = past_key_values.to_legacy_cache()
+            self.prefix_cache.put(cache_key, past_key_values)
+
+        # NOTE: the placeholder ids of the cached prefix are never embedded, `generate` only feeds the ids after the cache.
+        past_len = past_key_values[0][0].shape[2]
+        input_ids = torch.cat([torch.zeros((1, past_len), dtype=input_ids.dtype, device=input_ids.device), suffix_ids], dim=1)
+        attention_mask = torch.ones_like(input_ids)
+
+        return input_ids, attention_mask, past_key_values
 
     def initialize_vision_tokenizer(self, model_args, tokenizer):
         if model_args.mm_use_im_patch_token:
@@ -285,7 +312,7 @@ class Videollama2MetaForCausalLM(ABC):
                     p.requires_grad = False
 
             if model_args.pretrain_mm_mlp_adapter:
-                mm_projector_weights = torch.load(model_args.pretrain_mm_mlp_adapter, map_location='cpu')
+                mm_projector_weights = load_weights(model_args.pretrain_mm_mlp_adapter)
                 embed_tokens_weight = mm_projector_weights['model.embed_tokens.weight']
                 assert num_new_tokens == 2
                 if input_embeddings.shape == embed_tokens_weight.shape:
@@ -333,7 +360,7 @@ class Videollama2MetaForCausalLM(ABC):
                     p.requires_grad = False
 
             if model_args.pretrain_mm_mlp_adapter:
-                mm_projector_weights = torch.load(model_args.pretrain_mm_mlp_adapter, map_location='cpu')
+                mm_projector_weights = load_weights(model_args.pretrain_mm_mlp_adapter)
                 embed_tokens_weight = mm_projector_weights['model.embed_tokens.weight']
                 assert num_new_tokens == 6  # start/end tokens for image/video/audio
                 if input_embeddings.shape == embed_tokens_weight.shape:
@@ -0,0 +1,239 @@
+"""
+A streaming prefetch stage for the inference runners.
+
+The stage pulls samples from any iterable (e.g., a `DataLoader`) in a background thread and
+copies their tensors to the model device, so that decoding, preprocessing and host-to-device
+transfer of the next samples overlap with the generation of the current one. Decoded frames
+can be shipped from the `DataLoader` workers as uint8 through a shared-memory ring buffer.
+"""
+import time
+import queue
+import threading
+from collections import defaultdict
+
+import torch
+
+from .mm_cache import copy_media_key
+
+
+def pin_memory(value):
+    """Pin the cpu tensors in a (nested) tuple/list/dict."""
+    if isinstance(value, torch.Tensor):
+        return copy_media_key(value.pin_memory(), value) if value.device.type == 'cpu' else value
+    elif isinstance(value, (tuple, list)):
+        return type(value)(pin_memory(x) for x in value)
+    elif isinstance(value, dict):
+        return {k: pin_memory(v) for k, v in value.items()}
+    return value
+
+
+def to_device(value, device, dtype=None):
+    """Move the tensors in a (nested) tuple/list/dict to `device`, floating tensors are cast to `dtype`."""
+    if isinstance(value, torch.Tensor):
+        source = value
+        value = value.to(device, non_blocking=True)
+        if dtype is not None and value.is_floating_point():
+            value = value.to(dtype)
+        return copy_media_key(value, source)
+    elif isinstance(value, (tuple, list)):
+        return type(value)(to_device(x, device, dtype) for x in value)
+    elif isinstance(value, dict):
+        return {k: to_device(v, device, dtype) for k, v in value.items()}
+    return value
+
+
+def record_stream(value, stream):
+    """Mark the cuda tensors in a (nested) tuple/list/dict as used by `stream`."""
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda:
+            value.record_stream(stream)
+    elif isinstance(value, (tuple, list)):
+        for x in value:
+            record_stream(x, stream)
+    elif isinstance(value, dict):
+        for x in value.values():
+            record_stream(x, stream)
+
+
+class PrefetchPipeline(object):
+    """Iterate over `iterable` with up to `depth` samples prepared ahead of the consumer.
+
+    In the background thread every sample is loaded (decode & preprocess, or fetched from the
+    `DataLoader` workers), optionally transformed, pinned and copied to `device` on a side cuda
+    stream. On cpu the thread still overlaps loading with the model compute of the main thread.
+
+    The time spent in each stage is accumulated in `timings` (seconds):
+        load: waiting for the iterable (decode & preprocess).
+        transform: the optional `transform` callable.
+        transfer: pinning and issuing the host-to-device copies.
+        wait: the consumer blocked on an empty queue, i.e., the pipeline is the bottleneck.
+        compute: the consumer working between two samples, e.g., `generate`.
+
+    Args:
+        iterable: samples to prefetch.
+        device (str or torch.device): target device of the tensors, None to keep them on cpu.
+        dtype (torch.dtype): cast floating tensors to `dtype` after the transfer.
+        depth (int): maximum number of prefetched samples (size of the bounded queue).
+        transform (callable): function applied to every sample in the background thread.
+    """
+
+    def __init__(self, iterable, device=None, dtype=None, depth=2, transform=None):
+        self.iterable = iterable
+        self.device = torch.device(device) if device is not None else None
+        self.dtype = dtype
+        self.depth = depth
+        self.transform = transform
+
+        self.timings = defaultdict(float)
+        self.num_samples = 0
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        use_cuda = self.device is not None and self.device.type == 'cuda' and torch.cuda.is_available()
+        stream = torch.cuda.Stream(device=self.device) if use_cuda else None
+        samples = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            # NOTE: give up when the consumer stopped early, instead of blocking on a full queue forever.
+            while not stop.is_set():
+                try:
+                    samples.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                iterator = iter(self.iterable)
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        sample = next(iterator)
+                    except StopIteration:
+                        break
+                    self.timings['load'] += time.perf_counter() - start
+
+                    if self.transform is not None:
+                        start = time.perf_counter()
+                        sample = self.transform(sample)
+                        self.timings['transform'] += time.perf_counter() - start
+
+                    event = None
+                    if self.device is not None:
+                        start = time.perf_counter()
+                        if use_cuda:
+                            with torch.cuda.stream(stream):
+                                sample = to_device(pin_memory(sample), self.device, self.dtype)
+                                event = torch.cuda.Event()
+                                event.record(stream)
+                        else:
+                            sample = to_device(sample, self.device, self.dtype)
+                        self.timings['transfer'] += time.perf_counter() - start
+                    put((sample, event))
+            except Exception as e:
+                put((e, None))
+            put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = samples.get()
+                self.timings['wait'] += time.perf_counter() - start
+                if item is None:
+                    break
+                sample, event = item
+                if isinstance(sample, Exception):
+                    raise sample
+                if event is not None:
+                    # NOTE: the copies were issued on the side stream, sync it with the consumer stream.
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    record_stream(sample, current_stream)
+
+                self.num_samples += 1
+                start = time.perf_counter()
+                yield sample
+                self.timings['compute'] += time.perf_counter() - start
+        finally:
+            stop.set()
+            thread.join()
+
+    def summary(self):
+        """Format the per-stage timings, in total seconds and milliseconds per sample."""
+        num_samples = max(self.num_samples, 1)
+        return ', '.join(
+            f'{stage}: {seconds:.2f}s ({seconds / num_samples * 1000:.1f}ms/it)'
+            for stage, seconds in self.timings.items()
+        )
+
+
+class SharedFrameBuffer(object):
+    """Ring buffer of uint8 frames in shared memory, filled by `DataLoader` workers.
+
+    Instead of sending the frames of a sample through the multiprocessing queues, a worker writes
+    them into slot `idx % num_slots` of a buffer allocated once in shared memory and only sends a
+    handle (slot, num_frames). The consumer copies the frames out with `get` and normalizes them
+    later (see `normalize_frames`). Slots are reused, so `num_slots` must exceed the number of
+    samples in flight, which holds for sequential (unshuffled) loaders built with `for_loader`.
+
+    Args:
+        num_slots (int): number of samples held by the ring.
+        max_frames (int): maximum number of frames of a sample.
+        frame_shape (tuple): (C, H, W) of a frame.
+    """
+
+    def __init__(self, num_slots, max_frames, frame_shape):
+        self.num_slots = num_slots
+        self.max_frames = max_frames
+        self.frames = torch.zeros((num_slots, max_frames, *frame_shape), dtype=torch.uint8).share_memory_()
+
+    @classmethod
+    def for_loader(cls, image_processor, max_frames, batch_size, num_workers, prefetch_factor=2):
+        """Allocate a ring large enough for the samples in flight of a sequential `DataLoader`."""
+        # NOTE: the workers hold at most num_workers * prefetch_factor batches, plus the batch being consumed.
+        num_slots = (max(num_workers, 1) * prefetch_factor + 2) * batch_size
+        crop_size = image_processor.crop_size
+        return cls(num_slots, max_frames, (3, crop_size['height'], crop_size['width']))
+
+    def put(self, idx, frames):
+        """Write the uint8 frames of sample `idx` and return their handle."""
+        assert frames.dtype == torch.uint8 and len(frames) <= self.max_frames
+        slot = idx % self.num_slots
+        self.frames[slot, :len(frames)].copy_(frames)
+        return torch.tensor([slot, len(frames)], dtype=torch.long)
+
+    def get(self, handle, pin_memory=False):
+        """Copy the frames of `handle` out of the ring, the slot is overwritten by later samples."""
+        slot, num_frames = int(handle[0]), int(handle[1])
+        frames = self.frames[slot, :num_frames]
+        return torch.empty(frames.shape, dtype=frames.dtype, pin_memory=pin_memory).copy_(frames)
+
+    def get_batch(self, handles, pin_memory=False):
+        return [None if handle is None else self.get(handle, pin_memory) for handle in handles]
+
+
+class SharedFramesDataset(torch.utils.data.Dataset):
+    """Wrap a dataset of dict samples so that `sample[key]` is shipped through a `SharedFrameBuffer`.
+
+    The wrapped dataset must return uint8 frames (e.g., preprocessed with `normalize=False`) or None.
+    """
+
+    def __init__(self, dataset, frame_buffer, key='video'):
+        self.dataset = dataset
+        self.frame_buffer = frame_buffer
+        self.key = key
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        if sample[self.key] is not None:
+            sample[self.key] = self.frame_buffer.put(idx, sample[self.key])
+        return sample
@@ -0,0 +1,343 @@
+"""
+A continuous batching engine for the native model worker.
+
+New requests are prefilled one by one and then admitted into the running decode batch,
+finished requests leave the batch at once. The key/value caches of all running requests
+are kept in one left-padded batch cache, so that every decode step is a single forward
+of the model no matter when the requests arrived.
+"""
+import queue
+import threading
+import traceback
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchRequest(object):
+
+    def __init__(self, input_ids, images_or_videos=None, modal_list=None, temperature=1.0, top_p=1.0,
+                 max_new_tokens=256, stop_str=None, timeout=None):
+        self.input_ids = input_ids
+        self.images_or_videos = images_or_videos
+        self.modal_list = modal_list
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.stop_str = stop_str
+        self.timeout = timeout
+
+        self.output_ids = []
+        self.output_text = ""
+        self.detokenizer = None
+        # number of real (non-padding) tokens in the key/value cache
+        self.seq_len = 0
+        # whether the request has joined the running batch
+        self.started = False
+        self.finished = False
+        self.text_queue = queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Stream the decoded text chunks, the same as `TextIteratorStreamer`."""
+        while True:
+            try:
+                value = self.text_queue.get(timeout=self.timeout)
+                break
+            except queue.Empty:
+                # NOTE: `timeout` only applies once the request is decoded, not while it waits for a batch slot.
+                if self.started:
+                    raise
+        if value is None:
+            raise StopIteration()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    @property
+    def num_tokens(self):
+        """Number of tokens generated so far."""
+        return len(self.output_ids)
+
+
+class IncrementalDetokenizer(object):
+    """Decode a growing sequence of token ids into text deltas.
+
+    Only the last few tokens are decoded at every step: the text of the new tokens is the
+    difference between the decoding of `token_ids[prefix_offset:]` and of
+    `token_ids[prefix_offset:read_offset]`, where the prefix gives the tokenizer enough context
+    to place the leading spaces of the new tokens (e.g., SentencePiece), so the cost of a step
+    does not grow with the length of the output.
+
+    Args:
+        tokenizer: tokenizer.
+        skip_special_tokens (bool): drop the special tokens from the text.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def step(self, token_ids, final=False):
+        """Return the text of the tokens appended to `token_ids` since the last step.
+
+        Args:
+            token_ids (list): all the generated token ids so far.
+            final (bool): flush the text held back at the end of the generation.
+        Returns:
+            str: the new text, empty if there is none (yet).
+        """
+        prefix_text = self.tokenizer.decode(token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=self.skip_special_tokens)
+        text = self.tokenizer.decode(token_ids[self.prefix_offset:], skip_special_tokens=self.skip_special_tokens)
+        # NOTE: hold back incomplete multi-byte characters until they are decoded completely
+        if len(text) <= len(prefix_text) or (text.endswith("\ufffd") and not final):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(token_ids)
+        return text[len(prefix_text):]
+
+
+class TokenStreamer(object):
+    """Streamer for `model.generate` which decodes incrementally and counts the generated tokens.
+
+    A drop-in replacement of `TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)`
+    for a single sequence, which also exposes `num_tokens` like `BatchRequest`.
+
+    Args:
+        tokenizer: tokenizer.
+        timeout (float): timeout of waiting for the next text chunk.
+    """
+
+    def __init__(self, tokenizer, timeout=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.timeout = timeout
+        self.output_ids = []
+        self.text_queue = queue.Queue()
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        # NOTE: `generate` puts the prompt first, skip it.
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        self.output_ids.extend(value.view(-1).tolist())
+        text = self.detokenizer.step(self.output_ids)
+        if len(text) > 0:
+            self.text_queue.put(text)
+
+    def end(self):
+        text = self.detokenizer.step(self.output_ids, final=True)
+        if len(text) > 0:
+            self.text_queue.put(text)
+        self.text_queue.put(None)
+
+    @property
+    def num_tokens(self):
+        return len(self.output_ids)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value is None:
+            raise StopIteration()
+        return value
+
+
+def sample_next_token(logits, temperature, top_p):
+    """Sample the next token from logits with shape (vocab_size,)."""
+    if temperature <= 0.001:
+        return int(torch.argmax(logits, dim=-1))
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+        # keep the smallest set of tokens whose cumulative probability exceeds top_p
+        sorted_probs[(torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_p] = 0
+        return int(sorted_ids[torch.multinomial(sorted_probs, 1)])
+    return int(torch.multinomial(probs, 1))
+
+
+def pad_past_key_values(past_key_values, length):
+    """Left-pad legacy key/value caches with shape (b, h, t, d) to `length` along the time dimension."""
+    return tuple(
+        tuple(F.pad(x, (0, 0, length - x.shape[2], 0)) for x in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+class ContinuousBatchingEngine(object):
+    """Continuous batching scheduler on top of a `Videollama2*ForCausalLM` model.
+
+    Args:
+        model: VideoLLaMA2 model.
+        tokenizer: tokenizer.
+        max_batch_size (int): maximum number of requests in the decode batch.
+        start (bool): whether to start the scheduling thread, otherwise call `start`, or drive
+            the engine with `admit` and `step` (e.g., in tests).
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, start=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+
+        self.waiting = queue.Queue()
+        self.running = []
+        # batch states of the running requests
+        self.past_key_values = None
+        self.attention_mask = None
+
+        self.thread = None
+        if start:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_ids, images_or_videos=None, modal_list=None, **kwargs):
+        """Submit a request and return an iterator over its streamed text.
+
+        Args:
+            input_ids (torch.Tensor): prompt ids with shape (1, l).
+            images_or_videos (list): preprocessed images/videos, None for text-only requests.
+            modal_list (list): modality of each item in `images_or_videos`.
+            **kwargs: temperature, top_p, max_new_tokens, stop_str, timeout.
+        Returns:
+            BatchRequest: iterator of text chunks.
+        """
+        request = BatchRequest(input_ids, images_or_videos, modal_list, **kwargs)
+        request.detokenizer = IncrementalDetokenizer(self.tokenizer)
+        self.waiting.put(request)
+        return request
+
+    def loop(self):
+        while True:
+            # NOTE: block when idle, otherwise admit new requests between decode steps
+            if len(self.running) == 0:
+                self.admit(self.waiting.get())
+            while len(self.running) < self.max_batch_size and not self.waiting.empty():
+                self.admit(self.waiting.get_nowait())
+
+            if len(self.running) == 0:
+                continue
+
+            try:
+                self.step()
+            except Exception as e:
+                traceback.print_exc()
+                for request in self.running:
+                    request.text_queue.put(e)
+                self.running = []
+                self.past_key_values, self.attention_mask = None, None
+
+    @torch.inference_mode()
+    def admit(self, request):
+        """Prefill a request and merge it into the running batch."""
+        model = self.model
+        try:
+            input_ids = request.input_ids.to(model.device)
+            attention_mask = torch.ones_like(input_ids)
+            if request.images_or_videos is not None and len(request.modal_list) > 0:
+                _, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+                    input_ids, attention_mask, None, None, [request.images_or_videos, request.modal_list]
+                )
+            else:
+                inputs_embeds = model.get_model().embed_tokens(input_ids)
+
+            outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True, return_dict=True)
+        except Exception as e:
+            traceback.print_exc()
+            request.text_queue.put(e)
+            return
+
+        request.seq_len = inputs_embeds.shape[1]
+        self.merge(request, outputs.past_key_values, attention_mask)
+        request.started = True
+        self.append_token(request, outputs.logits[0, -1])
+        self.release_finished()
+
+    def merge(self, request, past_key_values, attention_mask):
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+        else:
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            batch_past = pad_past_key_values(self.past_key_values, length)
+            past_key_values = pad_past_key_values(past_key_values, length)
+            self.past_key_values = tuple(
+                tuple(torch.cat([x, y], dim=0) for x, y in zip(batch_layer_past, layer_past))
+                for batch_layer_past, layer_past in zip(batch_past, past_key_values)
+            )
+            self.attention_mask = torch.cat([
+                F.pad(self.attention_mask, (length - self.attention_mask.shape[1], 0)),
+                F.pad(attention_mask, (length - attention_mask.shape[1], 0)),
+            ], dim=0)
+        self.running.append(request)
+
+    @torch.inference_mode()
+    def step(self):
+        """Decode one token for every running request."""
+        device = self.attention_mask.device
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self.running], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[request.seq_len] for request in self.running], dtype=torch.long, device=device)
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.past_key_values, self.attention_mask = outputs.past_key_values, attention_mask
+
+        for idx, request in enumerate(self.running):
+            request.seq_len += 1
+            self.append_token(request, outputs.logits[idx, -1])
+        self.release_finished()
+
+    def append_token(self, request, logits):
+        token_id = sample_next_token(logits, request.temperature, request.top_p)
+        request.output_ids.append(token_id)
+
+        finished = token_id == self.tokenizer.eos_token_id or len(request.output_ids) >= request.max_new_tokens
+        text = request.output_text + request.detokenizer.step(request.output_ids, final=finished)
+        if request.stop_str:
+            # NOTE: only the new text (and the end of the previous one) can contain a new stop string
+            idx = text.find(request.stop_str, max(len(request.output_text) - len(request.stop_str) + 1, 0))
+            if idx >= 0:
+                text = text[:idx + len(request.stop_str)]
+                finished = True
+        request.finished = finished
+
+        if len(text) > len(request.output_text):
+            request.text_queue.put(text[len(request.output_text):])
+        request.output_text = text
+
+    def release_finished(self):
+        keep = [idx for idx, request in enumerate(self.running) if not request.finished]
+        for request in self.running:
+            if request.finished:
+                request.text_queue.put(None)
+        if len(keep) == len(self.running):
+            return
+
+        self.running = [self.running[idx] for idx in keep]
+        if len(keep) == 0:
+            self.past_key_values, self.attention_mask = None, None
+            return
+
+        keep = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[keep]
+        # drop the padding columns shared by all remaining requests
+        start = int(torch.nonzero(attention_mask.sum(dim=0))[0])
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            tuple(x[keep, :, start:] for x in layer_past)
+            for layer_past in self.past_key_values
+        )
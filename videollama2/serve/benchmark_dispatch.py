@@ -0,0 +1,140 @@
+"""
+Simulation benchmark of the dispatch methods of the controller against stub workers.
+
+Stub workers with different speeds are started locally, requests arrive as a Poisson process
+and are proxied through `Controller.aworker_api_generate_stream` with each dispatch method in
+turn. With `--direct`, requests are dispatched by `Controller.dispatch` and streamed from the
+workers like the gradio web server does, then reported with `Controller.report_request`.
+Heart beats (which carry the queue lengths used by shortest_queue) are simulated every
+`--heart-beat-interval` seconds.
+
+Usage:
+python3 -m videollama2.serve.benchmark_dispatch --workers 0.1:50,0.1:50,0.1:50,0.4:15 --request-rate 3.5 --num-requests 400
+"""
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import numpy as np
+import requests
+
+from videollama2.constants import WORKER_HEART_BEAT_INTERVAL
+from videollama2.serve.controller import Controller
+
+
+def start_stub_workers(worker_specs, base_port, num_tokens, concurrency):
+    """Start one stub worker per "prefill_latency:tokens_per_second" spec and return (processes, addresses)."""
+    processes, addresses = [], []
+    for idx, spec in enumerate(worker_specs):
+        prefill_latency, tokens_per_second = spec.split(":")
+        port = base_port + idx
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "videollama2.serve.stub_worker", "--no-register",
+            "--port", str(port), "--worker-address", f"http://localhost:{port}",
+            "--prefill-latency", prefill_latency, "--tokens-per-second", tokens_per_second,
+            "--num-tokens", str(num_tokens), "--concurrency", str(concurrency)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        addresses.append(f"http://localhost:{port}")
+
+    for address in addresses:
+        for _ in range(100):
+            try:
+                requests.post(address + "/worker_get_status", timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"Stub worker {address} did not start.")
+    return processes, addresses
+
+
+async def simulate_heart_beats(controller, addresses, interval):
+    while True:
+        await asyncio.sleep(interval)
+        all_status = await asyncio.gather(*[controller.aget_worker_status(address) for address in addresses])
+        for address, status in zip(addresses, all_status):
+            if status is not None:
+                controller.receive_heart_beat(address, status["queue_length"])
+
+
+async def send_request(controller, params, latencies):
+    start = time.time()
+    async for chunk in controller.aworker_api_generate_stream(params):
+        pass
+    latencies.append(time.time() - start)
+
+
+async def send_direct_request(controller, params, latencies):
+    start = time.time()
+    worker_addr, request_id = controller.dispatch(params["model"])
+    first_token_time, num_tokens, success = None, 0, False
+    try:
+        async with controller.get_client().stream("POST", worker_addr + "/worker_generate_stream", json=params) as response:
+            async for chunk in response.aiter_bytes():
+                if first_token_time is None:
+                    first_token_time = time.time()
+                num_tokens += chunk.count(b"\0")
+        success = True
+    finally:
+        controller.report_request(request_id, None if first_token_time is None else first_token_time - start,
+                                  num_tokens, 0 if first_token_time is None else time.time() - first_token_time, success)
+    latencies.append(time.time() - start)
+
+
+async def run(dispatch_method, addresses, args):
+    controller = Controller(dispatch_method)
+    for address in addresses:
+        controller.add_worker(address, False, await controller.aget_worker_status(address))
+    heart_beat_task = asyncio.create_task(simulate_heart_beats(controller, addresses, args.heart_beat_interval))
+
+    rng = np.random.default_rng(args.seed)
+    params = {"model": "stub", "prompt": "", "max_new_tokens": args.num_tokens, "stream_mode": "delta"}
+    latencies, tasks = [], []
+    start = time.time()
+    for _ in range(args.num_requests):
+        await asyncio.sleep(rng.exponential(1.0 / args.request_rate))
+        send = send_direct_request if args.direct else send_request
+        tasks.append(asyncio.create_task(send(controller, params, latencies)))
+    await asyncio.gather(*tasks)
+    duration = time.time() - start
+
+    heart_beat_task.cancel()
+    await controller.close()
+    return latencies, duration
+
+
+def main(args):
+    worker_specs = args.workers.split(",")
+    processes, addresses = start_stub_workers(worker_specs, args.base_port, args.num_tokens, args.concurrency)
+    try:
+        print(f"{len(addresses)} stub workers (prefill_latency:tokens_per_second): {worker_specs}, "
+              f"{args.num_requests} requests at {args.request_rate} requests/s")
+        for dispatch_method in args.dispatch_methods.split(","):
+            latencies, duration = asyncio.run(run(dispatch_method, addresses, args))
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            print(f"{dispatch_method:>16}: mean {np.mean(latencies):.3f}s, p50 {p50:.3f}s, p90 {p90:.3f}s, "
+                  f"p99 {p99:.3f}s, throughput {len(latencies) / duration:.2f} requests/s")
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the tail latency of the dispatch methods with stub workers.')
+
+    parser.add_argument("--workers", type=str, default="0.1:50,0.1:50,0.1:50,0.4:15",
+                        help="Comma separated prefill_latency:tokens_per_second of each stub worker.")
+    parser.add_argument("--dispatch-methods", type=str, default="lottery,shortest_queue,power_of_two")
+    parser.add_argument("--base-port", type=int, default=31002)
+    parser.add_argument("--num-tokens", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests a stub worker serves at a time.")
+    parser.add_argument("--request-rate", type=float, default=3.5)
+    parser.add_argument("--num-requests", type=int, default=400)
+    parser.add_argument("--heart-beat-interval", type=float, default=WORKER_HEART_BEAT_INTERVAL)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--direct", action="store_true", help="Stream from the workers directly and report the requests, instead of proxying.")
+    args = parser.parse_args()
+
+    main(args)
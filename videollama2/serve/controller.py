@@ -4,16 +4,20 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import bisect
 import dataclasses
+import hashlib
 from enum import Enum, auto
 import json
 import logging
 import time
-from typing import List, Union
+import uuid
+from typing import List, Optional, Union
 import threading
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+import httpx
 import numpy as np
 import requests
 import uvicorn
@@ -28,6 +32,8 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    POWER_OF_TWO = auto()
+    VIDEO_AFFINITY = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +41,10 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
+        elif name == "video_affinity":
+            return cls.VIDEO_AFFINITY
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -48,18 +58,136 @@ class WorkerInfo:
     last_heart_beat: str
 
 
+@dataclasses.dataclass
+class WorkerStats:
+    """Load and latency of a worker as seen by the controller.
+
+    `in_flight` counts the requests dispatched to the worker which are still streaming, the
+    other fields are EWMAs over the completed streams (None until the first one completes).
+    """
+    in_flight: int = 0
+    first_token_latency: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    num_tokens: Optional[float] = None
+
+    def update(self, first_token_latency: float, num_tokens: int, decode_time: float, alpha: float):
+        def ewma(old, new):
+            return new if old is None else (1 - alpha) * old + alpha * new
+
+        self.first_token_latency = ewma(self.first_token_latency, first_token_latency)
+        self.num_tokens = ewma(self.num_tokens, num_tokens)
+        if num_tokens > 1 and decode_time > 0:
+            self.tokens_per_second = ewma(self.tokens_per_second, (num_tokens - 1) / decode_time)
+
+    def service_time(self):
+        """Estimated time to serve one request alone, None if unknown."""
+        if self.first_token_latency is None:
+            return None
+        if self.tokens_per_second is None:
+            return self.first_token_latency
+        return self.first_token_latency + self.num_tokens / self.tokens_per_second
+
+
+class ConsistentHashRing:
+    """Consistent hashing of keys onto workers, each worker owns `num_replicas` virtual nodes.
+
+    When a worker joins or leaves, only the keys of its virtual nodes move to other workers.
+    """
+
+    def __init__(self, num_replicas: int = 128):
+        self.num_replicas = num_replicas
+        self.hashes = []
+        self.nodes = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def hash(key: str):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def __contains__(self, worker_name: str):
+        return worker_name in self.nodes
+
+    def add(self, worker_name: str):
+        with self.lock:
+            if worker_name in self.nodes:
+                return
+            for i in range(self.num_replicas):
+                h = self.hash(f"{worker_name}#{i}")
+                idx = bisect.bisect(self.hashes, h)
+                self.hashes.insert(idx, h)
+                self.nodes.insert(idx, worker_name)
+
+    def remove(self, worker_name: str):
+        with self.lock:
+            keep = [idx for idx, node in enumerate(self.nodes) if node != worker_name]
+            self.hashes = [self.hashes[idx] for idx in keep]
+            self.nodes = [self.nodes[idx] for idx in keep]
+
+    def walk(self, key: str):
+        """Return the distinct workers in ring order, starting from the owner of `key`."""
+        with self.lock:
+            hashes, nodes = self.hashes, self.nodes
+        start = bisect.bisect(hashes, self.hash(key))
+        worker_names = []
+        for idx in range(len(nodes)):
+            node = nodes[(start + idx) % len(nodes)]
+            if node not in worker_names:
+                worker_names.append(node)
+        return worker_names
+
+
+def get_media_key(params):
+    """Key of the media of a request: the "media_digest" param, the digests of its "media", otherwise a digest of the images/videos."""
+    if params.get("media_digest"):
+        return params["media_digest"]
+    if params.get("media"):
+        return ",".join(params["media"])
+    if params.get("images"):
+        return hashlib.sha1(json.dumps(params["images"]).encode("utf-8")).hexdigest()
+    return None
+
+
+def count_tokens(last_chunk, num_chunks):
+    """Number of tokens of a stream: reported by workers in the delta mode, otherwise one token per message."""
+    if last_chunk is not None:
+        try:
+            return json.loads(last_chunk).get("num_tokens", num_chunks)
+        except ValueError:
+            pass
+    return num_chunks
+
+
 def heart_beat_controller(controller):
     while True:
         time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
         controller.remove_stable_workers_by_expiration()
+        controller.remove_requests_by_expiration()
 
 
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(self, dispatch_method: str, max_connections: int = 256, worker_timeout: float = 5,
+                 ewma_alpha: float = 0.2, affinity_load_factor: float = 1.25, request_timeout: float = 600):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # Dict[str -> WorkerStats], kept when a worker registers again
+        self.worker_stats = {}
+        # NOTE: requests dispatched by `dispatch` and streamed by the clients directly from the
+        # workers, Dict[request_id -> (worker_name, dispatch time)]. They are released by
+        # `report_request`, or after `request_timeout` seconds if the client never reports.
+        self.requests = {}
+        self.request_timeout = request_timeout
+        self.ewma_alpha = ewma_alpha
+        # NOTE: for video_affinity, a worker takes a key unless it has more than `affinity_load_factor`
+        # times the average number of in-flight requests (consistent hashing with bounded loads).
+        self.ring = ConsistentHashRing()
+        self.affinity_load_factor = affinity_load_factor
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
 
+        # NOTE: the async client (of the asyncio path) is created in the event loop of the server, see `get_client`.
+        self.client = None
+        self.max_connections = max_connections
+        self.worker_timeout = worker_timeout
+
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,), daemon=True)
         self.heart_beat_thread.start()
@@ -75,12 +203,17 @@ class Controller:
 
         if not worker_status:
             worker_status = self.get_worker_status(worker_name)
+        return self.add_worker(worker_name, check_heart_beat, worker_status)
+
+    def add_worker(self, worker_name: str, check_heart_beat: bool,
+                   worker_status: dict):
         if not worker_status:
             return False
 
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
             check_heart_beat, time.time())
+        self.ring.add(worker_name)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
@@ -100,6 +233,8 @@ class Controller:
 
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
+        self.worker_stats.pop(worker_name, None)
+        self.ring.remove(worker_name)
 
     def refresh_all_workers(self):
         old_info = dict(self.worker_info)
@@ -108,6 +243,8 @@ class Controller:
         for w_name, w_info in old_info.items():
             if not self.register_worker(w_name, w_info.check_heart_beat, None):
                 logger.info(f"Remove stale worker: {w_name}")
+                self.worker_stats.pop(w_name, None)
+                self.ring.remove(w_name)
 
     def list_models(self):
         model_names = set()
@@ -117,7 +254,33 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    def get_worker_address(self, model_name: str, media_key: Optional[str] = None):
+        if self.dispatch_method == DispatchMethod.VIDEO_AFFINITY and media_key:
+            worker_names = [w_name for w_name in self.ring.walk(media_key)
+                            if w_name in self.worker_info and model_name in self.worker_info[w_name].model_names]
+            if len(worker_names) == 0:
+                return ""
+            # NOTE: the owner of the key takes the request unless it is overloaded, then the next
+            # workers on the ring, so a hot video spills over to the same few workers.
+            total_in_flight = sum(self.get_worker_stats(w_name).in_flight for w_name in worker_names)
+            capacity = np.ceil(self.affinity_load_factor * (total_in_flight + 1) / len(worker_names))
+            w_name = next((w_name for w_name in worker_names if self.get_worker_stats(w_name).in_flight < capacity), worker_names[0])
+            logger.info(f"media_key: {media_key}, owner: {worker_names[0]}, capacity: {capacity}, ret: {w_name}")
+            return w_name
+
+        if self.dispatch_method in [DispatchMethod.POWER_OF_TWO, DispatchMethod.VIDEO_AFFINITY]:
+            # requests without media are dispatched by load and latency
+            worker_names = [w_name for w_name, w_info in self.worker_info.items() if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            # NOTE: compare two random workers instead of all of them, which avoids herding every
+            # request onto the same worker when the estimates are stale or equal.
+            candidates = np.random.choice(len(worker_names), min(2, len(worker_names)), replace=False)
+            completion_times = [self.estimate_completion_time(worker_names[idx]) for idx in candidates]
+            w_name = worker_names[candidates[int(np.argmin(completion_times))]]
+            logger.info(f"names: {[worker_names[idx] for idx in candidates]}, completion_times: {completion_times}, ret: {w_name}")
+            return w_name
+
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
@@ -170,6 +333,80 @@ class Controller:
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
+    def get_worker_stats(self, worker_name: str):
+        if worker_name not in self.worker_stats:
+            self.worker_stats[worker_name] = WorkerStats()
+        return self.worker_stats[worker_name]
+
+    def estimate_completion_time(self, worker_name: str):
+        """Estimated time until a new request dispatched to `worker_name` completes.
+
+        The worker serves its queued requests and the new one at its EWMA service time (the mean
+        over the other workers if it has not completed any stream yet, 1 if no worker has). The
+        queue is the larger of the in-flight requests seen by the controller and the queue length
+        of the last heart beat, which also counts the requests the controller does not track.
+        """
+        service_time = self.get_worker_stats(worker_name).service_time()
+        if service_time is None:
+            known = [stats.service_time() for stats in self.worker_stats.values() if stats.service_time() is not None]
+            service_time = float(np.mean(known)) if len(known) > 0 else 1.0
+        w_info = self.worker_info[worker_name]
+        queue_length = max(self.get_worker_stats(worker_name).in_flight, w_info.queue_length)
+        return (queue_length + 1) * service_time / w_info.speed
+
+    def dispatch(self, model_name: str, media_key: Optional[str] = None):
+        """Choose a worker for a request that the client streams directly from the worker.
+
+        Returns:
+            (worker_name, request_id): the client reports the end of the stream with `request_id`
+                to `report_request`. The worker name is "" (and the request id None) if no worker serves `model_name`.
+        """
+        worker_name = self.get_worker_address(model_name, media_key)
+        if not worker_name:
+            return "", None
+        request_id = uuid.uuid4().hex
+        self.requests[request_id] = (worker_name, time.time())
+        self.start_request(worker_name)
+        return worker_name, request_id
+
+    def report_request(self, request_id: str, first_token_latency: Optional[float], num_tokens: int,
+                       decode_time: float, success: bool):
+        """Release a request of `dispatch` with the measurements of its stream made by the client."""
+        if request_id not in self.requests:
+            return False
+        worker_name, _ = self.requests.pop(request_id)
+        self.release_request(worker_name, first_token_latency, num_tokens, decode_time, success)
+        return True
+
+    def remove_requests_by_expiration(self):
+        expire = time.time() - self.request_timeout
+        for request_id, (worker_name, dispatch_time) in list(self.requests.items()):
+            if dispatch_time < expire:
+                logger.info(f"Release unreported request: {request_id}, {worker_name}")
+                self.requests.pop(request_id, None)
+                self.release_request(worker_name, None, 0, 0, False)
+
+    def start_request(self, worker_name: str):
+        self.get_worker_stats(worker_name).in_flight += 1
+
+    def finish_request(self, worker_name: str, start_time: float, first_token_time: Optional[float],
+                       num_tokens: int, success: bool):
+        """Release a request of `worker_name` proxied by the controller, which timed its stream."""
+        first_token_latency = None if first_token_time is None else first_token_time - start_time
+        decode_time = 0 if first_token_time is None else time.time() - first_token_time
+        self.release_request(worker_name, first_token_latency, num_tokens, decode_time, success)
+
+    def release_request(self, worker_name: str, first_token_latency: Optional[float], num_tokens: int,
+                        decode_time: float, success: bool):
+        """Release a request of `worker_name` and update the latency/throughput of the worker with the completed stream."""
+        if worker_name not in self.worker_stats:
+            # the worker was removed meanwhile
+            return
+        stats = self.worker_stats[worker_name]
+        stats.in_flight = max(stats.in_flight - 1, 0)
+        if success and first_token_latency is not None:
+            stats.update(first_token_latency, num_tokens, decode_time, self.ewma_alpha)
+
     def receive_heart_beat(self, worker_name: str, queue_length: int):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
@@ -191,7 +428,7 @@ class Controller:
             self.remove_worker(worker_name)
 
     def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+        worker_addr = self.get_worker_address(params["model"], get_media_key(params))
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
@@ -199,13 +436,20 @@ class Controller:
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
+        start_time, first_token_time, num_chunks, last_chunk, success = time.time(), None, 0, None, False
+        self.start_request(worker_addr)
         try:
             response = requests.post(worker_addr + "/worker_generate_stream",
                 json=params, stream=True, timeout=5)
             for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
                 if chunk:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    num_chunks, last_chunk = num_chunks + 1, chunk
                     yield chunk + b"\0"
+            success = True
         except requests.exceptions.RequestException as e:
             logger.info(f"worker timeout: {worker_addr}")
             ret = {
@@ -213,6 +457,8 @@ class Controller:
                 "error_code": 3,
             }
             yield json.dumps(ret).encode() + b"\0"
+        finally:
+            self.finish_request(worker_addr, start_time, first_token_time, count_tokens(last_chunk, num_chunks), success)
 
 
     # Let the controller act as a worker to achieve hierarchical
@@ -235,21 +481,136 @@ class Controller:
             "queue_length": queue_length,
         }
 
+    # The asyncio path used by the server: the workers are reached through one pooled
+    # keep-alive client and status checks of all workers run concurrently, so that proxied
+    # streams and fan-outs never hold a threadpool thread or open a connection per request.
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.worker_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections))
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def aget_worker_status(self, worker_name: str):
+        try:
+            r = await self.get_client().post(worker_name + "/worker_get_status")
+        except httpx.HTTPError as e:
+            logger.error(f"Get status fails: {worker_name}, {e}")
+            return None
+
+        if r.status_code != 200:
+            logger.error(f"Get status fails: {worker_name}, {r}")
+            return None
+
+        return r.json()
+
+    async def aregister_worker(self, worker_name: str, check_heart_beat: bool,
+                               worker_status: dict):
+        if worker_name not in self.worker_info:
+            logger.info(f"Register a new worker: {worker_name}")
+        else:
+            logger.info(f"Register an existing worker: {worker_name}")
+
+        if not worker_status:
+            worker_status = await self.aget_worker_status(worker_name)
+        return self.add_worker(worker_name, check_heart_beat, worker_status)
+
+    async def arefresh_all_workers(self):
+        old_info = dict(self.worker_info)
+
+        # NOTE: keep dispatching to the known workers while their status is being checked.
+        worker_names = list(old_info.keys())
+        all_status = await asyncio.gather(*[self.aget_worker_status(w_name) for w_name in worker_names])
+        for w_name, worker_status in zip(worker_names, all_status):
+            self.worker_info.pop(w_name, None)
+            if not self.add_worker(w_name, old_info[w_name].check_heart_beat, worker_status):
+                logger.info(f"Remove stale worker: {w_name}")
+                self.worker_stats.pop(w_name, None)
+                self.ring.remove(w_name)
+
+    async def aworker_api_generate_stream(self, params):
+        worker_addr = self.get_worker_address(params["model"], get_media_key(params))
+        if not worker_addr:
+            logger.info(f"no worker: {params['model']}")
+            ret = {
+                "text": server_error_msg,
+                "error_code": 2,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+            return
+
+        start_time, first_token_time, num_chunks, last_chunk, success = time.time(), None, 0, None, False
+        self.start_request(worker_addr)
+        try:
+            async with self.get_client().stream("POST", worker_addr + "/worker_generate_stream", json=params) as response:
+                buffer = b""
+                async for data in response.aiter_bytes():
+                    # NOTE: forward complete messages only, they are delimited by b"\0".
+                    *chunks, buffer = (buffer + data).split(b"\0")
+                    for chunk in chunks:
+                        if chunk:
+                            if first_token_time is None:
+                                first_token_time = time.time()
+                            num_chunks, last_chunk = num_chunks + 1, chunk
+                            yield chunk + b"\0"
+                if buffer:
+                    num_chunks, last_chunk = num_chunks + 1, buffer
+                    yield buffer + b"\0"
+            success = True
+        except httpx.HTTPError as e:
+            logger.info(f"worker timeout: {worker_addr}")
+            ret = {
+                "text": server_error_msg,
+                "error_code": 3,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+        finally:
+            self.finish_request(worker_addr, start_time, first_token_time, count_tokens(last_chunk, num_chunks), success)
+
+    async def aworker_api_get_status(self):
+        model_names = set()
+        speed = 0
+        queue_length = 0
+
+        all_status = await asyncio.gather(*[self.aget_worker_status(w_name) for w_name in list(self.worker_info)])
+        for worker_status in all_status:
+            if worker_status is not None:
+                model_names.update(worker_status["model_names"])
+                speed += worker_status["speed"]
+                queue_length += worker_status["queue_length"]
+
+        return {
+            "model_names": list(model_names),
+            "speed": speed,
+            "queue_length": queue_length,
+        }
+
 
 app = FastAPI()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await controller.close()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.aregister_worker(
         data["worker_name"], data["check_heart_beat"],
         data.get("worker_status", None))
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    await controller.arefresh_all_workers()
 
 
 @app.post("/list_models")
@@ -261,10 +622,24 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    # NOTE: clients which stream from the worker directly ask for a request id with "report",
+    # and post the measurements of the stream to /report_request when it ends.
+    if data.get("report", False):
+        addr, request_id = controller.dispatch(data["model"], data.get("media_digest", None))
+        return {"address": addr, "request_id": request_id}
+    addr = controller.get_worker_address(data["model"], data.get("media_digest", None))
     return {"address": addr}
 
 
+@app.post("/report_request")
+async def report_request(request: Request):
+    data = await request.json()
+    exist = controller.report_request(
+        data["request_id"], data.get("first_token_latency", None), data.get("num_tokens", 0),
+        data.get("decode_time", 0), data.get("success", False))
+    return {"exist": exist}
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
@@ -276,13 +651,13 @@ async def receive_heart_beat(request: Request):
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
     params = await request.json()
-    generator = controller.worker_api_generate_stream(params)
+    generator = controller.aworker_api_generate_stream(params)
     return StreamingResponse(generator)
 
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.aworker_api_get_status()
 
 
 if __name__ == "__main__":
@@ -290,9 +665,16 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "power_of_two", "video_affinity"], default="shortest_queue")
+    parser.add_argument("--max-connections", type=int, default=256, help="Size of the keep-alive connection pool to the workers.")
+    parser.add_argument("--worker-timeout", type=float, default=5)
+    parser.add_argument("--ewma-alpha", type=float, default=0.2, help="Weight of the last stream in the latency estimates of power_of_two.")
+    parser.add_argument("--affinity-load-factor", type=float, default=1.25, help="Maximum in-flight requests of a worker relative to the average with video_affinity.")
+    parser.add_argument("--request-timeout", type=float, default=600, help="Seconds after which a dispatched request that was never reported is released.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, max_connections=args.max_connections, worker_timeout=args.worker_timeout,
+                            ewma_alpha=args.ewma_alpha, affinity_load_factor=args.affinity_load_factor,
+                            request_timeout=args.request_timeout)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
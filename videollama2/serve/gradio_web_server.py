@@ -1,6 +1,7 @@
 import os
 import json
 import time
+import base64
 import hashlib
 import requests
 import argparse
@@ -13,12 +14,15 @@ from decord import VideoReader, cpu
 from videollama2.constants import LOGDIR, NUM_FRAMES
 from videollama2.conversation import (default_conversation, conv_templates,SeparatorStyle)
 from videollama2.utils import (build_logger, server_error_msg, violates_moderation, moderation_msg)
+from videollama2.serve.media_store import HTTPBlobStore, upload_media, upload_bytes
 
 
 logger = build_logger("gradio_web_server", "gradio_web_server.log")
 
 headers = {"User-Agent": "Videollama2 Client"}
 
+media_store = None
+
 no_change_btn = gr.Button.update()
 enable_btn = gr.Button.update(interactive=True)
 disable_btn = gr.Button.update(interactive=False)
@@ -45,6 +49,24 @@ def get_model_list():
     return models
 
 
+def report_request(request_id, start_time, first_token_time, num_tokens, paused, success):
+    """Report a stream served directly by the worker to the controller, which tracks the load and latency of the workers.
+
+    `paused` seconds of the stream were spent sleeping between the UI updates, not waiting for the worker.
+    """
+    if request_id is None:
+        return
+    try:
+        requests.post(args.controller_url + "/report_request", json={
+            "request_id": request_id,
+            "first_token_latency": None if first_token_time is None else first_token_time - start_time,
+            "num_tokens": num_tokens,
+            "decode_time": 0 if first_token_time is None else max(time.time() - first_token_time - paused, 0),
+            "success": success}, timeout=5)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"report request error: {e}")
+
+
 get_window_url_params = """
 function() {
     const params = new URLSearchParams(window.location.search);
@@ -256,19 +278,6 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         new_state.modality = state.modality
         state = new_state
 
-    # Query worker address
-    controller_url = args.controller_url
-    ret = requests.post(controller_url + "/get_worker_address",
-            json={"model": model_name})
-    worker_addr = ret.json()["address"]
-    logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
-
-    # No available worker
-    if worker_addr == "":
-        state.messages[-1][-1] = server_error_msg
-        yield (state, state.to_gradio_chatbot(), disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-        return
-
     # Construct prompt
     prompt = state.get_prompt()
     if state.modality == "image" or state.modality == "image_text":
@@ -296,6 +305,7 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE] else state.sep2,
         #"images": f'List of {len(state.get_images())} images: {all_image_hash}',
         "images": f'List of {len(all_image_hash)} images: {all_image_hash}',
+        "stream_mode": "delta",
     }
     logger.info(f"==== request ====\n{pload}")
 
@@ -304,18 +314,53 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
     elif state.modality == "video" or state.modality == "video_text":
         pload['images'] = state.get_videos()
 
+    # NOTE: upload the media once and reference them by digest, instead of base64 images or video paths in the JSON.
+    if media_store is not None:
+        if state.modality == "image" or state.modality == "image_text":
+            pload['media'] = [upload_bytes(media_store, base64.b64decode(image)) for image in pload['images']]
+        else:
+            pload['media'] = [upload_media(media_store, video) for video in pload['images']]
+        del pload['images']
+
+    # Query worker address
+    # NOTE: the digests of the media let the video_affinity dispatch send the same media to the same worker.
+    media_digest = ",".join(pload["media"]) if "media" in pload else ",".join(all_image_hash) or None
+    controller_url = args.controller_url
+    ret = requests.post(controller_url + "/get_worker_address",
+            json={"model": model_name, "media_digest": media_digest, "report": True})
+    worker_addr = ret.json()["address"]
+    request_id = ret.json().get("request_id", None)
+    logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
+
+    # No available worker
+    if worker_addr == "":
+        state.messages[-1][-1] = server_error_msg
+        yield (state, state.to_gradio_chatbot(), disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+        return
+
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
+    # NOTE: the stream does not go through the controller, report it so that the controller knows the load of the worker.
+    request_start, first_token_time, num_tokens, paused, success = time.time(), None, 0, 0.0, False
     try:
         # Stream output
         response = requests.post(worker_addr + "/worker_generate_stream",
             headers=headers, json=pload, stream=True, timeout=10)
+        output_text = ""
         for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
             if chunk:
                 data = json.loads(chunk.decode())
                 if data["error_code"] == 0:
-                    output = data["text"][len(prompt):].strip()
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    num_tokens = data.get("num_tokens", num_tokens + 1)
+                    # NOTE: workers without the delta mode stream the full text.
+                    if data.get("delta", False):
+                        output_text += data["text"]
+                    else:
+                        output_text = data["text"][len(prompt):]
+                    output = output_text.strip()
                     state.messages[-1][-1] = output + "▌"
                     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
                 else:
@@ -324,10 +369,14 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
                     yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
                     return
                 time.sleep(0.03)
+                paused += 0.03
+        success = True
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
         return
+    finally:
+        report_request(request_id, request_start, first_token_time, num_tokens, paused, success)
 
     state.messages[-1][-1] = state.messages[-1][-1][:-1]
     yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
@@ -482,9 +531,13 @@ if __name__ == "__main__":
     parser.add_argument("--share", action="store_true")
     parser.add_argument("--moderate", action="store_true")
     parser.add_argument("--embed", action="store_true")
+    parser.add_argument("--media-server-url", type=str, default=None, help="Upload the images/videos to this media server and send their digests to the workers.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
+    if args.media_server_url is not None:
+        media_store = HTTPBlobStore(args.media_server_url)
+
     models = get_model_list()
 
     logger.info(args)
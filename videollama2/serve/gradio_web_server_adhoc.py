@@ -1,6 +1,8 @@
 # import spaces
 
 import os
+import uuid
+from collections import OrderedDict
 
 import torch
 import gradio as gr
@@ -11,6 +13,7 @@ from videollama2.constants import MMODAL_TOKEN_INDEX, DEFAULT_MMODAL_TOKEN
 from videollama2.conversation import conv_templates, SeparatorStyle, Conversation
 from videollama2.model.builder import load_pretrained_model
 from videollama2.mm_utils import KeywordsStoppingCriteria, tokenizer_MMODAL_token, get_model_name_from_path, process_image, process_video
+from videollama2.mm_cache import LRUCache
 
 
 title_markdown = ("""
@@ -74,8 +77,19 @@ plum_color = gr.themes.colors.Color(
 )
 
 
+def to_device(value, device):
+    """Move the tensors in a (nested) tuple/list/dict to `device`."""
+    if isinstance(value, torch.Tensor):
+        return value.to(device, non_blocking=True)
+    elif isinstance(value, (tuple, list)):
+        return type(value)(to_device(x, device) for x in value)
+    elif isinstance(value, dict):
+        return {k: to_device(v, device) for k, v in value.items()}
+    return value
+
+
 class Chat:
-    def __init__(self, model_path, conv_mode, model_base=None, load_8bit=False, load_4bit=False):
+    def __init__(self, model_path, conv_mode, model_base=None, load_8bit=False, load_4bit=False, max_sessions=4, max_offload_size=16 << 30):
         # disable_torch_init()
         model_name = get_model_name_from_path(model_path)
         self.tokenizer, self.model, processor, context_len = load_pretrained_model(
@@ -86,15 +100,104 @@ class Chat:
         self.conv_mode = conv_mode
         self.conv = conv_templates[conv_mode].copy()
 
+        # NOTE: the media tensors and key/value states of the latest `max_sessions` sessions stay on the
+        # model device, less recently used sessions are offloaded to cpu (up to `max_offload_size` bytes).
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.offloaded_sessions = LRUCache(max_offload_size)
+
     def get_prompt(self, qs, state):
         state.append_message(state.roles[0], qs)
         state.append_message(state.roles[1], None)
         return state
 
+    def load_session(self, session_id, media_key):
+        """Get the cached session of `session_id`, None if missing or the media of the session changed."""
+        if session_id is None:
+            return None
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            session = self.sessions[session_id]
+        else:
+            session = self.offloaded_sessions.pop(session_id)
+            if session is None:
+                return None
+            session = to_device(session, self.model.device)
+            self.save_session(session_id, session)
+        if session['media_key'] != media_key:
+            self.drop_session(session_id)
+            return None
+        return session
+
+    def save_session(self, session_id, session):
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            evicted_id, evicted_session = self.sessions.popitem(last=False)
+            self.offloaded_sessions.put(evicted_id, to_device(evicted_session, 'cpu'))
+
+    def drop_session(self, session_id):
+        self.sessions.pop(session_id, None)
+        self.offloaded_sessions.pop(session_id)
+
+    def get_session_media(self, session_id, media_key):
+        """Reuse the preprocessed media of a session, so that the image/video is decoded only once per chat."""
+        session = self.load_session(session_id, media_key)
+        if session is None:
+            return None
+        return session['tensor'], session['modals']
+
+    def prepare_session_inputs(self, session, input_ids):
+        """Truncate the cached key/value states to the longest common prefix with the new prompt.
+
+        Returns:
+            tuple: (input_ids, attention_mask, past_key_values) where only the ids after the cache are
+                prefilled, or None if the cache does not cover the visual tokens of the prompt.
+        """
+        if session is None:
+            return None
+        cached_ids = session['input_ids']
+        # NOTE: keep at least one id of the prompt to prefill
+        length = min(len(cached_ids), input_ids.shape[1] - 1)
+        mismatch = torch.nonzero(cached_ids[:length] != input_ids[0, :length])
+        common_len = int(mismatch[0]) if len(mismatch) > 0 else length
+        if common_len <= session['modal_index']:
+            return None
+
+        # NOTE: the cache is longer than the ids by the visual tokens that replace the modal token
+        past_len = common_len + session['visual_offset']
+        past_key_values = tuple(
+            tuple(x[:, :, :past_len] for x in layer_past)
+            for layer_past in session['past_key_values']
+        )
+        input_ids = torch.cat([
+            torch.zeros((1, past_len), dtype=input_ids.dtype, device=input_ids.device),
+            input_ids[:, common_len:]
+        ], dim=1)
+        return input_ids, torch.ones_like(input_ids), past_key_values
+
+    def update_session(self, session_id, media_key, tensor, modals, input_ids, output_ids, past_key_values):
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            past_key_values = past_key_values.to_legacy_cache()
+        # NOTE: the last generated token is never fed to the model, so it is not in the cache
+        cached_ids = torch.cat([input_ids[0], output_ids[0, :-1]])
+        modal_index = torch.nonzero(torch.isin(cached_ids, torch.tensor([MMODAL_TOKEN_INDEX[modal] for modal in modals], device=cached_ids.device)))
+        if past_key_values is None or len(modal_index) == 0:
+            self.drop_session(session_id)
+            return
+        self.save_session(session_id, {
+            'media_key': media_key,
+            'tensor': tensor,
+            'modals': modals,
+            'input_ids': cached_ids,
+            'modal_index': int(modal_index[-1]),
+            'visual_offset': past_key_values[0][0].shape[2] - len(cached_ids),
+            'past_key_values': past_key_values,
+        })
+
     # @spaces.GPU(duration=120)
     @torch.inference_mode()
-    def generate(self, tensor: list, modals: list, prompt: str, first_run: bool, state, temperature, top_p, max_output_tokens):
-        # TODO: support multiple turns of conversation.
+    def generate(self, tensor: list, modals: list, prompt: str, first_run: bool, state, temperature, top_p, max_output_tokens, session_id=None, media_key=None):
         assert len(tensor) == len(modals)
 
         # 1. prepare model, tokenizer, and processor.
@@ -107,24 +210,38 @@ class Chat:
         input_ids = tokenizer_MMODAL_token(prompt, tokenizer, MMODAL_TOKEN_INDEX[modals[0]], return_tensors='pt')
         input_ids = input_ids.unsqueeze(0).to(self.model.device)
 
+        # NOTE: continue from the key/value states of the previous turns, only the new message is prefilled.
+        session_inputs = self.prepare_session_inputs(self.load_session(session_id, media_key), input_ids)
+        if session_inputs is not None:
+            generate_ids, attention_mask, past_key_values = session_inputs
+            X_kwargs = {'past_key_values': past_key_values}
+        else:
+            generate_ids, attention_mask = input_ids, torch.ones_like(input_ids)
+            X_kwargs = {'images_or_videos': tensor, 'modal_list': modals}
+
         # 3. generate response according to visual signals and prompts. 
         stop_str = self.conv.sep if self.conv.sep_style in [SeparatorStyle.SINGLE] else self.conv.sep2
         # keywords = ["<s>", "</s>"]
         keywords = [stop_str]
-        stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
+        stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, generate_ids)
 
         with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images_or_videos=tensor,
-                modal_list=modals,
+            outputs = model.generate(
+                generate_ids,
+                attention_mask=attention_mask,
                 do_sample=True,
                 temperature=temperature,
                 top_p=top_p,
                 max_new_tokens=max_output_tokens,
                 use_cache=True,
                 stopping_criteria=[stopping_criteria],
+                return_dict_in_generate=True,
+                **X_kwargs,
             )
+        output_ids = outputs.sequences
+
+        if session_id is not None:
+            self.update_session(session_id, media_key, tensor, modals, input_ids, output_ids, outputs.past_key_values)
 
         outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0]
         print(outputs)
@@ -150,34 +267,46 @@ def generate(image, video, state, state_, textbox_in, temperature, top_p, max_ou
     if type(state) is not Conversation:
         state = conv_templates[conv_mode].copy()
         state_ = conv_templates[conv_mode].copy()
+    if not hasattr(state_, 'session_id'):
+        state_.session_id = uuid.uuid4().hex
 
-    first_run = False if len(state.messages) > 0 else True
+    first_run = False if len(state_.messages) > 0 else True
 
     text_en_in = textbox_in.replace("picture", "image")
 
     num_frames = handler.model.config.num_frames if hasattr(handler.model.config, "num_frames") else NUM_FRAMES
 
     processor = handler.processor
-    if os.path.exists(image) and not os.path.exists(video):
-        tensor.append(process_image(image, processor).to(handler.model.device, dtype=dtype))
-        modals.append('IMAGE')
-    if not os.path.exists(image) and os.path.exists(video):
-        tensor.append(process_video(video, processor, num_frames=num_frames, sample_scheme='fps').to(handler.model.device, dtype=dtype))
-        modals.append('VIDEO')
+    media_key = (image, video)
+    session_media = handler.get_session_media(state_.session_id, media_key)
+    if session_media is not None:
+        tensor, modals = session_media
+    else:
+        if os.path.exists(image) and not os.path.exists(video):
+            tensor.append(process_image(image, processor).to(handler.model.device, dtype=dtype))
+            modals.append('IMAGE')
+        if not os.path.exists(image) and os.path.exists(video):
+            tensor.append(process_video(video, processor, num_frames=num_frames, sample_scheme='fps').to(handler.model.device, dtype=dtype))
+            modals.append('VIDEO')
     if os.path.exists(image) and os.path.exists(video):
         raise NotImplementedError("Not support image and video at the same time")
 
+    # NOTE: the modal token is only inserted into the first message, the following turns refer to the same media.
+    if not first_run:
+        for modal_token in DEFAULT_MMODAL_TOKEN.values():
+            text_en_in = text_en_in.replace(modal_token, '').strip()
     # BUG: Only support single video and image inference now.
-    if os.path.exists(image) and not os.path.exists(video):
+    elif os.path.exists(image) and not os.path.exists(video):
         text_en_in = text_en_in.replace(DEFAULT_MMODAL_TOKEN['IMAGE'], '').strip()
         text_en_in = DEFAULT_MMODAL_TOKEN['IMAGE'] + '\n' + text_en_in
-    if not os.path.exists(image) and os.path.exists(video):
+    elif not os.path.exists(image) and os.path.exists(video):
         text_en_in = text_en_in.replace(DEFAULT_MMODAL_TOKEN['VIDEO'], '').strip()
         text_en_in = DEFAULT_MMODAL_TOKEN['VIDEO'] + '\n' + text_en_in
-    if os.path.exists(image) and os.path.exists(video):
+    elif os.path.exists(image) and os.path.exists(video):
         text_en_in = text_en_in.replace(DEFAULT_MMODAL_TOKEN['VIDEO'], '').strip()
         text_en_in = DEFAULT_MMODAL_TOKEN['VIDEO'] + '\n' + text_en_in
-    text_en_out, state_ = handler.generate(tensor, modals, text_en_in, first_run=first_run, state=state_, temperature=temperature, top_p=top_p, max_output_tokens=max_output_tokens)
+    text_en_out, state_ = handler.generate(tensor, modals, text_en_in, first_run=first_run, state=state_, temperature=temperature, top_p=top_p, max_output_tokens=max_output_tokens,
+                                           session_id=state_.session_id, media_key=media_key)
     state_.messages[-1] = (state_.roles[1], text_en_out)
 
     text_en_out = text_en_out.split('#')[0]
@@ -192,10 +321,6 @@ def generate(image, video, state, state_, textbox_in, temperature, top_p, max_ou
     state.append_message(state.roles[0], textbox_in + "\n" + show_images)
     state.append_message(state.roles[1], textbox_out)
 
-    # BUG: only support single turn conversation now.
-    state_.messages.pop(-1)
-    state_.messages.pop(-1)
-
     return (gr.update(value=image if os.path.exists(image) else None, interactive=True), 
             gr.update(value=video if os.path.exists(video) else None, interactive=True), 
             state.to_gradio_chatbot(), state, state_)
@@ -204,12 +329,17 @@ def generate(image, video, state, state_, textbox_in, temperature, top_p, max_ou
 def regenerate(state, state_):
     state.messages.pop(-1)
     state.messages.pop(-1)
+    # NOTE: drop the last answer, `generate` re-sends the last question with an empty textbox.
+    if len(state_.messages) > 0:
+        state_.messages.pop(-1)
     if len(state.messages) > 0:
         return state.to_gradio_chatbot(), state, state_
     return state.to_gradio_chatbot(), state, state_
 
 
 def clear_history(state, state_):
+    if hasattr(state_, 'session_id'):
+        handler.drop_session(state_.session_id)
     state = conv_templates[conv_mode].copy()
     state_ = conv_templates[conv_mode].copy()
     return (gr.update(value=None, interactive=True),
@@ -0,0 +1,327 @@
+"""
+A content-addressed store of the media (images/videos) of the requests.
+
+Clients upload a file once to the media server (a streaming multipart upload) and reference
+it by its sha1 digest in the `"media"` param of the requests, instead of inlining base64
+images in the JSON or passing video paths which must exist on the worker. Workers fetch the
+blobs they do not have yet into a local cache.
+
+Backends:
+    LocalBlobStore: blobs on a local (or shared) filesystem, also the cache of the workers.
+    HTTPBlobStore: client of a media server started with
+        python3 -m videollama2.serve.media_store --port 21003 --root media
+"""
+import io
+import os
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+
+from videollama2.utils import build_logger
+from videollama2.mm_cache import file_digest
+
+
+CHUNK_SIZE = 1 << 20
+
+logger = build_logger("media_store", "media_store.log")
+
+
+def is_digest(digest):
+    return isinstance(digest, str) and len(digest) == 40 and all(c in "0123456789abcdef" for c in digest)
+
+
+class LocalBlobStore(object):
+    """Blobs on the local filesystem, stored as `root/<digest[:2]>/<digest>`.
+
+    The sizes of the blobs are indexed in memory (in least-recently-used order) when the store
+    is opened, so that the eviction keeps a running total instead of scanning the directory.
+    Blobs which are pinned (in use by a request) or were used within `min_age` seconds are
+    never evicted, so that a path returned by `MediaCache.fetch` stays valid while it is read.
+
+    Args:
+        root (str): directory of the store.
+        max_bytes (int): evict the least recently used blobs beyond this size, None to keep all.
+        min_age (float): seconds after its last use during which a blob is not evicted.
+    """
+
+    def __init__(self, root, max_bytes=None, min_age=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        # digest -> [size, last use], from the least to the most recently used
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.pins = Counter()
+        if max_bytes is not None:
+            blobs = []
+            for name in os.listdir(root):
+                folder = os.path.join(root, name)
+                if os.path.isdir(folder):
+                    for digest in os.listdir(folder):
+                        stat = os.stat(os.path.join(folder, digest))
+                        blobs.append((stat.st_mtime, digest, stat.st_size))
+            for mtime, digest, size in sorted(blobs):
+                self.index[digest] = [size, mtime]
+                self.total_bytes += size
+
+    def path(self, digest):
+        if not is_digest(digest):
+            raise ValueError(f"Invalid media digest: {digest}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, fileobj, digest=None, filename=None):
+        """Write the content of `fileobj` (read in chunks) and return its digest.
+
+        Args:
+            fileobj: binary file-like object.
+            digest (str): expected digest, checked against the content.
+            filename (str): name of the file, unused.
+        Returns:
+            str: sha1 digest of the content.
+        """
+        tmp_path = os.path.join(self.root, f"{uuid.uuid4().hex}.tmp")
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                    sha1.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if digest is not None and sha1.hexdigest() != digest:
+                raise ValueError(f"Corrupted media: expected {digest}, got {sha1.hexdigest()}")
+            path = self.path(sha1.hexdigest())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # NOTE: rename at once, so that concurrent readers never see partial blobs.
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self.lock:
+            self._use(sha1.hexdigest(), size)
+        self.evict()
+        return sha1.hexdigest()
+
+    def _use(self, digest, size=None):
+        entry = self.index.pop(digest, None)
+        if size is None:
+            size = entry[0] if entry is not None else os.path.getsize(self.path(digest))
+        self.total_bytes += size - (entry[0] if entry is not None else 0)
+        self.index[digest] = [size, time.time()]
+
+    def touch(self, digest):
+        # NOTE: mark the blob as recently used for the eviction.
+        os.utime(self.path(digest))
+        with self.lock:
+            self._use(digest)
+
+    def pin(self, digest):
+        """Protect the blob `digest` from the eviction until `unpin`, it may not be stored yet."""
+        with self.lock:
+            self.pins[digest] += 1
+
+    def unpin(self, digest):
+        with self.lock:
+            self.pins[digest] -= 1
+            if self.pins[digest] <= 0:
+                del self.pins[digest]
+
+    def open(self, digest):
+        self.touch(digest)
+        return open(self.path(digest), "rb")
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            deadline = time.time() - self.min_age
+            victims = []
+            total_bytes = self.total_bytes
+            for digest, (size, last_use) in self.index.items():
+                # NOTE: the blobs are in the order of their last use, the following ones are recent too.
+                if total_bytes <= self.max_bytes or last_use > deadline:
+                    break
+                if digest not in self.pins:
+                    victims.append(digest)
+                    total_bytes -= size
+            for digest in victims:
+                size, _ = self.index.pop(digest)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def download(self, digest, store):
+        """Copy the blob `digest` into the `LocalBlobStore` `store`."""
+        with self.open(digest) as f:
+            return store.put(f, digest=digest)
+
+
+class HTTPBlobStore(object):
+    """Client of a media server.
+
+    Args:
+        address (str): address of the media server, e.g., http://localhost:21003.
+        timeout (float): timeout of the requests.
+    """
+
+    def __init__(self, address, timeout=60):
+        self.address = address.rstrip("/")
+        self.client = httpx.Client(timeout=timeout)
+
+    def has(self, digest):
+        return self.client.head(f"{self.address}/media/{digest}").status_code == 200
+
+    def put(self, fileobj, digest=None, filename="media"):
+        """Upload the content of `fileobj` (streamed as multipart) and return its digest."""
+        r = self.client.post(f"{self.address}/upload_media", files={"file": (filename, fileobj)})
+        r.raise_for_status()
+        uploaded = r.json()["digests"][0]
+        if digest is not None and uploaded != digest:
+            raise ValueError(f"Corrupted media: expected {digest}, got {uploaded}")
+        return uploaded
+
+    def download(self, digest, store):
+        """Stream the blob `digest` into the `LocalBlobStore` `store`."""
+        with self.client.stream("GET", f"{self.address}/media/{digest}") as r:
+            r.raise_for_status()
+            return store.put(StreamReader(r.iter_bytes(CHUNK_SIZE)), digest=digest)
+
+
+class StreamReader(object):
+    """Minimal binary file-like object over an iterator of bytes."""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.iterator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def upload_media(backend, file_path):
+    """Upload a file unless the backend already has it, and return its digest."""
+    digest = file_digest(file_path)
+    if not backend.has(digest):
+        with open(file_path, "rb") as f:
+            backend.put(f, digest=digest, filename=os.path.basename(file_path))
+    return digest
+
+
+def upload_bytes(backend, data):
+    """Upload `data` unless the backend already has it, and return its digest."""
+    digest = hashlib.sha1(data).hexdigest()
+    if not backend.has(digest):
+        backend.put(io.BytesIO(data), digest=digest)
+    return digest
+
+
+class MediaCache(object):
+    """Local cache of the blobs of a backend on a worker.
+
+    Args:
+        backend (LocalBlobStore or HTTPBlobStore): where the blobs are uploaded.
+        cache_dir (str): directory of the cache, unused if the backend is a `LocalBlobStore`.
+        max_bytes (int): size of the cache.
+    """
+
+    def __init__(self, backend, cache_dir=None, max_bytes=64 << 30):
+        self.backend = backend
+        if isinstance(backend, LocalBlobStore):
+            # NOTE: the blobs are already on the local filesystem.
+            self.store = backend
+        else:
+            self.store = LocalBlobStore(cache_dir, max_bytes=max_bytes)
+        self.fetch_locks = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def use(self, digests):
+        """Pin the blobs `digests` in the local store while the block runs, e.g., a request reads them."""
+        for digest in digests:
+            self.store.pin(digest)
+        try:
+            yield
+        finally:
+            for digest in digests:
+                self.store.unpin(digest)
+
+    def fetch(self, digest):
+        """Return the local path of the blob `digest`, downloading it if needed.
+
+        The blob is not evicted for `min_age` seconds, pin it with `use` to read it for longer.
+        """
+        if self.store.has(digest):
+            self.store.touch(digest)
+            return self.store.path(digest)
+
+        # NOTE: one download per digest, concurrent requests of the same media wait for it.
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(digest, threading.Lock())
+        with fetch_lock:
+            if not self.store.has(digest):
+                self.backend.download(digest, self.store)
+        with self.lock:
+            self.fetch_locks.pop(digest, None)
+        return self.store.path(digest)
+
+
+app = FastAPI()
+
+
+@app.post("/upload_media")
+async def upload_media_api(request: Request):
+    # NOTE: the multipart body is parsed as a stream, files are spooled to disk, never held in memory.
+    form = await request.form()
+    digests = []
+    for _, upload in form.multi_items():
+        if hasattr(upload, "file"):
+            digests.append(await run_in_threadpool(store.put, upload.file))
+            await upload.close()
+    logger.info(f"Uploaded: {digests}")
+    return {"digests": digests}
+
+
+@app.head("/media/{digest}")
+@app.get("/media/{digest}")
+async def get_media(digest: str):
+    if not is_digest(digest) or not store.has(digest):
+        raise HTTPException(status_code=404)
+    return FileResponse(store.path(digest), media_type="application/octet-stream")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21003)
+    parser.add_argument("--root", type=str, default="media")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    store = LocalBlobStore(args.root)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
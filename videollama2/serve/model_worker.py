@@ -11,6 +11,7 @@ import argparse
 import threading
 from threading import Thread
 from functools import partial
+from contextlib import nullcontext
 from typing import Iterator, List, Optional, Tuple
 
 import uvicorn
@@ -22,12 +23,14 @@ import decord
 import numpy as np
 from PIL import Image
 from decord import VideoReader, cpu
-from transformers import TextIteratorStreamer
 
 from videollama2.constants import WORKER_HEART_BEAT_INTERVAL
 from videollama2.utils import (build_logger, server_error_msg, pretty_print_semaphore)
 from videollama2.model.builder import load_pretrained_model
-from videollama2.mm_utils import process_images, process_videos, load_image_from_base64, tokenizer_image_token, KeywordsStoppingCriteria, tokenizer_MMODAL_token
+from videollama2.serve.batch_engine import ContinuousBatchingEngine, TokenStreamer
+from videollama2.serve.media_store import LocalBlobStore, HTTPBlobStore, MediaCache
+from videollama2.mm_cache import set_media_key
+from videollama2.mm_utils import process_images, process_videos, load_image_from_base64, tokenizer_image_token, KeywordsStoppingCriteria, tokenizer_MMODAL_token, precompute_template_tokens
 from videollama2.mm_utils import chunk_list, frame_expansion
 from videollama2.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, DEFAULT_VIDEO_TOKEN, NUM_FRAMES, MMODAL_TOKEN_INDEX
 
@@ -57,6 +60,8 @@ else:
 KEYWORD_BLOCK_MESSAGE2 = "The output contains political, erotic and other unsafe content that violates local laws. Please re-enter your question."
 KEYWORD_BLOCK_MESSAGE1 = "Your input question contains political, erotic and other unsafe content that violates local laws. Please re-enter your question."
 STREAM_CHECK_MULTIPLE = 20
+# NOTE: a keyword may straddle two safety check windows, so each window overlaps the previous one.
+SAFETY_CHECK_OVERLAP = max([len(x) for x in KEYWORDS_LIST], default=0)
 
 
 def heart_beat_worker(controller):
@@ -82,12 +87,30 @@ def input_safety_check(text) -> Optional[str]:
     return None
 
 
+def split_stop_str(text, stop_str):
+    """Split `text` into the text which can be streamed and the tail which may be the beginning of `stop_str`.
+
+    Returns:
+        Tuple[str, str, bool]: the streamable text, the held back tail and whether `stop_str` was found.
+    """
+    if not stop_str:
+        return text, "", False
+    if stop_str in text:
+        return text[:text.index(stop_str)], "", True
+    for length in range(min(len(stop_str) - 1, len(text)), 0, -1):
+        if text.endswith(stop_str[:length]):
+            return text[:-length], text[-length:], False
+    return text, "", False
+
+
 class ModelWorker:
 
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device):
+                 load_8bit, load_4bit, device,
+                 continuous_batching=False, max_batch_size=8, fast_load=False, media_cache=None,
+                 feature_cache_size=0, prefix_cache_size=0, preprocess_backend='pil'):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -104,10 +127,25 @@ class ModelWorker:
             self.model_name = model_name
 
         self.device = device
+        self.preprocess_backend = preprocess_backend
+        # NOTE: local cache of the media referenced by digest in the requests.
+        self.media_cache = media_cache
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
-            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device)
+            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, fast_load=fast_load)
         self.is_multimodal = 'videollama2' in self.model_name.lower() or 'vlb' in self.model_name.lower()
+        # NOTE: tokenize the system prompts and separators of all conversation templates once.
+        precompute_template_tokens(self.tokenizer)
+        if feature_cache_size > 0:
+            self.model.get_vision_tower().enable_feature_cache(feature_cache_size)
+        if prefix_cache_size > 0:
+            self.model.enable_prefix_cache(prefix_cache_size)
+
+        # NOTE: with continuous batching, concurrent requests share decode steps instead of serializing on `model.generate`.
+        if continuous_batching:
+            self.engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=max_batch_size)
+        else:
+            self.engine = None
 
         if not no_register:
             self.register_to_controller()
@@ -169,6 +207,12 @@ class ModelWorker:
         prompt = params["prompt"]
         ori_prompt = prompt
         images_or_videos = params.get("images", None)
+        # NOTE: media uploaded to the media store are referenced by their digests instead of inlined.
+        media = params.get("media", None)
+        if media is not None:
+            if self.media_cache is None:
+                raise ValueError("Media referenced by digest, but the worker has no media store.")
+            images_or_videos = [self.media_cache.fetch(digest) for digest in media]
         #print("Input images:", images_or_videos)
         num_image_tokens = 0
         modal_list = []
@@ -179,7 +223,10 @@ class ModelWorker:
                 
                 try:
                     print("Load image...")
-                    images_or_videos = [load_image_from_base64(image) for image in images_or_videos]
+                    if media is not None:
+                        images_or_videos = [Image.open(image).convert('RGB') for image in images_or_videos]
+                    else:
+                        images_or_videos = [load_image_from_base64(image) for image in images_or_videos]
                     images_or_videos = process_images(images_or_videos, image_processor, model.config)
                     
                     modal_list = ["image"]
@@ -192,7 +239,7 @@ class ModelWorker:
                     if not "use_taug" in self.model_path:
                         frame_id_list = np.linspace(0, duration-1, 8, dtype=int)
                         video_frames = decord_vr.get_batch(frame_id_list).asnumpy()
-                        images_or_videos = process_videos(video_frames, image_processor, model.config)
+                        images_or_videos = process_videos(video_frames, image_processor, model.config, backend=self.preprocess_backend)
                     else:
                         print("Temporal augmentation activated!!!")
                         frame_id_list = np.linspace(0, duration-1, 8 * 2 * 2, dtype=int)
@@ -215,6 +262,9 @@ class ModelWorker:
                 else:
                     images_or_videos = images_or_videos.to(self.model.device, dtype=torch.float16)
                     if modal_list[0] == "video":
+                        # NOTE: the media digest keys the frame features of the video in the feature cache.
+                        if media is not None:
+                            set_media_key(images_or_videos, media[0])
                         print("Video:", images_or_videos.shape)
                         images_or_videos = [images_or_videos]
                     else:
@@ -260,45 +310,78 @@ class ModelWorker:
         #print("input_ids.shape:", input_ids.shape)
         keywords = [stop_str]
         stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
+        streamer = TokenStreamer(tokenizer, timeout=15)
 
         max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_image_tokens)
 
+        # NOTE: "full" streams the prompt and all the text generated so far in every message,
+        # "delta" only streams the new text (and the number of generated tokens).
+        stream_mode = params.get("stream_mode", "full")
+
         if max_new_tokens < 1:
-            yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+            if stream_mode == "delta":
+                yield json.dumps({"text": "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0, "num_tokens": 0, "delta": True, "finished": True}).encode() + b"\0"
+            else:
+                yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
-            inputs=input_ids,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            stopping_criteria=[stopping_criteria],
-            use_cache=True,
-            **image_args
-        ))
-        thread.start()
+        if self.engine is not None:
+            streamer = self.engine.submit(
+                input_ids,
+                temperature=temperature if do_sample else 0.0,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                stop_str=stop_str,
+                timeout=15,
+                **image_args
+            )
+        else:
+            thread = Thread(target=model.generate, kwargs=dict(
+                inputs=input_ids,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                stopping_criteria=[stopping_criteria],
+                use_cache=True,
+                **image_args
+            ))
+            thread.start()
 
         generated_text = ori_prompt
-        token_count = 0
+        output_text = ""
+        held_text = ""
+        checked_len = 0
+        checked_tokens = 0
         for new_text in streamer:
             generated_text += new_text
-            token_count += len(tokenizer.encode(new_text))
-            if token_count >= STREAM_CHECK_MULTIPLE:
-                safety_message = safety_check(generated_text)
+            output_text += new_text
+            if streamer.num_tokens - checked_tokens >= STREAM_CHECK_MULTIPLE:
+                # NOTE: only check the text generated since the last check (the prompt is checked by `generate_stream_gate`).
+                safety_message = safety_check(output_text[max(checked_len - SAFETY_CHECK_OVERLAP, 0):])
                 if safety_message:
-                    print('####### Keyword alarm triggered:', generated_text)
+                    print('####### Keyword alarm triggered:', output_text)
                     yield json.dumps({"text": safety_message , "error_code": 1}).encode() + b"\0"
-                    return  
-                token_count = 0  # 
-                
+                    return
+                checked_len, checked_tokens = len(output_text), streamer.num_tokens
+
+            if stream_mode == "delta":
+                delta_text, held_text, stopped = split_stop_str(held_text + new_text, stop_str)
+                if len(delta_text) > 0:
+                    yield json.dumps({"text": delta_text, "error_code": 0, "num_tokens": streamer.num_tokens, "delta": True}).encode() + b"\0"
+                if stopped:
+                    break
+                continue
 
             if generated_text.endswith(stop_str):
                 generated_text = generated_text[:-len(stop_str)]
             yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
 
+        if stream_mode == "delta":
+            # NOTE: the held back text was not the beginning of `stop_str` after all.
+            yield json.dumps({"text": held_text, "error_code": 0, "num_tokens": streamer.num_tokens, "delta": True, "finished": True}).encode() + b"\0"
+
     def generate_stream_gate(self, params):
         try:      
             input_text = params.get("prompt", "")
@@ -307,8 +390,12 @@ class ModelWorker:
                 yield json.dumps({"text": safety_message, "error_code": 1}).encode() + b"\0"
                 return
 
-            for x in self.generate_stream(params):
-                yield x
+            # NOTE: pin the media of the request, so that the media cache does not evict them while they are read.
+            media = params.get("media", None)
+            media_context = self.media_cache.use(media) if media and self.media_cache is not None else nullcontext()
+            with media_context:
+                for x in self.generate_stream(params):
+                    yield x
         except ValueError as e:
             print("Caught ValueError:", e)
             ret = {
@@ -378,9 +465,31 @@ if __name__ == "__main__":
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
+    parser.add_argument("--continuous-batching", action="store_true", help="Batch the decoding of concurrent requests in one running batch.")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--fast-load", action="store_true", help="Materialize the weights on the device directly and load the vision tower on the first request.")
+    parser.add_argument("--media-server-address", type=str, default=None, help="Media server of the media referenced by digest.")
+    parser.add_argument("--media-root", type=str, default=None, help="Local (or shared) media store, instead of a media server.")
+    parser.add_argument("--media-cache-dir", type=str, default="media_cache")
+    parser.add_argument("--media-cache-size", type=int, default=64, help="Size of the media cache in GB.")
+    parser.add_argument("--feature-cache-size", type=int, default=0, help="Cache the frame features of the vision tower in a cpu LRU of this size in GB (0 disables it).")
+    parser.add_argument("--prefix-cache-size", type=int, default=0, help="Reuse the key/value states of the system prompt and media across the questions on the same media, in a LRU of this size in GB (0 disables it, not used with --continuous-batching).")
+    parser.add_argument("--preprocess-backend", type=str, default="pil", choices=["pil", "torch"], help="Preprocess the frames of a video one by one with PIL, or as one batch with torch.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
+    if args.media_root is not None:
+        media_cache = MediaCache(LocalBlobStore(args.media_root))
+    elif args.media_server_address is not None:
+        media_cache = MediaCache(HTTPBlobStore(args.media_server_address), args.media_cache_dir, max_bytes=args.media_cache_size * GB)
+    else:
+        media_cache = None
+
+    if args.continuous_batching and args.limit_model_concurrency < args.max_batch_size:
+        # NOTE: the semaphore admits requests into the engine, it must not cap the running batch.
+        logger.info(f"Raise --limit-model-concurrency to --max-batch-size ({args.max_batch_size}) with continuous batching.")
+        args.limit_model_concurrency = args.max_batch_size
+
     if args.multi_modal:
         logger.warning("Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
 
@@ -393,5 +502,12 @@ if __name__ == "__main__":
                          args.model_name,
                          args.load_8bit,
                          args.load_4bit,
-                         args.device)
+                         args.device,
+                         continuous_batching=args.continuous_batching,
+                         max_batch_size=args.max_batch_size,
+                         fast_load=args.fast_load,
+                         media_cache=media_cache,
+                         feature_cache_size=args.feature_cache_size * GB,
+                         prefix_cache_size=args.prefix_cache_size * GB,
+                         preprocess_backend=args.preprocess_backend)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
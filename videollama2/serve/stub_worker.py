@@ -0,0 +1,144 @@
+"""
+A stub worker which speaks the model worker protocol without a model.
+
+It streams fake tokens with a configurable prefill latency and decoding speed, so that the
+controller (proxying, status fan-out, dispatch) can be tested and benchmarked locally.
+
+Usage:
+python3 -m videollama2.serve.stub_worker --port 21002 --worker-address http://localhost:21002 --controller-address http://localhost:21001
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
+
+import requests
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from videollama2.constants import WORKER_HEART_BEAT_INTERVAL
+from videollama2.utils import build_logger
+
+
+worker_id = str(uuid.uuid4())[:6]
+logger = build_logger("stub_worker", f"stub_worker_{worker_id}.log")
+
+
+def heart_beat_worker(worker):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        worker.send_heart_beat()
+
+
+class StubWorker:
+    """Fake worker: every request waits `prefill_latency` seconds, then streams `num_tokens` tokens at `tokens_per_second`.
+
+    The worker serves `concurrency` requests at a time, the other ones wait in its queue.
+    """
+
+    def __init__(self, controller_addr, worker_addr, model_name, prefill_latency=0.1,
+                 tokens_per_second=50.0, num_tokens=32, concurrency=1, no_register=False):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.model_name = model_name
+        self.prefill_latency = prefill_latency
+        self.tokens_per_second = tokens_per_second
+        self.num_tokens = num_tokens
+        self.concurrency = concurrency
+
+        self.semaphore = None
+        self.num_requests = 0
+
+        if not no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(
+                target=heart_beat_worker, args=(self,), daemon=True)
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        r = requests.post(self.controller_addr + "/register_worker", json={
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status()})
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        try:
+            ret = requests.post(self.controller_addr + "/receive_heart_beat", json={
+                "worker_name": self.worker_addr,
+                "queue_length": self.get_queue_length()}, timeout=5)
+            if not ret.json()["exist"]:
+                self.register_to_controller()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"heart beat error: {e}")
+
+    def get_queue_length(self):
+        return self.num_requests
+
+    def get_status(self):
+        return {
+            "model_names": [self.model_name],
+            "speed": 1,
+            "queue_length": self.get_queue_length(),
+        }
+
+    async def generate_stream(self, params):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        max_new_tokens = min(int(params.get("max_new_tokens", self.num_tokens)), self.num_tokens)
+        delta = params.get("stream_mode", "full") == "delta"
+
+        self.num_requests += 1
+        try:
+            async with self.semaphore:
+                await asyncio.sleep(self.prefill_latency)
+                text = params.get("prompt", "")
+                for i in range(max_new_tokens):
+                    await asyncio.sleep(1.0 / self.tokens_per_second)
+                    new_text = f" token{i}"
+                    text += new_text
+                    if delta:
+                        ret = {"text": new_text, "error_code": 0, "num_tokens": i + 1, "delta": True}
+                    else:
+                        ret = {"text": text, "error_code": 0}
+                    yield json.dumps(ret).encode() + b"\0"
+        finally:
+            self.num_requests -= 1
+
+
+app = FastAPI()
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    params = await request.json()
+    return StreamingResponse(worker.generate_stream(params))
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--model-name", type=str, default="stub")
+    parser.add_argument("--prefill-latency", type=float, default=0.1, help="Seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--num-tokens", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests served at a time.")
+    parser.add_argument("--no-register", action="store_true")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    worker = StubWorker(args.controller_address, args.worker_address, args.model_name,
+                        prefill_latency=args.prefill_latency, tokens_per_second=args.tokens_per_second,
+                        num_tokens=args.num_tokens, concurrency=args.concurrency, no_register=args.no_register)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -43,6 +43,7 @@ from transformers.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
 sys.path.append('./')
 from videollama2 import conversation as conversation_lib
 from videollama2.model import *
+from videollama2.model.multimodal_projector import save_weights
 from videollama2.constants import NUM_FRAMES, IGNORE_INDEX, MMODAL_TOKEN_INDEX, DEFAULT_MMODAL_TOKEN, DEFAULT_MMODAL_START_TOKEN, DEFAULT_MMODAL_END_TOKEN
 from videollama2.mm_utils import tokenizer_MMODAL_token, tokenizer_image_token, expand2square, process_video, process_image
 from videollama2.videollama2_trainer import (
@@ -109,6 +110,7 @@ class DataArguments:
     num_frames: Optional[int] = field(default=None)
     # Preprocess Arguments
     image_aspect_ratio: str = 'square'
+    uint8_frames: bool = field(default=False, metadata={"help": "Ship uint8 frames from the dataloader workers and normalize them on the model device."})
 
 
 @dataclass
@@ -708,7 +710,7 @@ class LazySupervisedDataset(Dataset):
             image_file = os.path.join(self.data_args.data_folder, image_file)
 
             try:
-                image = process_image(image_file, image_processor, self.data_args.image_aspect_ratio)[0]
+                image = process_image(image_file, image_processor, self.data_args.image_aspect_ratio, normalize=not self.data_args.uint8_frames)[0]
             except Exception as e:
                 traceback.print_exc()
                 backup_idx = random.randint(0, len(self.list_data_dict)-1)
@@ -722,7 +724,7 @@ class LazySupervisedDataset(Dataset):
             video_file = os.path.join(self.data_args.data_folder, video_file)
 
             try: 
-                video = process_video(video_file, video_processor, self.data_args.image_aspect_ratio, num_frames)
+                video = process_video(video_file, video_processor, self.data_args.image_aspect_ratio, num_frames, normalize=not self.data_args.uint8_frames)
             except Exception as e:
                 traceback.print_exc()
                 backup_idx = random.randint(0, len(self.list_data_dict)-1)
@@ -1041,7 +1043,7 @@ def train(attn_implementation=None):
         if training_args.local_rank == 0 or training_args.local_rank == -1:
             model.config.save_pretrained(training_args.output_dir)
             model.save_pretrained(training_args.output_dir, state_dict=state_dict)
-            torch.save(non_lora_state_dict, os.path.join(training_args.output_dir, 'non_lora_trainables.bin'))
+            save_weights(non_lora_state_dict, os.path.join(training_args.output_dir, 'non_lora_trainables.safetensors'))
     else:
         safe_save_model_for_hf_trainer(trainer=trainer, output_dir=training_args.output_dir)
 
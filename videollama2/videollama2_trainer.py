@@ -17,6 +17,8 @@ from transformers.trainer import (
     TRAINER_STATE_NAME,
 )
 
+from .model.multimodal_projector import save_weights
+
 
 def maybe_zero_3(param, ignore_status=False, name=None):
     from deepspeed import zero
@@ -107,9 +109,9 @@ def safe_save_model_for_hf_trainer(trainer: Trainer,
             if current_folder.startswith('checkpoint-'):
                 mm_projector_folder = os.path.join(parent_folder, "mm_projector")
                 os.makedirs(mm_projector_folder, exist_ok=True)
-                torch.save(weight_to_save, os.path.join(mm_projector_folder, f'{current_folder}.bin'))
+                save_weights(weight_to_save, os.path.join(mm_projector_folder, f'{current_folder}.safetensors'))
             else:
-                torch.save(weight_to_save, os.path.join(output_dir, f'mm_projector.bin'))
+                save_weights(weight_to_save, os.path.join(output_dir, f'mm_projector.safetensors'))
         return
 
     if trainer.deepspeed:
@@ -336,7 +338,7 @@ class VideoLLaMA2Trainer(Trainer):
 
             if self.args.local_rank == 0 or self.args.local_rank == -1:
                 self.model.config.save_pretrained(output_dir)
-                torch.save(weight_to_save, os.path.join(output_dir, f'mm_projector.bin'))
+                save_weights(weight_to_save, os.path.join(output_dir, f'mm_projector.safetensors'))
             # Save optimizer and scheduler
             self._save_optimizer_and_scheduler(output_dir)
             # Save RNG state
@@ -359,7 +361,7 @@ class VideoLLaMA2Trainer(Trainer):
                     self.model.config.save_pretrained(output_dir)
                     # save for acquring `adapter_config.json`, `adapter_model.bin`
                     # self.model.save_pretrained(output_dir, state_dict=state_dict)
-                    torch.save(non_lora_state_dict, os.path.join(output_dir, 'non_lora_trainables.bin'))
+                    save_weights(non_lora_state_dict, os.path.join(output_dir, 'non_lora_trainables.safetensors'))
 
                 # save for acquring lora adapter parameters & trainer states: `adapter_config.json`, `adapter_model.safetensors`
                 super(VideoLLaMA2Trainer, self)._save_checkpoint(model, trial, metrics)